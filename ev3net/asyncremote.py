@@ -0,0 +1,206 @@
+import asyncio
+from bindata import parse_value
+from condition import Condition
+from connection import Connection, AsyncConnection
+from protocol import CODECS, BinaryCodec, DecodeError, TextCodec
+from trace import Trace
+
+################################################################################
+#
+# Class representing a remote EV3, for use with asyncio
+#
+# The asyncio counterpart of RemoteEV3: requests are pipelined in the same
+# way, but callers await the responses instead of blocking on futures. Any
+# number of bricks can be driven from a single event loop. Create instances
+# with 'await AsyncRemoteEV3.connect(...)'.
+#
+class AsyncRemoteEV3:
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_connection',
+        '_pending',
+        '_next_id',
+        '_reader',
+        '_closed'
+    ]
+
+    #
+    # Construction from an established connection, use connect()
+    #
+    def __init__(self, connection):
+        self._connection = connection
+        self._pending    = {}
+        self._next_id    = 0
+        self._reader     = None
+        self._closed     = False
+
+    #
+    # Connect to a brick
+    #
+    @staticmethod
+    async def connect(remote_ip, remote_port = Connection.DEFAULT_PORT, protocol = BinaryCodec.NAME):
+        ev3 = AsyncRemoteEV3(await AsyncConnection.connect(remote_ip, remote_port))
+
+        # Negotiate the protocol, the server answers with the one it will use
+        if protocol != TextCodec.NAME:
+            ev3._connection.send(ev3.__make_id(), 'proto', protocol)
+            result, response = await ev3._connection.recv()
+            if not result:
+                raise ValueError('Connection closed')
+            ev3._connection.codec = CODECS.get(response[2][0], TextCodec)()
+
+        # Start the response reader
+        ev3._reader = asyncio.ensure_future(ev3.__read_responses())
+        return ev3
+
+    #
+    # Close the connection, outstanding requests fail
+    #
+    async def close(self):
+        self._connection.close()
+        await self._reader
+
+    #
+    # Determine name to use for a specific device
+    #
+    async def get_name(self, class_name, device_name):
+        return await self.__request('name', class_name, device_name)
+
+    #
+    # Get an attribute
+    #
+    async def get_attribute(self, name, attribute):
+        return await self.__request('get', name, attribute)
+
+    #
+    # Get an attribute as int, or None if it cannot be read as one
+    #
+    async def get_attribute_int(self, name, attribute):
+        values = await self.__request('geti', name, attribute, decode = lambda values : values)
+        if not values or values == ['']:
+            return None
+        return int(values[0])
+
+    #
+    # Get multiple attributes in a single round trip. Takes a list of
+    # (name, attribute) tuples, returns a list of values in the same order.
+    #
+    async def get_attributes(self, attributes):
+
+        # Flatten into name, attribute, name, attribute, ...
+        args = []
+        for name, attribute in attributes:
+            args.append(name)
+            args.append(attribute)
+
+        # The text protocol cannot distinguish between no values and one
+        # empty value, so trim or pad to the expected count
+        count  = len(attributes)
+        values = await self.__request('mget', *args, decode = lambda values : values)
+        values.extend([''] * (count - len(values)))
+        return values[:count]
+
+    #
+    # Get all values of a sensor in a single round trip. Returns a list of
+    # numbers, or None.
+    #
+    async def get_values(self, name):
+        values = await self.__request('vals', name, decode = lambda values : values)
+        if not values or values == ['']:
+            return None
+        return [parse_value(value) for value in values]
+
+    #
+    # Set an attribute
+    #
+    async def set_attribute(self, name, attribute, value):
+
+        # Send message, there is no response
+        if self._closed:
+            raise ValueError('Connection closed')
+        self._connection.send(self.__make_id(), 'set', name, attribute, value)
+        await self._connection.drain()
+
+    #
+    # Set multiple attributes in a single message. Takes a list of (name,
+    # attribute, value) tuples, which the brick applies in order.
+    #
+    async def set_attributes(self, sets):
+
+        # Flatten into name, attribute, value, name, ...
+        args = []
+        for name, attribute, value in sets:
+            args.extend((name, attribute, value))
+
+        # Send message, there is no response
+        if self._closed:
+            raise ValueError('Connection closed')
+        self._connection.send(self.__make_id(), 'mset', *args)
+        await self._connection.drain()
+
+    #
+    # Wait on the brick until a named condition holds, or the timeout in ms
+    # expires. Returns whether the condition was met.
+    #
+    async def wait(self, name, condition, arg = None, timeout = 0):
+        Condition(condition, arg)
+        return await self.__request('wait', name, condition, arg, timeout, decode = lambda values : int(values[0]) != 0)
+
+    #
+    # Allocate a request id
+    #
+    def __make_id(self):
+        self._next_id += 1
+        return self._next_id
+
+    #
+    # Send a request that expects a response, and wait for it
+    #
+    async def __request(self, msg, *args, decode = None):
+
+        # Fail immediately if the connection is gone
+        if self._closed:
+            raise ValueError('Connection closed')
+
+        # Register the future before sending
+        future = asyncio.get_running_loop().create_future()
+        msg_id = self.__make_id()
+        self._pending[msg_id] = (future, decode)
+        self._connection.send(msg_id, msg, *args)
+        await self._connection.drain()
+
+        return await future
+
+    #
+    # Response reader task
+    #
+    async def __read_responses(self):
+
+        while True:
+
+            # Receive response. A response that cannot be decoded leaves its
+            # request pending.
+            try:
+                result, response = await self._connection.recv()
+            except DecodeError as ex:
+                Trace.Warning('Invalid response', ex)
+                continue
+            if not result:
+                break
+
+            # Resolve the matching future, unless the caller gave up on it
+            msg_id, _, values = response
+            pending = self._pending.pop(msg_id, None)
+            if pending is not None and not pending[0].done():
+                future, decode = pending
+                future.set_result(values[0] if decode is None else decode(values))
+
+        # Connection closed, fail all outstanding requests
+        self._closed = True
+        pending, self._pending = self._pending, {}
+        for future, _ in pending.values():
+            if not future.done():
+                future.set_exception(ValueError('Connection closed'))
@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+
+#
+# Benchmarks for the ev3 network interface. Runs entirely on the local
+# machine, using a fake EV3 behind a server on the loopback interface, or a
+# LocalEV3 on an emulated sysfs tree.
+#
+
+import asyncio
+import tracemalloc
+from multiprocessing import Pool, Process
+from random import random
+from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, SHUT_RDWR
+from threading import Thread
+from time import perf_counter, sleep, time
+
+from trace import Trace
+from connection import Connection
+from fake import FakeEV3, FakeMediumMotor, FakeSensor, FakeLambdaAttribute
+from local import LocalEV3
+from protocol import TextCodec, BinaryCodec
+from remote import RemoteEV3
+from sensor import ColorSensor, GyroSensor, TouchSensor
+from sensorarray import SensorArray
+from server import Server
+from sysfs import SysfsTree
+
+#
+# Port used by the benchmark server
+#
+BENCH_PORT = 44500
+
+#
+# Print a result line
+#
+def report(name, count, elapsed):
+    print(name.ljust(40), str(int(count / elapsed)).rjust(10), 'msg/s')
+
+#
+# Create a fake brick with two motors
+#
+def make_fake_ev3():
+    fake_ev3 = FakeEV3()
+    fake_ev3.add_motor(FakeMediumMotor(), 'outA')
+    fake_ev3.add_motor(FakeMediumMotor(), 'outB')
+    return fake_ev3
+
+#
+# Start a server for a fake brick in the background
+#
+def start_server(port = BENCH_PORT, ev3 = None, unix_path = None):
+    server = Server(ev3 if ev3 is not None else make_fake_ev3())
+    Thread(target = server.main, args = ('127.0.0.1', port, unix_path), daemon = True).start()
+    sleep(0.1)
+    return server
+
+#
+# Run an asyncio mode server for a fake brick, in a separate process
+#
+def run_async_server(port):
+    Trace.level = Trace.TRACE_LEVEL_WARNING
+    asyncio.run(Server(make_fake_ev3()).main_async('127.0.0.1', port))
+
+#
+# Encode and decode a typical request/response pair
+#
+def bench_codec(codec, count = 100000):
+
+    start = perf_counter()
+    for i in range(count):
+        codec.decode(codec.encode(i, 'get', ('tacho-motor/motor0', 'position')))
+        codec.decode(codec.encode(i, 'ret', ('-1234',)))
+    report('codec ' + codec.NAME, count, perf_counter() - start)
+
+#
+# Pipelined attribute reads over the loopback interface
+#
+def bench_remote(protocol, count = 20000, window = 64):
+
+    ev3  = RemoteEV3('127.0.0.1', BENCH_PORT, protocol)
+    name = ev3.get_name('tacho-motor', 'outA')
+
+    start = perf_counter()
+    for _ in range(count // window):
+        futures = [ev3.get_attribute_future(name, 'driver_name') for _ in range(window)]
+        for future in futures:
+            future.result()
+    report('remote ' + protocol + ' pipelined get', count, perf_counter() - start)
+
+    start = perf_counter()
+    for _ in range(count // 10):
+        ev3.get_attribute(name, 'driver_name')
+    report('remote ' + protocol + ' sequential get', count // 10, perf_counter() - start)
+
+    ev3.close()
+    sleep(0.1)
+
+#
+# Client process for bench_clients, returns the number of reads done
+#
+def client_worker(args):
+
+    port, duration, window = args
+    ev3  = RemoteEV3('127.0.0.1', port)
+    name = ev3.get_name('tacho-motor', 'outA')
+
+    count    = 0
+    deadline = perf_counter() + duration
+    while perf_counter() < deadline:
+        futures = [ev3.get_attribute_future(name, 'driver_name') for _ in range(window)]
+        for future in futures:
+            future.result()
+        count += window
+
+    ev3.close()
+    return count
+
+#
+# Aggregate read throughput of an asyncio mode server, for a growing number of
+# concurrent clients, each in its own process
+#
+def bench_clients(client_counts = (1, 2, 4, 8, 16, 32), duration = 2, window = 16, port = BENCH_PORT + 3):
+
+    server = Process(target = run_async_server, args = (port,), daemon = True)
+    server.start()
+    sleep(0.5)
+
+    for clients in client_counts:
+        with Pool(clients) as pool:
+            count = sum(pool.map(client_worker, [(port, duration, window)] * clients))
+        report('async server, ' + str(clients) + ' clients', count, duration)
+
+    server.terminate()
+
+#
+# Memory allocated while sending and receiving bursts of packets. Reports the
+# peak memory in use above the baseline and the number of memory blocks still
+# allocated afterwards, both per packet.
+#
+def bench_allocations(size, count = 2000, burst = 50, port = BENCH_PORT + 1):
+
+    # Connect a pair of connections over the loopback interface
+    listener = Connection()
+    listener.listen('127.0.0.1', port)
+    client = Connection()
+    connector = Thread(target = client.connect, args = ('127.0.0.1', port))
+    connector.start()
+    listener.accept()
+    connector.join()
+    for connection in (listener, client):
+        connection.codec = BinaryCodec()
+
+    # Warm up with a single packet
+    payload = bytes(size)
+    listener.send(0, 'ret', payload)
+    client.recv()
+
+    # Send bursts, so that the receiver finds multiple packets per read
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.take_snapshot()
+    base_size, _ = tracemalloc.get_traced_memory()
+    for i in range(count // burst):
+        for j in range(burst):
+            listener.send(j, 'ret', payload)
+        for j in range(burst):
+            client.recv()
+    _, peak = tracemalloc.get_traced_memory()
+    blocks = sum(stat.count_diff for stat in tracemalloc.take_snapshot().compare_to(baseline, 'filename'))
+    tracemalloc.stop()
+
+    print(('allocations ' + str(size) + ' byte packets').ljust(40),
+          str((peak - base_size) // burst).rjust(10), 'peak bytes/packet',
+          str(round(blocks / count, 3)).rjust(8), 'blocks/packet')
+
+    client.close()
+
+#
+# Create a fake brick with a sensor whose value is the time it was read
+#
+def make_clock_ev3():
+    fake_ev3 = make_fake_ev3()
+    sensor = FakeSensor()
+    sensor.add_attribute(FakeLambdaAttribute('value0', get = lambda : repr(time())))
+    fake_ev3.add_sensor(sensor, 'in1')
+    return fake_ev3
+
+#
+# Forward a TCP connection, simulating packet loss on the way to the client.
+# A lost segment holds back everything behind it until it is retransmitted,
+# which takes at least the minimum retransmission timeout.
+#
+def run_lossy_proxy(listen_port, server_port, loss, rto = 0.2):
+
+    def pump(source, target, loss):
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                if loss and random() < loss:
+                    sleep(rto)
+                target.sendall(data)
+        except OSError:
+            pass
+        for s in (source, target):
+            try:
+                s.shutdown(SHUT_RDWR)
+            except OSError:
+                pass
+
+    listener = socket(AF_INET, SOCK_STREAM)
+    listener.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', listen_port))
+    listener.listen(1)
+
+    def accept():
+        client, _ = listener.accept()
+        server = socket(AF_INET, SOCK_STREAM)
+        server.connect(('127.0.0.1', server_port))
+        Thread(target = pump, args = (client, server, 0), daemon = True).start()
+        Thread(target = pump, args = (server, client, loss), daemon = True).start()
+    Thread(target = accept, daemon = True).start()
+
+#
+# Compare how stale the newest sensor value is over a TCP subscription and
+# over the UDP telemetry channel, with simulated packet loss. The age of the
+# newest value is sampled every millisecond; the tail shows the stalls.
+#
+def bench_telemetry(loss, duration = 3, period_ms = 2, port = BENCH_PORT + 4):
+
+    # Servers for both channels, TCP through a lossy proxy
+    start_server(port, make_clock_ev3())
+    start_server(port + 1, make_clock_ev3()).telemetry.loss = loss
+    run_lossy_proxy(port + 2, port, loss)
+
+    for channel, ev3 in (('tcp', RemoteEV3('127.0.0.1', port + 2)), ('udp', RemoteEV3('127.0.0.1', port + 1))):
+
+        name = ev3.get_name('lego-sensor', 'in1')
+        subscribe = ev3.subscribe if channel == 'tcp' else ev3.subscribe_telemetry
+        with subscribe(name, 'value0', period_ms) as subscription:
+
+            # Wait for the first value, then sample its age
+            subscription.next(1.0)
+            ages = []
+            end = perf_counter() + duration
+            while perf_counter() < end:
+                ages.append(time() - float(subscription.value))
+                sleep(0.001)
+
+        ages.sort()
+        percentile = lambda p : round(ages[min(len(ages) - 1, int(len(ages) * p))] * 1000, 1)
+        print(('telemetry ' + channel + ' ' + str(int(loss * 100)) + '% loss').ljust(40),
+              'p50', str(percentile(0.5)).rjust(6),
+              'p99', str(percentile(0.99)).rjust(6),
+              'max', str(round(ages[-1] * 1000, 1)).rjust(6), 'ms')
+        ev3.close()
+
+#
+# Compare the cost of a single attribute read over TCP on the loopback
+# interface, over a Unix domain socket, and from shared memory
+#
+def bench_transports(count = 20000, port = BENCH_PORT + 7, unix_path = '/tmp/ev3net-bench.sock'):
+
+    start_server(port, make_clock_ev3(), unix_path if Connection.HAVE_UNIX else None)
+
+    # Connections are served one at a time, close each before the next
+    transports = [('tcp', {})]
+    if Connection.HAVE_UNIX:
+        transports += [('unix', { 'unix_path' : unix_path }), ('shm', { 'unix_path' : unix_path })]
+    for transport, kwargs in transports:
+
+        ev3 = RemoteEV3('127.0.0.1', port, **kwargs)
+        name = ev3.get_name('lego-sensor', 'in1')
+        if transport == 'shm' and not ev3.share_attribute(name, 'value0', 1):
+            print(('transport ' + transport).ljust(40), 'not available')
+            ev3.close()
+            continue
+
+        start = perf_counter()
+        for i in range(count):
+            ev3.get_attribute(name, 'value0')
+        elapsed = perf_counter() - start
+        print(('transport ' + transport).ljust(40), str(round(elapsed / count * 1000000, 2)).rjust(10), 'us/request')
+        ev3.close()
+        sleep(0.1)
+
+#
+# Read attributes from an emulated sysfs tree, directly and through a server,
+# to measure the file layer that FakeEV3 skips
+#
+def bench_sysfs(count = 20000, window = 64, port = BENCH_PORT + 8):
+
+    with SysfsTree() as tree:
+        tree.add_default_devices()
+        ev3    = LocalEV3(root = tree.root)
+        motor  = ev3.get_name('tacho-motor', 'outA')
+        sensor = ev3.get_name('lego-sensor', 'in1')
+
+        # Reads on the local brick
+        reads = [
+            ('get_attribute',       lambda : ev3.get_attribute(motor, 'position')),
+            ('get_attribute_int',   lambda : ev3.get_attribute_int(motor, 'position')),
+            ('get_values',          lambda : ev3.get_values(sensor)),
+            ('get_name',            lambda : ev3.get_name('tacho-motor', 'outA'))
+        ]
+        with ev3.bind(motor, 'position') as position:
+            reads.append(('bound read_int', position.read_int))
+            for name, read in reads:
+                start = perf_counter()
+                for i in range(count):
+                    read()
+                elapsed = perf_counter() - start
+                print(('sysfs ' + name).ljust(40), str(round(elapsed / count * 1000000, 2)).rjust(10), 'us/read')
+
+        # Pipelined reads through a server
+        start_server(port, LocalEV3(root = tree.root))
+        remote = RemoteEV3('127.0.0.1', port)
+        start = perf_counter()
+        for _ in range(count // window):
+            futures = [remote.get_attribute_future(motor, 'position') for _ in range(window)]
+            for future in futures:
+                future.result()
+        report('sysfs remote pipelined get', count, perf_counter() - start)
+        remote.close()
+        sleep(0.1)
+
+#
+# Read the sensors of several bricks behind servers, one sensor at a time and
+# with a SensorArray
+#
+def bench_sensor_array(bricks = 4, count = 2000, port = BENCH_PORT + 9):
+
+    trees   = [SysfsTree() for _ in range(bricks)]
+    remotes = []
+    sensors = []
+    for index, tree in enumerate(trees):
+        tree.add_default_devices()
+        start_server(port + index, LocalEV3(root = tree.root))
+        remote = RemoteEV3('127.0.0.1', port + index)
+        remotes.append(remote)
+        sensors += [GyroSensor('in1', remote), ColorSensor('in2', remote), TouchSensor('in3', remote)]
+
+    array = SensorArray(sensors)
+    reads = [
+        ('per sensor',  lambda : [sensor.value() for sensor in sensors]),
+        ('SensorArray', array.read)
+    ]
+    for name, read in reads:
+        start = perf_counter()
+        for _ in range(count):
+            read()
+        elapsed = perf_counter() - start
+        print(('sensors ' + str(len(sensors)) + ' ' + name).ljust(40), str(round(elapsed / count * 1000000, 2)).rjust(10), 'us/tick')
+
+    for remote in remotes:
+        remote.close()
+    for tree in trees:
+        tree.close()
+    sleep(0.1)
+
+#
+# Run benchmarks as script
+#
+if __name__ == "__main__":
+
+    # Only show warnings and errors
+    Trace.level = Trace.TRACE_LEVEL_WARNING
+
+    bench_codec(TextCodec())
+    bench_codec(BinaryCodec())
+
+    bench_allocations(16)
+    bench_allocations(4096, port = BENCH_PORT + 2)
+
+    start_server()
+    bench_remote(TextCodec.NAME)
+    bench_remote(BinaryCodec.NAME)
+
+    bench_clients()
+
+    bench_telemetry(0.05)
+
+    bench_transports()
+
+    bench_sysfs()
+
+    bench_sensor_array()
@@ -0,0 +1,55 @@
+from struct import Struct, calcsize
+
+################################################################################
+#
+# Decoding of sensor bin_data
+#
+# The bin_data attribute of a sensor holds the raw values of its current mode
+# in one read, in the type named by bin_data_format. Reading it replaces a
+# read and string parse per valueN attribute. The attribute is the driver's
+# whole raw data buffer, so only the first num_values values are valid.
+#
+# Struct format characters by bin_data_format. Values are little endian
+# unless the format says otherwise.
+#
+FORMATS = {
+    'u8'        : '<B',
+    's8'        : '<b',
+    'u16'       : '<H',
+    's16'       : '<h',
+    's16_be'    : '>h',
+    's32'       : '<i',
+    's32_be'    : '>i',
+    'float'     : '<f'
+}
+
+#
+# Structs by (format, number of values)
+#
+_structs = {}
+
+#
+# Decode the first count values of bin_data in a format. Returns a list of
+# numbers, or None for an unknown format or data that holds fewer values.
+#
+def unpack_values(data, format, count):
+
+    code = FORMATS.get(format)
+    if code is None or len(data) < count * calcsize(code):
+        return None
+
+    values = _structs.get((format, count))
+    if values is None:
+        values = _structs[(format, count)] = Struct(code[0] + str(count) + code[1])
+    return list(values.unpack_from(data))
+
+#
+# Parse a value received as a string, as the text protocol does, into a number
+#
+def parse_value(value):
+    if not isinstance(value, str):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
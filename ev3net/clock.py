@@ -0,0 +1,113 @@
+from math import sqrt
+from time import time
+
+################################################################################
+#
+# Class representing the estimated clock of a remote brick
+#
+# The offset is estimated NTP-style from ping exchanges: the server reports
+# its clock, which is compared against the midpoint of the client's send and
+# receive times. The exchange with the shortest round trip gives the best
+# estimate; the spread over all exchanges indicates how reliable it is.
+# Successive syncs also give the drift between both clocks.
+#
+class Clock:
+
+    #
+    # Default number of ping exchanges per sync
+    #
+    DEFAULT_SAMPLES = 8
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_offset',
+        '_delay',
+        '_jitter',
+        '_drift',
+        '_samples',
+        '_synced_at'
+    ]
+
+    #
+    # Construction, the clock is unsynchronized until sync() is called
+    #
+    def __init__(self):
+        self._offset    = 0.0
+        self._delay     = None
+        self._jitter    = None
+        self._drift     = None
+        self._samples   = 0
+        self._synced_at = None
+
+    #
+    # Offset of the remote clock relative to the local one, in seconds
+    #
+    offset = property(fget = lambda self : self._offset)
+
+    #
+    # Shortest round trip seen during the last sync, in seconds. The offset
+    # is accurate to within half of this.
+    #
+    delay = property(fget = lambda self : self._delay)
+
+    #
+    # Standard deviation of the offsets measured during the last sync
+    #
+    jitter = property(fget = lambda self : self._jitter)
+
+    #
+    # Drift of the remote clock relative to the local one between the last
+    # two syncs, in seconds per second. None until synced twice.
+    #
+    drift = property(fget = lambda self : self._drift)
+
+    #
+    # Number of exchanges used in the last sync, and when it happened
+    #
+    samples     = property(fget = lambda self : self._samples)
+    synced_at   = property(fget = lambda self : self._synced_at)
+
+    #
+    # Whether the clock has been synchronized
+    #
+    synced = property(fget = lambda self : self._synced_at is not None)
+
+    #
+    # Synchronize using a function that returns the remote clock
+    #
+    def sync(self, ping, samples = DEFAULT_SAMPLES):
+
+        # Measure offset and round trip for each exchange
+        measurements = []
+        for _ in range(samples):
+            sent     = time()
+            remote   = ping()
+            received = time()
+            measurements.append((received - sent, remote - (sent + received) / 2))
+
+        # Use the exchange with the shortest round trip
+        delay, offset = min(measurements)
+        mean = sum(m[1] for m in measurements) / len(measurements)
+        jitter = sqrt(sum((m[1] - mean) ** 2 for m in measurements) / len(measurements))
+
+        # Determine drift since the previous sync
+        now = time()
+        if self._synced_at is not None and now > self._synced_at:
+            self._drift = (offset - self._offset) / (now - self._synced_at)
+
+        self._offset    = offset
+        self._delay     = delay
+        self._jitter    = jitter
+        self._samples   = samples
+        self._synced_at = now
+
+    #
+    # Convert a local timestamp to the remote clock and back
+    #
+    def to_remote(self, timestamp):
+        return timestamp + self._offset
+
+    def to_local(self, timestamp):
+        return timestamp - self._offset
@@ -0,0 +1,66 @@
+################################################################################
+#
+# Class representing a named condition on a motor attribute
+#
+# Named conditions can be evaluated anywhere, unlike arbitrary callables,
+# which lets a server wait for them locally on behalf of a client.
+#
+class Condition:
+
+    #
+    # Condition names
+    #
+    STOPPED     = 'stopped'
+    POSITION    = 'position'
+
+    #
+    # Attribute inspected by each condition
+    #
+    ATTRIBUTES  = {
+        STOPPED     : 'state',
+        POSITION    : 'position'
+    }
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_name',
+        '_target',
+        '_direction'
+    ]
+
+    #
+    # Construction. The argument is the target position for POSITION, and is
+    # ignored for STOPPED.
+    #
+    def __init__(self, name, arg = None):
+        if not name in Condition.ATTRIBUTES:
+            raise ValueError('Invalid condition ' + str(name))
+        if name == Condition.POSITION and arg is None:
+            raise ValueError('Condition ' + name + ' needs a target position')
+        self._name      = name
+        self._target    = int(arg) if name == Condition.POSITION else None
+        self._direction = None
+
+    #
+    # Condition name and inspected attribute
+    #
+    name        = property(fget = lambda self : self._name)
+    attribute   = property(fget = lambda self : Condition.ATTRIBUTES[self._name])
+
+    #
+    # Check the condition against a value of the attribute
+    #
+    def check(self, value):
+
+        # The motor is stopped when its state does not include running
+        if self._name == Condition.STOPPED:
+            return not 'running' in str(value).split()
+
+        # The position is reached when it is at or past the target, as seen
+        # from the first position checked
+        distance = self._target - int(value)
+        if self._direction is None:
+            self._direction = distance >= 0
+        return distance == 0 or (distance > 0) != self._direction
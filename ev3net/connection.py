@@ -1,16 +1,28 @@
 #
 # Imports
 #
-from socket import SocketIO, socket, AF_INET, SOCK_STREAM
+from socket import SocketIO, socket, AF_INET, SOCK_STREAM, SHUT_RDWR, IPPROTO_TCP, TCP_NODELAY
+import asyncio
+import os
+import socket as sockets
+import stat
+from select import select
+from struct import Struct
+from protocol import TextCodec
 from trace import Trace
 
 class Connection:
 
     __slots__ = [
-        '_listen_socket',
+        '_listen_sockets',
         '_client_socket',
         '_remote_address',
-        '_recv_buffer'
+        '_recv_buffer',
+        '_recv_view',
+        '_recv_start',
+        '_recv_end',
+        '_send_header',
+        '_codec'
     ]
 
     #
@@ -18,95 +30,397 @@ class Connection:
     #
     DEFAULT_PORT = 44444
 
+    #
+    # Unix domain sockets are not available on all platforms
+    #
+    HAVE_UNIX = hasattr(sockets, 'AF_UNIX')
+
+    #
+    # Unix domain socket path of the server on a port, for clients on the
+    # same host, and that of the default port
+    #
+    UNIX_PATH_FORMAT  = '/tmp/ev3net-{}.sock'
+    DEFAULT_UNIX_PATH = UNIX_PATH_FORMAT.format(DEFAULT_PORT)
+
+    #
+    # Addresses of this host, and the address reported for peers connected
+    # through a Unix domain socket
+    #
+    LOCAL_HOSTS   = ('127.0.0.1', '::1', 'localhost')
+    LOCAL_ADDRESS = '127.0.0.1'
+
+    #
+    # Initial receive buffer size, grows if a single packet does not fit
+    #
+    RECV_BUFFER_SIZE = 65536
+
+    #
+    # Packet length prefix, includes the prefix itself
+    #
+    LENGTH = Struct('<I')
+
+    #
+    # Gathering writes are not available on all platforms
+    #
+    HAVE_SENDMSG = hasattr(socket, 'sendmsg')
+
     #
     # Construction
     #
     def __init__(self):
-        pass
+        self._codec = TextCodec()
+        self._listen_sockets = []
+        self._remote_address = None
+        self._send_header = bytearray(Connection.LENGTH.size)
+        self.__reset_buffer()
+
+    #
+    # Message codec, all connections start out using the text protocol
+    #
+    def __set_codec(self, codec):
+        self._codec = codec
+    codec = property(fget = lambda self : self._codec, fset = __set_codec)
+
+    #
+    # Address of the connected peer
+    #
+    remote_address = property(fget = lambda self : self._remote_address)
 
     #
     # Listen for connections
     #
     def listen(self, address = '0.0.0.0', port = DEFAULT_PORT):
-        self._listen_socket = socket(AF_INET, SOCK_STREAM)
-        self._listen_socket.bind((address, port))
-        self._listen_socket.listen()
+        listen_socket = socket(AF_INET, SOCK_STREAM)
+        listen_socket.bind((address, port))
+        listen_socket.listen()
+        self._listen_sockets.append(listen_socket)
         Trace.Info('Listening on', address, ':', port)
 
     #
-    # Accept connection
+    # Get the Unix domain socket path of the server on a port
     #
-    def accept(self):
+    @staticmethod
+    def get_unix_path(port):
+        return Connection.UNIX_PATH_FORMAT.format(port)
+
+    #
+    # Listen for connections on a Unix domain socket as well, replacing a
+    # stale socket file left behind by an earlier server
+    #
+    def listen_unix(self, path = DEFAULT_UNIX_PATH):
+        Connection.remove_unix_path(path)
+        listen_socket = socket(sockets.AF_UNIX, SOCK_STREAM)
+        listen_socket.bind(path)
+        listen_socket.listen()
+        self._listen_sockets.append(listen_socket)
+        Trace.Info('Listening on', path)
+
+    #
+    # Remove a Unix domain socket file left behind by a server that is no
+    # longer running. Raises OSError if a server still listens on it.
+    #
+    @staticmethod
+    def remove_unix_path(path):
+
+        try:
+            if not stat.S_ISSOCK(os.stat(path).st_mode):
+                return
+        except FileNotFoundError:
+            return
+
+        # Only a socket nobody accepts on is stale
+        probe = socket(sockets.AF_UNIX, SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)
+            return
+        finally:
+            probe.close()
+        raise OSError('Unix domain socket ' + path + ' is in use by another server')
+
+    #
+    # Accept connection, waiting at most timeout seconds. Returns whether a
+    # connection was accepted.
+    #
+    def accept(self, timeout = None):
+
+        # Wait for a connection on any of the listening sockets
+        ready = select(self._listen_sockets, [], [], timeout)[0]
+        if not ready:
+            return False
+        listen_socket = ready[0]
 
         # Release existing client socket
         self._client_socket = None
 
         # Clear receive buffer
-        self._recv_buffer = bytes()
-        
+        self.__reset_buffer()
+
         # Accept new connection
-        self._client_socket, self._remote_address = self._listen_socket.accept()
-        Trace.Info('Connection from', self._remote_address)
+        self._client_socket, self._remote_address = listen_socket.accept()
 
-        # Mark socket blocking
+        # Mark socket blocking, and send small messages immediately
         self._client_socket.setblocking(True)
+        if listen_socket.family == AF_INET:
+            self._client_socket.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        else:
+            self._remote_address = (Connection.LOCAL_ADDRESS, listen_socket.getsockname())
+        Trace.Info('Connection from', self._remote_address)
+        return True
 
     #
     # Establish connection
     #
     def connect(self, address, port = DEFAULT_PORT):
         # Clear receive buffer
-        self._recv_buffer = bytes()
+        self.__reset_buffer()
 
         # Create new socket and connect        
         self._client_socket = socket(AF_INET, SOCK_STREAM)
         self._client_socket.connect((address, port))
+        self._remote_address = (address, port)
 
-        # Mark socket blocking
+        # Mark socket blocking, and send small messages immediately
         self._client_socket.setblocking(True)
+        self._client_socket.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+
+    #
+    # Establish connection through a Unix domain socket
+    #
+    def connect_unix(self, path = DEFAULT_UNIX_PATH):
+        self.__reset_buffer()
+        self._client_socket = socket(sockets.AF_UNIX, SOCK_STREAM)
+        self._client_socket.connect(path)
+        self._client_socket.setblocking(True)
+        self._remote_address = (Connection.LOCAL_ADDRESS, path)
+
+    #
+    # Whether the peer is on this host
+    #
+    def is_local(self):
+        return self._remote_address is not None and self._remote_address[0] in Connection.LOCAL_HOSTS
+
+    #
+    # Close the connection
+    #
+    def close(self):
+        try:
+            self._client_socket.shutdown(SHUT_RDWR)
+        except:
+            pass
+        self._client_socket.close()
+
+    #
+    # Allocate an empty receive buffer
+    #
+    def __reset_buffer(self, size = RECV_BUFFER_SIZE):
+        self._recv_buffer = bytearray(size)
+        self._recv_view   = memoryview(self._recv_buffer)
+        self._recv_start  = 0
+        self._recv_end    = 0
 
     # Send packet
-    def send(self, msg, *args):
+    def send(self, msg_id, op, *args):
 
-        # Combine message and arguments
-        parts = list()
-        parts.append(msg)
-        parts.extend(args)
+        # Encode message
+        msg = self._codec.encode(msg_id, op, args)
 
-        # Join all argument parts as trimmed strings, and encode
-        msg = ':'.join(map(lambda v : str(v).strip(), parts)).encode()
+        # Compose length prefix in place, and send prefix and message with a
+        # single gathering write
+        size = len(msg) + Connection.LENGTH.size
+        Connection.LENGTH.pack_into(self._send_header, 0, size)
+        sent = self._client_socket.sendmsg((self._send_header, msg)) if Connection.HAVE_SENDMSG else 0
 
-        # Compose packet
-        data = (len(msg) + 4).to_bytes(4, byteorder='little') + msg
-        
-        # Send packet
-        self._client_socket.sendall(data)
+        # Send whatever remains after a partial write
+        if sent < size:
+            self._client_socket.sendall((bytes(self._send_header) + msg)[sent:])
 
-    # Receive packet
+    # Receive packet, returns the decoded (msg_id, op, args)
+    #
+    # Data is received directly into the receive buffer, and packets are
+    # decoded from a view on that buffer. Unprocessed data is moved to the
+    # front of the buffer only when the free space at the end runs out.
+    #
+    # A packet that cannot be decoded raises DecodeError. The packet has been
+    # consumed by then, so the next call receives the packet after it. A
+    # length prefix that does not cover itself means that the stream cannot
+    # be followed any further, the connection is closed.
     def recv(self):
 
         # Receive data until an entire response is available
         while True:
 
             # Check the receive buffer for a complete response length
-            if len(self._recv_buffer) >= 4:
+            start     = self._recv_start
+            available = self._recv_end - start
+            data_len  = 0
+            if available >= Connection.LENGTH.size:
 
                 # Extract the response length
-                data_len = int.from_bytes(self._recv_buffer[:4], byteorder='little')
-                if len(self._recv_buffer) >= data_len:
+                data_len = Connection.LENGTH.unpack_from(self._recv_buffer, start)[0]
+                if data_len < Connection.LENGTH.size:
+                    Trace.Warning('Invalid packet length', data_len, 'from', self._remote_address)
+                    self.close()
+                    return False, None
+                if available >= data_len:
 
-                    # Extract the response
-                    data = self._recv_buffer[4:data_len]
-                    self._recv_buffer = self._recv_buffer[data_len:]
-                    return True, data
+                    # Decode the response in place, and rewind if the buffer is empty
+                    data = self._recv_view[start + Connection.LENGTH.size:start + data_len]
+                    self._recv_start = start + data_len
+                    if self._recv_start == self._recv_end:
+                        self._recv_start = self._recv_end = 0
+                    return True, self._codec.decode(data)
+
+            # Make room for the rest of the response
+            self.__make_room(max(data_len, Connection.LENGTH.size))
 
             # Receive more data from the server
             try:
-                received = self._client_socket.recv(1024)
-                if len(received) == 0:
+                received = self._client_socket.recv_into(self._recv_view[self._recv_end:])
+                if received == 0:
                     return False, None
             except:
                 return False, None
 
-            # Append to buffer
-            self._recv_buffer += received
+            # Extend buffer contents
+            self._recv_end += received
+
+    #
+    # Wait until a packet can be received, or the timeout in seconds expires.
+    # Waits indefinitely if the timeout is None. Returns whether recv() will
+    # have data to work with, which includes the connection being closed.
+    #
+    def wait(self, timeout = None):
+
+        # A complete packet is already buffered
+        available = self._recv_end - self._recv_start
+        if available >= Connection.LENGTH.size:
+            if available >= Connection.LENGTH.unpack_from(self._recv_buffer, self._recv_start)[0]:
+                return True
+
+        # Wait for the socket
+        try:
+            readable, _, _ = select((self._client_socket,), (), (), timeout)
+        except:
+            return True
+        return len(readable) > 0
+
+    #
+    # Make sure a packet of the specified size fits in the receive buffer
+    #
+    def __make_room(self, size):
+
+        # Enough room left at the end
+        if self._recv_start + size <= len(self._recv_buffer) and self._recv_end < len(self._recv_buffer):
+            return
+
+        # Grow the buffer if the packet cannot fit at all
+        start     = self._recv_start
+        available = self._recv_end - start
+        if size > len(self._recv_buffer):
+            view = self._recv_view
+            self.__reset_buffer(max(size, 2 * len(self._recv_buffer)))
+            self._recv_view[:available] = view[start:start + available]
+            self._recv_end = available
+            return
+
+        # Move unprocessed data to the front
+        self._recv_view[:available] = self._recv_view[start:start + available]
+        self._recv_start = 0
+        self._recv_end   = available
+
+
+################################################################################
+#
+# Connection on top of asyncio streams, using the same packet format
+#
+class AsyncConnection:
+
+    __slots__ = [
+        '_reader',
+        '_writer',
+        '_remote_address',
+        '_codec'
+    ]
+
+    #
+    # Construction from a connected stream pair
+    #
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._remote_address = writer.get_extra_info('peername')
+        self._codec  = TextCodec()
+
+        # Send small messages immediately
+        sock = writer.get_extra_info('socket')
+        if sock is not None and sock.family == AF_INET:
+            sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        elif sock is not None:
+            self._remote_address = (Connection.LOCAL_ADDRESS, sock.getsockname())
+
+    #
+    # Establish connection
+    #
+    @staticmethod
+    async def connect(address, port = Connection.DEFAULT_PORT):
+        reader, writer = await asyncio.open_connection(address, port)
+        return AsyncConnection(reader, writer)
+
+    #
+    # Establish connection through a Unix domain socket
+    #
+    @staticmethod
+    async def connect_unix(path = Connection.DEFAULT_UNIX_PATH):
+        reader, writer = await asyncio.open_unix_connection(path)
+        return AsyncConnection(reader, writer)
+
+    #
+    # Message codec, all connections start out using the text protocol
+    #
+    def __set_codec(self, codec):
+        self._codec = codec
+    codec = property(fget = lambda self : self._codec, fset = __set_codec)
+
+    #
+    # Remote address
+    #
+    remote_address = property(fget = lambda self : self._remote_address)
+
+    #
+    # Close the connection
+    #
+    def close(self):
+        self._writer.close()
+
+    # Send packet. The packet is buffered, use drain() to wait until the
+    # buffer has been flushed.
+    def send(self, msg_id, op, *args):
+        msg = self._codec.encode(msg_id, op, args)
+        self._writer.writelines((Connection.LENGTH.pack(len(msg) + Connection.LENGTH.size), msg))
+
+    #
+    # Wait until the send buffer has been flushed
+    #
+    async def drain(self):
+        try:
+            await self._writer.drain()
+        except ConnectionError:
+            pass
+
+    # Receive packet, returns the decoded (msg_id, op, args). Raises
+    # DecodeError for a packet that cannot be decoded, and closes the
+    # connection on an invalid length prefix, like Connection.recv.
+    async def recv(self):
+        try:
+            header = await self._reader.readexactly(Connection.LENGTH.size)
+            size   = Connection.LENGTH.unpack(header)[0]
+            if size < Connection.LENGTH.size:
+                Trace.Warning('Invalid packet length', size, 'from', self._remote_address)
+                self.close()
+                return False, None
+            data   = await self._reader.readexactly(size - Connection.LENGTH.size)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return False, None
+        return True, self._codec.decode(data)
@@ -1,8 +1,38 @@
 #
 # This is the client part of the ev3 network interface
 #
+from contextlib import nullcontext
+from inspect import isawaitable
+from os.path import exists
+from connection import Connection
+from history import History
+from readcache import ReadCache
+from schema import Attribute, ListAttribute, schema_of
 from local  import LocalEV3
 from remote import RemoteEV3 
+from pool   import RemotePool
+
+
+################################################################################
+#
+# Await a value returned by an EV3 instance if it is awaitable, so that the
+# async device methods work with both asyncio and blocking instances
+#
+async def await_value(value):
+    return (await value) if isawaitable(value) else value
+
+#
+# Check the value returned by an EV3 instance to a blocking device method. An
+# asyncio instance returns a coroutine, which would be dropped without ever
+# running, so it is closed and the caller is pointed to the async method.
+#
+def check_blocking(value, method):
+    if isawaitable(value):
+        close = getattr(value, 'close', None)
+        if close is not None:
+            close()
+        raise TypeError(method + ' cannot be used on an asyncio instance, use ' + method + '_async')
+    return value
 
 
 ################################################################################
@@ -93,6 +123,120 @@ class EV3:
         # Return the instance
         return instance
 
+    #
+    # Get an instance using the fastest transport available: the local brick
+    # if no address is given, the server's Unix domain socket if the address
+    # is on this host and the socket exists, and TCP otherwise. The socket
+    # path defaults to the one of the server on the port. Remote instances
+    # are registered like those of get_remote_instance.
+    #
+    @staticmethod
+    def get_instance(remote_ip = None, remote_port = Connection.DEFAULT_PORT, unix_path = None):
+
+        # Local brick
+        if remote_ip is None:
+            return EV3.get_local_instance()
+
+        # Combine ip and port into key and find existing instance
+        key = remote_ip + ':' + str(remote_port)
+        instance = EV3.__instance_dict.get(key)
+        if instance != None:
+            return instance
+
+        # Prefer the Unix domain socket for a server on this host
+        unix_path = unix_path if unix_path is not None else Connection.get_unix_path(remote_port)
+        if Connection.HAVE_UNIX and remote_ip in Connection.LOCAL_HOSTS and exists(unix_path):
+            try:
+                instance = RemoteEV3(remote_ip, remote_port, unix_path = unix_path)
+            except OSError:
+                instance = None
+
+        # Fall back to TCP
+        if instance == None:
+            instance = RemoteEV3(remote_ip, remote_port)
+
+        EV3.__instance_dict[key] = instance
+        return instance
+
+    #
+    # Get all registered remote instances, as a dictionary by 'ip:port'
+    #
+    @staticmethod
+    def get_remote_instances():
+        return dict(EV3.__instance_dict)
+
+    #
+    # Get a pooled remote EV3 instance for a specific IP and port. The pool
+    # keeps up to size connections, so that threads using the same brick run
+    # in parallel; the server must run in asyncio mode.
+    #
+    @staticmethod
+    def get_pooled_instance(remote_ip, remote_port, size = RemotePool.DEFAULT_SIZE):
+
+        # Combine ip and port into key and find existing instance
+        key = remote_ip + ':' + str(remote_port)
+        instance = EV3.__instance_dict.get(key)
+
+        # If not found, create a pool and cache it
+        if instance == None:
+            instance = RemotePool(remote_ip, remote_port, size)
+            EV3.__instance_dict[key] = instance
+
+        # Return the instance
+        return instance
+
+
+################################################################################
+#
+# Class representing a bound attribute on instances without direct access,
+# with the same interface as a local BoundAttribute
+#
+class BoundDeviceAttribute:
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_ev3',
+        '_name',
+        '_attribute'
+    ]
+
+    #
+    # Construction
+    #
+    def __init__(self, ev3, name, attribute):
+        self._ev3       = ev3
+        self._name      = name
+        self._attribute = attribute
+
+    #
+    # Read the value as a string, or as an integer
+    #
+    def read(self):
+        return self._ev3.get_attribute(self._name, self._attribute)
+
+    def read_int(self):
+        return int(self.read())
+
+    #
+    # Write a value
+    #
+    def write(self, value):
+        self._ev3.set_attribute(self._name, self._attribute, value)
+
+    #
+    # Nothing to close
+    #
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
 
 ################################################################################
 #
@@ -106,48 +250,224 @@ class Device:
     __slots__ = [
         '_ev3',
         '_name',
-        '_cache'
+        '_cache',
+        '_static',
+        '_reads',
+        '_driver'
     ]
 
+    #
+    # Attributes whose sets can change any other attribute
+    #
+    INVALIDATES_ALL = ('command', 'mode')
+
 
     #
     # Construction
     #
+    # With an asyncio instance such as AsyncRemoteEV3, the device must be
+    # awaited before use, which resolves its name and checks the driver:
+    #
+    #   motor = await MediumMotor('outA', ev3)
+    #
     def __init__(self, class_name, device_name, driver_name = None, ev3_instance = None):        
         
-        # Initialize attribute cache
-        self._cache = {}
+        # Initialize attribute caches, with the maximum ages of the schema
+        self._cache  = {}
+        self._static = {}
+        self._reads  = ReadCache({ name : attribute.max_age_ms for name, attribute in schema_of(type(self)).items() if attribute.max_age_ms })
 
         # Get EV3 instance
         self._ev3 = ev3_instance if not ev3_instance == None else EV3.get_default_instance()
         
-        # Get name, then match the driver name 
-        self._name  = self._ev3.get_name(class_name, device_name)
+        # Get name, then match the driver name. Asyncio instances return an
+        # awaitable name, which is resolved when the device is awaited.
+        self._name   = self._ev3.get_name(class_name, device_name)
+        self._driver = driver_name
+        if isawaitable(self._name):
+            return
         if not driver_name is None and self.driver_name != driver_name:
             raise ValueError('Expected driver name ' + str(driver_name) + ', got ' + str(self.driver_name))
 
+    #
+    # Resolve the name and check the driver, for asyncio instances
+    #
+    def __await__(self):
+        return self.__resolve_async().__await__()
+
+    async def __resolve_async(self):
+        self._name = await await_value(self._name)
+        if not self._driver is None:
+            driver_name = self._cache.get('driver_name')
+            if driver_name is None:
+                driver_name = self._cache['driver_name'] = await self.get_attribute_async('driver_name')
+            if driver_name != self._driver:
+                raise ValueError('Expected driver name ' + str(self._driver) + ', got ' + str(driver_name))
+        return self
+
     #
     # Get name
     #
     name = property(fget = lambda self : self._name)
 
     #
-    # Get an attribute
+    # Get the EV3 instance the device is on
+    #
+    ev3 = property(fget = lambda self : self._ev3)
+
+    #
+    # Get an attribute, from the read cache if it holds a recent enough value
     #
     def get_attribute(self, attribute):
-        return self._ev3.get_attribute(self._name, attribute)
+        hit, value, timestamp = self._reads.lookup(attribute)
+        if hit:
+            return value
+        value = check_blocking(self._ev3.get_attribute(self._name, attribute), 'get_attribute')
+        self._reads.store(attribute, value, timestamp)
+        return value
 
     #
     # Get an attribute as int
     #
     def get_attribute_int(self, attribute):
+        get_attribute_int = getattr(self._ev3, 'get_attribute_int', None)
+        if get_attribute_int is not None and not self._reads.caches(attribute):
+            return check_blocking(get_attribute_int(self._name, attribute), 'get_attribute_int')
         return int(self.get_attribute(attribute))
 
+    #
+    # Bind an attribute, for reading or writing it repeatedly. On the local
+    # brick, the returned object reads the attribute file directly; close it
+    # when done.
+    #
+    def bind(self, attribute):
+        bind = getattr(self._ev3, 'bind', None)
+        if bind is not None:
+            return bind(self._name, attribute)
+        return BoundDeviceAttribute(self._ev3, self._name, attribute)
+
+    #
+    # Get multiple attributes in a single request
+    #
+    def get_attributes(self, attributes):
+        return check_blocking(self._ev3.get_attributes([(self._name, attribute) for attribute in attributes]), 'get_attributes')
+
     #
     # Set an attribute
     #
     def set_attribute(self, attribute, value):
-        return self._ev3.set_attribute(self._name, attribute, value)
+        self.__invalidate(attribute)
+        return check_blocking(self._ev3.set_attribute(self._name, attribute, value), 'set_attribute')
+
+    #
+    # Set multiple attributes in a single request. Takes a list of
+    # (attribute, value) tuples, which are applied in order.
+    #
+    def set_attributes(self, values):
+        for attribute, _ in values:
+            self.__invalidate(attribute)
+        return check_blocking(self._ev3.set_attributes([(self._name, attribute, value) for attribute, value in values]), 'set_attributes')
+
+    #
+    # Gather the sets made during a with statement into a single request, on
+    # instances that support it
+    #
+    def batch(self):
+        batch = getattr(self._ev3, 'batch', None)
+        return batch() if batch is not None else nullcontext()
+
+    #
+    # Set multiple attributes at a given time, in seconds since the epoch on
+    # the local clock. Takes a list of (attribute, value) tuples, which are
+    # applied in order.
+    #
+    def set_attributes_at(self, timestamp, values):
+        for attribute, _ in values:
+            self.__invalidate(attribute)
+        return check_blocking(self._ev3.set_attributes_at(timestamp, [(self._name, attribute, value) for attribute, value in values]), 'set_attributes_at')
+
+    #
+    # Get an attribute, for asyncio instances
+    #
+    async def get_attribute_async(self, attribute):
+        hit, value, timestamp = self._reads.lookup(attribute)
+        if hit:
+            return value
+        value = await await_value(self._ev3.get_attribute(self._name, attribute))
+        self._reads.store(attribute, value, timestamp)
+        return value
+
+    #
+    # Get an attribute as int, for asyncio instances
+    #
+    async def get_attribute_int_async(self, attribute):
+        get_attribute_int = getattr(self._ev3, 'get_attribute_int', None)
+        if get_attribute_int is not None and not self._reads.caches(attribute):
+            return await await_value(get_attribute_int(self._name, attribute))
+        return int(await self.get_attribute_async(attribute))
+
+    #
+    # Get multiple attributes in a single request, for asyncio instances
+    #
+    async def get_attributes_async(self, attributes):
+        return await await_value(self._ev3.get_attributes([(self._name, attribute) for attribute in attributes]))
+
+    #
+    # Set an attribute, for asyncio instances
+    #
+    async def set_attribute_async(self, attribute, value):
+        self.__invalidate(attribute)
+        return await await_value(self._ev3.set_attribute(self._name, attribute, value))
+
+    #
+    # Set multiple attributes in a single request, for asyncio instances
+    #
+    async def set_attributes_async(self, values):
+        for attribute, _ in values:
+            self.__invalidate(attribute)
+        return await await_value(self._ev3.set_attributes([(self._name, attribute, value) for attribute, value in values]))
+
+    #
+    # Subscribe to an attribute. The callback, if any, is invoked with each new
+    # value; the returned Subscription can also be iterated over.
+    #
+    def subscribe(self, attribute, period_ms = 10, callback = None):
+        return self._ev3.subscribe(self._name, attribute, period_ms, callback)
+
+    #
+    # Subscribe to an attribute over the telemetry channel, where only the
+    # newest value matters. Falls back to a regular subscription on instances
+    # without one.
+    #
+    def subscribe_telemetry(self, attribute, period_ms = 10, callback = None):
+        subscribe = getattr(self._ev3, 'subscribe_telemetry', self._ev3.subscribe)
+        return subscribe(self._name, attribute, period_ms, callback)
+
+    #
+    # Record an integer attribute on the brick at a fixed rate, for fetching
+    # in bulk. Returns a History.
+    #
+    def sample(self, attribute, period_ms = 10, capacity = History.DEFAULT_CAPACITY):
+        return self._ev3.sample(self._name, attribute, period_ms, capacity)
+
+    #
+    # Set the maximum age in ms of cached reads of an attribute. Reads within
+    # that age of the previous read are answered from the cache; 0 or None
+    # stops caching the attribute.
+    #
+    def set_max_age(self, attribute, max_age_ms):
+        self._reads.set_max_age(attribute, max_age_ms)
+
+    #
+    # Cache of recent reads, with its hit statistics
+    #
+    read_cache = property(fget = lambda self : self._reads)
+
+    #
+    # Drop cached reads that a set of an attribute may have changed
+    #
+    def __invalidate(self, attribute):
+        self._reads.invalidate(None if attribute in Device.INVALIDATES_ALL else attribute)
 
     #
     # Get cached attribute
@@ -161,16 +481,35 @@ class Device:
 
         return value
 
+    #
+    # Get a static attribute, decoded once
+    #
+    def get_static_attribute(self, attribute, decode):
+        value = self._static.get(attribute)
+        if value is None:
+            value = decode(self.get_cached_attribute(attribute))
+            if value is not None:
+                self._static[attribute] = value
+        return value
+
     #
     # Clear a cached attribute
     #
     def clear_cached_attribute(self, attribute):
         self._cache.pop(attribute, None)
+        self._static.pop(attribute, None)
+
+    #
+    # Declared attributes of the device class, as { name : Attribute }
+    #
+    @classmethod
+    def get_schema(cls):
+        return schema_of(cls)
 
     #
     # Attributes
     #
-    address     = property(fget = lambda self : self.get_cached_attribute('address'))
-    command     = property(fset = lambda self, value : self.set_attribute('command', value))
-    commands    = property(fget = lambda self : self.get_cached_attribute('commands'))
-    driver_name = property(fget = lambda self : self.get_cached_attribute('driver_name'))
+    address     = Attribute(static = True)
+    command     = Attribute(readable = False, writable = True)
+    commands    = ListAttribute(static = True)
+    driver_name = Attribute(static = True)
@@ -0,0 +1,29 @@
+from threading import Timer
+from time import time
+
+################################################################################
+#
+# Base class for EV3 instances that set attributes on the devices directly,
+# rather than through a server. Derived classes implement set_attribute.
+#
+class DirectEV3:
+
+    #
+    # Members
+    #
+    __slots__ = []
+
+    #
+    # Set multiple attributes, in order. Takes a list of (name, attribute,
+    # value) tuples.
+    #
+    def set_attributes(self, sets):
+        for name, attribute, value in sets:
+            self.set_attribute(name, attribute, value)
+
+    #
+    # Set attributes at a given time, in seconds since the epoch. Takes a list
+    # of (name, attribute, value) tuples, applied in order from a timer.
+    #
+    def set_attributes_at(self, timestamp, sets):
+        Timer(max(0, timestamp - time()), self.set_attributes, args = (sets,)).start()
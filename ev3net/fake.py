@@ -2,13 +2,15 @@ import io
 import os
 import stat
 from trace import Trace
+from direct import DirectEV3
+from subscription import PollingSubscription
 from motor import Motor
 
 ################################################################################
 #
 # Class representing a fake EV3
 #
-class FakeEV3:
+class FakeEV3(DirectEV3):
 
     #
     # Valid inputs
@@ -136,6 +138,18 @@ class FakeEV3:
         # Pass to device
         return device.get_attribute(attribute)
 
+    #
+    # Get multiple attributes, takes a list of (name, attribute) tuples
+    #
+    def get_attributes(self, attributes):
+        return [self.get_attribute(name, attribute) for name, attribute in attributes]
+
+    #
+    # Subscribe to an attribute, sampled from a background thread
+    #
+    def subscribe(self, name, attribute, period_ms, callback = None):
+        return PollingSubscription(self, name, attribute, period_ms, callback)
+
     #
     # Set an attribute
     #
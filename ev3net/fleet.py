@@ -0,0 +1,222 @@
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from time import monotonic
+from clock import Clock
+from device import EV3
+
+################################################################################
+#
+# Class representing the results of an operation on a fleet of bricks
+#
+class FleetResult:
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_values',
+        '_errors'
+    ]
+
+    #
+    # Construction
+    #
+    def __init__(self):
+        self._values = {}
+        self._errors = {}
+
+    #
+    # Results by brick key, for the bricks that succeeded
+    #
+    values = property(fget = lambda self : self._values)
+
+    #
+    # Exceptions by brick key, for the bricks that failed or timed out
+    #
+    errors = property(fget = lambda self : self._errors)
+
+    #
+    # Whether all bricks succeeded
+    #
+    ok = property(fget = lambda self : len(self._errors) == 0)
+
+    #
+    # Get the result for a brick, raises its exception if it failed
+    #
+    def __getitem__(self, key):
+        error = self._errors.get(key)
+        if error is not None:
+            raise error
+        return self._values[key]
+
+
+################################################################################
+#
+# Class representing a fleet of bricks
+#
+# Runs reads and commands on all bricks concurrently, so that an operation
+# takes as long as the slowest brick rather than the sum of all of them.
+# Instances that return futures are used directly, others are called from a
+# thread pool. Results are keyed by brick, and bricks that fail or do not
+# respond within the timeout are reported in the result's errors.
+#
+class Fleet:
+
+    #
+    # Default timeout per brick, in seconds
+    #
+    DEFAULT_TIMEOUT = 1.0
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_bricks',
+        '_names',
+        '_executor'
+    ]
+
+    #
+    # Construction from a dictionary of EV3 instances by key. Defaults to all
+    # remote instances registered with EV3.
+    #
+    def __init__(self, bricks = None):
+        self._bricks    = dict(bricks) if bricks is not None else EV3.get_remote_instances()
+        self._names     = {}
+        self._executor  = ThreadPoolExecutor(max_workers = max(1, len(self._bricks)))
+
+    #
+    # Instances by key
+    #
+    bricks = property(fget = lambda self : self._bricks)
+
+    #
+    # Stop the thread pool
+    #
+    def close(self):
+        self._executor.shutdown(wait = False)
+
+    #
+    # Call a function taking an EV3 instance on every brick
+    #
+    def call(self, function, timeout = DEFAULT_TIMEOUT):
+        futures = { key : self._executor.submit(function, brick) for key, brick in self._bricks.items() }
+        return self.__collect(futures, timeout)
+
+    #
+    # Get an attribute of a device on every brick
+    #
+    def get_attribute(self, class_name, device_name, attribute, timeout = DEFAULT_TIMEOUT):
+
+        # Resolve device names first, then read from the bricks where that worked
+        deadline = monotonic() + timeout
+        names, result = self.__resolve(class_name, device_name, deadline)
+        futures = { key : self.__submit(self._bricks[key], 'get_attribute', name, attribute) for key, name in names.items() }
+        return self.__collect(futures, deadline - monotonic(), result)
+
+    #
+    # Get multiple attributes of a device on every brick, in one round trip
+    # per brick. The values for each brick are a list, in attribute order.
+    #
+    def get_attributes(self, class_name, device_name, attributes, timeout = DEFAULT_TIMEOUT):
+
+        deadline = monotonic() + timeout
+        names, result = self.__resolve(class_name, device_name, deadline)
+        futures = { key : self.__submit(self._bricks[key], 'get_attributes', [(name, attribute) for attribute in attributes]) for key, name in names.items() }
+        return self.__collect(futures, deadline - monotonic(), result)
+
+    #
+    # Set an attribute of a device on every brick
+    #
+    def set_attribute(self, class_name, device_name, attribute, value, timeout = DEFAULT_TIMEOUT):
+
+        deadline = monotonic() + timeout
+        names, result = self.__resolve(class_name, device_name, deadline)
+        futures = { key : self._executor.submit(self._bricks[key].set_attribute, name, attribute, value) for key, name in names.items() }
+        return self.__collect(futures, deadline - monotonic(), result)
+
+    #
+    # Synchronize the clocks of all bricks that support it. The values are the
+    # bricks' Clock objects.
+    #
+    def sync_clocks(self, samples = Clock.DEFAULT_SAMPLES, timeout = DEFAULT_TIMEOUT):
+        bricks = { key : brick for key, brick in self._bricks.items() if hasattr(brick, 'sync_clock') }
+        futures = { key : self._executor.submit(brick.sync_clock, samples) for key, brick in bricks.items() }
+        return self.__collect(futures, timeout)
+
+    #
+    # Set multiple attributes of a device on every brick at the same moment,
+    # in seconds since the epoch on the local clock. Takes a list of
+    # (attribute, value) tuples. Allow enough time for the commands to reach
+    # all bricks.
+    #
+    def set_attributes_at(self, class_name, device_name, timestamp, values, timeout = DEFAULT_TIMEOUT):
+
+        deadline = monotonic() + timeout
+        names, result = self.__resolve(class_name, device_name, deadline)
+        futures = { key : self._executor.submit(self._bricks[key].set_attributes_at, timestamp, [(name, attribute, value) for attribute, value in values]) for key, name in names.items() }
+        return self.__collect(futures, deadline - monotonic(), result)
+
+    #
+    # Resolve a device name on every brick, caching the results. Returns the
+    # names by key, and a result holding the errors for bricks that failed.
+    #
+    def __resolve(self, class_name, device_name, deadline):
+
+        # Look up the names that are not known yet
+        futures = {}
+        for key, brick in self._bricks.items():
+            if not (key, class_name, device_name) in self._names:
+                futures[key] = self.__submit(brick, 'get_name', class_name, device_name)
+        resolved = self.__collect(futures, deadline - monotonic())
+
+        # Cache the names that were found
+        result = FleetResult()
+        for key, name in resolved.values.items():
+            if name is None or name == 'None':
+                result.errors[key] = ValueError('Could not find device ' + class_name + ':' + device_name)
+            else:
+                self._names[(key, class_name, device_name)] = name
+        result.errors.update(resolved.errors)
+
+        # Return the names of the devices found
+        names = {}
+        for key in self._bricks:
+            name = self._names.get((key, class_name, device_name))
+            if name is not None:
+                names[key] = name
+        return names, result
+
+    #
+    # Start a method call on a brick, returns a future. Uses the instance's
+    # future variant of the method if it has one. A brick that fails to start
+    # the call, for instance because its connection is closed, gets a failed
+    # future, so that it is reported with the others.
+    #
+    def __submit(self, brick, method, *args):
+        future_method = getattr(brick, method + '_future', None)
+        if future_method is None:
+            return self._executor.submit(getattr(brick, method), *args)
+        try:
+            return future_method(*args)
+        except Exception as ex:
+            future = Future()
+            future.set_exception(ex)
+            return future
+
+    #
+    # Wait for futures by key until the timeout expires, and collect their
+    # results. Futures that time out are left to complete, a late response
+    # is dropped.
+    #
+    def __collect(self, futures, timeout, result = None):
+
+        result   = result if result is not None else FleetResult()
+        deadline = monotonic() + timeout
+        for key, future in futures.items():
+            try:
+                result.values[key] = future.result(max(0, deadline - monotonic()))
+            except TimeoutError:
+                result.errors[key] = TimeoutError('No response from ' + str(key))
+            except Exception as ex:
+                result.errors[key] = ex
+        return result
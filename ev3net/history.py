@@ -0,0 +1,190 @@
+from array import array
+from sys import byteorder
+
+################################################################################
+#
+# Sample history, recorded on the server at a fixed rate
+#
+# The server samples an attribute into a preallocated ring buffer of
+# timestamps and integer values, without a round trip per sample. Clients
+# fetch what was recorded since their last fetch in chunks: the timestamps
+# as little endian doubles, followed by the values as little endian 64 bit
+# integers. Each sample has a sequence number, counting from zero, so that a
+# client can tell which samples were overwritten before it fetched them.
+#
+
+#
+# Maximum number of samples in a chunk
+#
+MAX_CHUNK = 4096
+
+#
+# Encode samples as a chunk
+#
+def encode_chunk(timestamps, values):
+    if byteorder != 'little':
+        timestamps, values = array('d', timestamps), array('q', values)
+        timestamps.byteswap()
+        values.byteswap()
+    return timestamps.tobytes() + values.tobytes()
+
+#
+# Decode a chunk, returns (timestamps, values) arrays
+#
+def decode_chunk(data):
+    count = len(data) // 16
+    timestamps, values = array('d'), array('q')
+    timestamps.frombytes(data[:count * 8])
+    values.frombytes(data[count * 8:count * 16])
+    if byteorder != 'little':
+        timestamps.byteswap()
+        values.byteswap()
+    return timestamps, values
+
+
+################################################################################
+#
+# Class representing a ring buffer of samples, used by the server
+#
+class SampleRing:
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_timestamps',
+        '_values',
+        '_capacity',
+        '_count'
+    ]
+
+    #
+    # Construction, allocates room for capacity samples up front
+    #
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError('Invalid capacity ' + str(capacity))
+        self._timestamps    = array('d', bytes(8 * capacity))
+        self._values        = array('q', bytes(8 * capacity))
+        self._capacity      = capacity
+        self._count         = 0
+
+    #
+    # Number of samples the ring holds, and the sequence number of the next
+    # sample, which is the number of samples recorded
+    #
+    capacity    = property(fget = lambda self : self._capacity)
+    count       = property(fget = lambda self : self._count)
+
+    #
+    # Record a sample, overwriting the oldest when full
+    #
+    def append(self, timestamp, value):
+        index = self._count % self._capacity
+        self._timestamps[index] = timestamp
+        self._values[index]     = value
+        self._count += 1
+
+    #
+    # Read at most max_count samples, starting at sequence number since or at
+    # the oldest sample still held. Returns the sequence number of the first
+    # sample, and the timestamps and values as arrays.
+    #
+    def read(self, since, max_count = MAX_CHUNK):
+
+        first = min(max(since, self._count - self._capacity, 0), self._count)
+        count = min(self._count - first, max_count)
+
+        # Copy in one or two parts, depending on whether the range wraps
+        start = first % self._capacity
+        end   = start + count
+        if end <= self._capacity:
+            return first, self._timestamps[start:end], self._values[start:end]
+        end -= self._capacity
+        return first, self._timestamps[start:] + self._timestamps[:end], self._values[start:] + self._values[:end]
+
+
+################################################################################
+#
+# Class representing a sampler on the server, used by the client
+#
+# The fetch function takes the sequence number to fetch from, and returns the
+# sequence number of the first sample returned, the number of samples
+# recorded, and the chunk. The cancel function is invoked once on close.
+#
+class History:
+
+    #
+    # Default number of samples kept by the server
+    #
+    DEFAULT_CAPACITY = 8192
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_fetch',
+        '_cancel',
+        '_next',
+        '_lost',
+        '_closed'
+    ]
+
+    #
+    # Construction
+    #
+    def __init__(self, fetch, cancel = None):
+        self._fetch     = fetch
+        self._cancel    = cancel
+        self._next      = 0
+        self._lost      = 0
+        self._closed    = False
+
+    #
+    # Number of samples overwritten on the server before they were fetched
+    #
+    lost = property(fget = lambda self : self._lost)
+
+    #
+    # Fetch the samples recorded since the previous fetch. Returns the
+    # timestamps, in seconds since the epoch on the server's clock, and the
+    # values as arrays.
+    #
+    def fetch(self):
+
+        if self._closed:
+            raise ValueError('History closed')
+
+        timestamps, values = array('d'), array('q')
+        while True:
+
+            # Fetch the next chunk, and count what was missed before it
+            first, count, chunk = self._fetch(self._next)
+            chunk_timestamps, chunk_values = decode_chunk(chunk)
+            self._lost += first - self._next
+            self._next  = first + len(chunk_values)
+            timestamps.extend(chunk_timestamps)
+            values.extend(chunk_values)
+
+            # Stop when caught up
+            if not chunk_values or self._next >= count:
+                return timestamps, values
+
+    #
+    # Stop sampling on the server
+    #
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._cancel is not None:
+            self._cancel()
+
+    #
+    # Context manager support
+    #
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,106 +1,642 @@
+import errno
 import io
 import os
+import select
 import stat
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic, sleep
 from trace import Trace
+from bindata import unpack_values
+from condition import Condition
+from direct import DirectEV3
+from subscription import PollingSubscription
 
 ################################################################################
 #
-# Class representing a local EV3
+# Class representing an open attribute file
+#
+# Reads go straight to the file descriptor with a positioned read into a
+# buffer owned by the attribute, so reading allocates nothing but the result.
+# Integers are parsed from the buffer directly: the buffer is kept padded
+# with spaces after the value, which int() ignores. An attribute is not
+# thread safe, each thread should bind its own.
 #
-class LocalEV3:
+class BoundAttribute:
+
+    #
+    # Initial buffer size, grows for longer values
+    #
+    BUFFER_SIZE = 64
+
+    #
+    # Positioned reads are not available on all platforms
+    #
+    HAVE_PREADV = hasattr(os, 'preadv')
 
     #
     # Members
     #
     __slots__ = [
-        '_attrs'
+        '_file',
+        '_fd',
+        '_buffer',
+        '_buffers',
+        '_view',
+        '_length',
+        '_truncate'
+    ]
+
+    #
+    # Construction from an open file. Writes truncate the file if asked to,
+    # which regular files need and sysfs attributes do not.
+    #
+    def __init__(self, file, truncate = False):
+        self._file      = file
+        self._fd        = file.fileno()
+        self._length    = 0
+        self._truncate  = truncate
+        self.__allocate(BoundAttribute.BUFFER_SIZE)
+
+    #
+    # Read the value as a string
+    #
+    def read(self):
+        length = self.__read()
+        return str(self._view[:length], 'utf-8').strip()
+
+    #
+    # Read the value as an integer
+    #
+    def read_int(self):
+        self.__read()
+        return int(self._buffer)
+
+    #
+    # Read the raw value. Returns a view of the buffer, which is only valid
+    # until the next read.
+    #
+    def read_raw(self):
+        length = self.__read()
+        return self._view[:length]
+
+    #
+    # Write a value. Attribute files replace their value on every write, but
+    # regular files, such as an emulated tree, keep the tail of a longer value
+    # unless truncated.
+    #
+    def write(self, value):
+        if not isinstance(value, bytes):
+            value = value.encode() if isinstance(value, str) else str(value).encode()
+        os.pwrite(self._fd, value, 0)
+        if self._truncate:
+            try:
+                os.ftruncate(self._fd, len(value))
+            except OSError:
+                self._truncate = False
+
+    #
+    # File descriptor, for polling
+    #
+    def fileno(self):
+        return self._fd
+
+    #
+    # Close the file
+    #
+    def close(self):
+        self._file.close()
+
+    #
+    # Use as a context manager to close when done
+    #
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    #
+    # Allocate a buffer of spaces
+    #
+    def __allocate(self, size):
+        self._buffer    = bytearray(b' ' * size)
+        self._buffers   = [self._buffer]
+        self._view      = memoryview(self._buffer)
+
+    #
+    # Read the value into the buffer, and blank out what is left of the
+    # previous value. Returns the length of the value.
+    #
+    def __read(self):
+
+        while True:
+            if BoundAttribute.HAVE_PREADV:
+                length = os.preadv(self._fd, self._buffers, 0)
+            else:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                length = os.readv(self._fd, self._buffers)
+
+            # Retry with a larger buffer if the value may not have fit
+            if length < len(self._buffer):
+                break
+            self.__allocate(len(self._buffer) * 2)
+            self._length = 0
+
+        if length < self._length:
+            self._view[length:self._length] = b' ' * (self._length - length)
+        self._length = length
+        return length
+
+
+################################################################################
+#
+# Class representing a bounded cache of open attribute files
+#
+# Keeps at most max_handles files open, closing the least recently used one
+# when another is needed. Handles are keyed by (device name, attribute), so
+# that all handles of a device can be dropped when it disappears.
+#
+class HandleCache:
+
+    #
+    # Default number of open files
+    #
+    DEFAULT_MAX_HANDLES = 64
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_handles',
+        '_max_handles',
+        '_hits',
+        '_misses',
+        '_evictions'
     ]
 
     #
     # Construction
     #
-    def __init__(self):
-        self._attrs = {}
+    def __init__(self, max_handles = DEFAULT_MAX_HANDLES):
+        if max_handles < 1:
+            raise ValueError('Invalid handle budget ' + str(max_handles))
+        self._handles       = OrderedDict()
+        self._max_handles   = max_handles
+        self._hits          = 0
+        self._misses        = 0
+        self._evictions     = 0
+
+    #
+    # Budget, and number of files currently open
+    #
+    max_handles = property(fget = lambda self : self._max_handles)
+    size        = property(fget = lambda self : len(self._handles))
+
+    #
+    # Number of lookups that found an open file, that did not, and files
+    # closed to stay within the budget
+    #
+    hits        = property(fget = lambda self : self._hits)
+    misses      = property(fget = lambda self : self._misses)
+    evictions   = property(fget = lambda self : self._evictions)
+
+    #
+    # Get an open file, or None
+    #
+    def get(self, name, attribute):
+        handle = self._handles.get((name, attribute))
+        if handle is None:
+            self._misses += 1
+            return None
+        self._hits += 1
+        self._handles.move_to_end((name, attribute))
+        return handle
+
+    #
+    # Add an open file, closing the least recently used ones over budget
+    #
+    def put(self, name, attribute, handle):
+        self._handles[(name, attribute)] = handle
+        while len(self._handles) > self._max_handles:
+            _, evicted = self._handles.popitem(last = False)
+            self._evictions += 1
+            HandleCache.__close(evicted)
+
+    #
+    # Close and drop the files of a device, or a single attribute
+    #
+    def invalidate(self, name, attribute = None):
+        keys = [(name, attribute)] if attribute is not None else [key for key in self._handles if key[0] == name]
+        for key in keys:
+            handle = self._handles.pop(key, None)
+            if handle is not None:
+                HandleCache.__close(handle)
+
+    #
+    # Close all files
+    #
+    def clear(self):
+        handles, self._handles = self._handles, OrderedDict()
+        for handle in handles.values():
+            HandleCache.__close(handle)
+
+    #
+    # Close a file, ignoring errors from devices that are gone
+    #
+    @staticmethod
+    def __close(handle):
+        try:
+            handle.close()
+        except OSError:
+            pass
+
+
+################################################################################
+#
+# Class representing a local EV3
+#
+class LocalEV3(DirectEV3):
+
+    #
+    # Errors indicating that a device is gone
+    #
+    DEVICE_GONE = (errno.ENODEV, errno.ENOENT, errno.ENXIO)
+
+    #
+    # Minimum number of seconds between rescans of a class directory for a
+    # device that was not found
+    #
+    RESCAN_INTERVAL = 1.0
+
+    #
+    # Directory holding the device classes
+    #
+    DEFAULT_ROOT = '/sys/class/'
+
+    #
+    # Attributes that notify pollers when they change, and the periods in ms
+    # at which waits read attributes with and without notification
+    #
+    NOTIFYING_ATTRIBUTES    = {'state'}
+    NOTIFY_PERIOD_MS        = 1000
+    WAIT_PERIOD_MS          = 10
+
+    #
+    # Notification is not available on all platforms
+    #
+    HAVE_POLL = hasattr(select, 'poll')
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_attrs',
+        '_root',
+        '_lock',
+        '_index',
+        '_formats',
+        '_sysfs'
+    ]
+
+    #
+    # Construction. At most max_handles attribute files are kept open. The
+    # root can point to another tree with the same layout, such as one made
+    # by SysfsTree.
+    #
+    def __init__(self, max_handles = HandleCache.DEFAULT_MAX_HANDLES, root = DEFAULT_ROOT):
+        self._attrs = HandleCache(max_handles)
+        self._root  = os.path.join(root, '')
+        self._index = {}
+
+        # Files outside of sysfs are regular files, which writes truncate and
+        # which do not notify pollers
+        self._sysfs = self._root.startswith('/sys/')
+
+        # The bin_data format and number of values of each sensor read, until
+        # its mode is set
+        self._formats = {}
+
+        # Handles are shared, and subscriptions access them from other threads
+        self._lock = Lock()
 
 
     #
     # Determine name to use for a specific device
     #
+    # Devices are looked up in an index of each class directory, mapping the
+    # parts of each device's address to its name. The index is rebuilt when
+    # the directory's mtime changes. Sysfs does not always update it when
+    # devices come and go, so names found are checked to still exist, and a
+    # device that is not found causes a rescan, at most once per interval.
+    #
     def get_name(self, class_name, device_name):
 
-        path_root  = '/sys/class/'
-        class_path = path_root + class_name
+        class_path = self._root + class_name
+
+        # Rebuild the index if the directory changed
+        mtime = os.stat(class_path).st_mtime_ns
+        index = self._index.get(class_name)
+        if index is None or index[0] != mtime:
+            index = self.__scan(class_name, mtime)
+
+        # Look up the device, rescan if it is missing or gone
+        subdir = self.__find(index[2], device_name)
+        if subdir is None or not os.path.exists(class_path + '/' + subdir):
+            if monotonic() - index[1] < LocalEV3.RESCAN_INTERVAL:
+                return None
+            index = self.__scan(class_name, mtime)
+            subdir = self.__find(index[2], device_name)
+            if subdir is None:
+                return None
+
+        return class_name + '/' + subdir
+
+    #
+    # Forget the device index, so that the next lookup rescans
+    #
+    def invalidate_names(self):
+        self._index.clear()
+
+    #
+    # Directory holding the device classes
+    #
+    root = property(fget = lambda self : self._root)
+
+    #
+    # Cache of open attribute files
+    #
+    handles = property(fget = lambda self : self._attrs)
+
+    #
+    # Close all open attribute files
+    #
+    def close(self):
+        with self._lock:
+            self._attrs.clear()
+
+    #
+    # Scan a class directory, and index its devices by address. Returns the
+    # index as (mtime, time of scan, { address part : subdir }).
+    #
+    def __scan(self, class_name, mtime):
+
+        class_path = self._root + class_name
+        addresses = {}
+        for subdir in sorted(os.listdir(class_path)):
 
-        for subdir in os.listdir(class_path):
-            
             device_path = class_path + '/' + subdir
             Trace.Verbose(device_path)
-            
-            with io.FileIO(device_path + '/address') as f:
-                address = f.read().strip().decode()
-            
-            if device_name in address:
-                return class_name + '/' + subdir
-        
-        return None
+
+            try:
+                with io.FileIO(device_path + '/address') as f:
+                    address = f.read().strip().decode()
+            except OSError:
+                continue
+
+            # Index the full address and each of its parts, first device wins
+            addresses.setdefault(address, subdir)
+            for part in address.split(':'):
+                addresses.setdefault(part, subdir)
+
+        # Close the files of devices that disappeared
+        previous = self._index.get(class_name)
+        if previous is not None:
+            with self._lock:
+                for subdir in set(previous[2].values()) - set(addresses.values()):
+                    self._attrs.invalidate(class_name + '/' + subdir)
+
+        index = (mtime, monotonic(), addresses)
+        self._index[class_name] = index
+        return index
+
+    #
+    # Find a device in an index. Falls back to matching part of an address,
+    # as in 'outA' for 'ev3-ports:outA'.
+    #
+    @staticmethod
+    def __find(addresses, device_name):
+        subdir = addresses.get(device_name)
+        if subdir is None:
+            for address, candidate in addresses.items():
+                if device_name in address:
+                    return candidate
+        return subdir
 
     #
     # Get an attribute
     #
     def get_attribute(self, name, attribute):
         
-        # Get handle to device
-        handle = self.__get_handle(name, attribute)
-        if handle == None:
-            return None
+        with self._lock:
 
-        # Read and return value
-        try:
-            return handle.read().strip().decode()
-        except Exception as ex:
-            Trace.Warning('Read failed on', name, ex)
-            return None
+            # Get handle to device
+            handle = self.__get_handle(name, attribute)
+            if handle == None:
+                return None
+
+            # Read and return value
+            try:
+                return handle.read()
+            except Exception as ex:
+                Trace.Warning('Read failed on', name, ex)
+                self.__check_gone(name, attribute, ex)
+                return None
+
+    #
+    # Get an attribute as int, without going through a string
+    #
+    def get_attribute_int(self, name, attribute):
+
+        with self._lock:
+
+            # Get handle to device
+            handle = self.__get_handle(name, attribute)
+            if handle == None:
+                return None
+
+            # Read and return value
+            try:
+                return handle.read_int()
+            except OSError as ex:
+                Trace.Warning('Read failed on', name, ex)
+                self.__check_gone(name, attribute, ex)
+                return None
+
+    #
+    # Bind an attribute, for reading or writing it repeatedly. The returned
+    # BoundAttribute keeps its own file open until closed, outside of the
+    # handle budget.
+    #
+    def bind(self, name, attribute):
+        handle = self.__open(name, attribute)
+        if handle is None:
+            raise ValueError('Cannot open ' + name + '/' + attribute)
+        return handle
+
+    #
+    # Get all values of a sensor, in a single read of its bin_data. Falls back
+    # to reading each valueN for sensors without bin_data. Returns a list of
+    # numbers, or None if the values cannot be read.
+    #
+    # The format of bin_data depends on the mode, and is read again after the
+    # mode is set through this instance. Set the mode through the same
+    # instance that reads the values.
+    #
+    def get_values(self, name):
+
+        with self._lock:
+
+            try:
+
+                # Determine the format and the number of values
+                format_count = self._formats.get(name)
+                if format_count is None:
+                    handle = self.__get_handle(name, 'num_values')
+                    if handle is None:
+                        return None
+                    count  = handle.read_int()
+                    handle = self.__get_handle(name, 'bin_data_format')
+                    format = handle.read() if handle is not None else ''
+                    format_count = self._formats[name] = (format, count)
+                format, count = format_count
+
+                # Read and decode the values
+                handle = self.__get_handle(name, 'bin_data') if format else None
+                values = unpack_values(handle.read_raw(), format, count) if handle is not None else None
+                if values is not None:
+                    return values
+
+                # Read the values one by one
+                values = []
+                for index in range(count):
+                    handle = self.__get_handle(name, 'value' + str(index))
+                    if handle is None:
+                        return None
+                    values.append(handle.read_int())
+                return values
+
+            except OSError as ex:
+                Trace.Warning('Read failed on', name, ex)
+                self.__check_gone(name, 'bin_data', ex)
+                return None
+
+    #
+    # Get multiple attributes, takes a list of (name, attribute) tuples
+    #
+    def get_attributes(self, attributes):
+        return [self.get_attribute(name, attribute) for name, attribute in attributes]
+
+    #
+    # Subscribe to an attribute, sampled from a background thread
+    #
+    def subscribe(self, name, attribute, period_ms, callback = None):
+        return PollingSubscription(self, name, attribute, period_ms, callback)
+
+    #
+    # Wait until a named condition holds, or the timeout in ms expires.
+    # Returns whether the condition holds.
+    #
+    # Attributes that notify pollers when they change are waited on with
+    # poll(), which sysfs signals as POLLPRI. The value is still read every
+    # NOTIFY_PERIOD_MS, in case a notification is missed. Other attributes,
+    # and all attributes of a tree outside of sysfs, are read every
+    # WAIT_PERIOD_MS.
+    #
+    def wait(self, name, condition, arg = None, timeout = 0):
+
+        condition = Condition(condition, arg)
+        deadline  = monotonic() + timeout / 1000 if timeout > 0 else None
+        with self.bind(name, condition.attribute) as attribute:
+
+            # Register for notification if the attribute supports it
+            poller = None
+            period = LocalEV3.WAIT_PERIOD_MS
+            if LocalEV3.HAVE_POLL and self._sysfs and condition.attribute in LocalEV3.NOTIFYING_ATTRIBUTES:
+                poller = select.poll()
+                poller.register(attribute, select.POLLPRI)
+                period = LocalEV3.NOTIFY_PERIOD_MS
+
+            while True:
+
+                # Reading the value also rearms the notification
+                try:
+                    if condition.check(attribute.read()):
+                        return True
+                except OSError as ex:
+                    Trace.Warning('Wait failed on', name, ex)
+                    return False
+
+                # Block until notified, or the next read is due
+                wait_ms = period
+                if deadline is not None:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        return False
+                    wait_ms = min(wait_ms, remaining * 1000)
+                if poller is not None:
+                    poller.poll(wait_ms)
+                else:
+                    sleep(wait_ms / 1000)
 
     #
     # Set an attribute
     #
     def set_attribute(self, name, attribute, value):
 
-        # Obtain handle to device
-        handle = self.__get_handle(name, attribute)
-        if handle == None:
-            return False
+        with self._lock:
 
-        # Convert to bytes
-        if not isinstance(value, bytes):
-            if isinstance(value, str):
-                value = value.encode()
-            else:
-                value = str(value).encode()
+            # Obtain handle to device
+            handle = self.__get_handle(name, attribute)
+            if handle == None:
+                return False
         
-        # Try to execute command
-        try:
-            handle.write(value)
-            handle.flush()
-            return True
-        except Exception as ex:
-            Trace.Warning("Write failed on", name, ex)
-            return False
+            # The mode determines the format of bin_data
+            if attribute == 'mode':
+                self._formats.pop(name, None)
+
+            # Try to execute command
+            try:
+                handle.write(value)
+                return True
+            except Exception as ex:
+                Trace.Warning("Write failed on", name, ex)
+                self.__check_gone(name, attribute, ex)
+                return False
+
+    #
+    # Drop the cached files of a device after an error that shows it is gone
+    #
+    def __check_gone(self, name, attribute, ex):
+        if isinstance(ex, OSError) and ex.errno in LocalEV3.DEVICE_GONE:
+            self._attrs.invalidate(name)
+            self._formats.pop(name, None)
+            self._index.pop(name.split('/')[0], None)
 
     #
     # Get handle to attribute
     #
     def __get_handle(self, name, attribute):
-        
-        # Build full name
-        full_name = '/sys/class/' + name + '/' + attribute
 
         # Retrieve from cached handles
-        handle = self._attrs.get(full_name)
+        handle = self._attrs.get(name, attribute)
         if handle != None:
-            handle.seek(0)
             return handle
 
+        # Open the attribute, and cache it
+        handle = self.__open(name, attribute)
+        if handle != None:
+            self._attrs.put(name, attribute, handle)
+        return handle
+
+    #
+    # Open an attribute
+    #
+    def __open(self, name, attribute):
+
+        # Build full name
+        full_name = self._root + name + '/' + attribute
+
         # Inspect the device
         try:
             mode = stat.S_IMODE(os.stat(full_name)[stat.ST_MODE])
@@ -123,11 +659,7 @@ class LocalEV3:
 
         # Open the device
         try:
-            handle = io.FileIO(full_name, mode_str)
+            return BoundAttribute(io.FileIO(full_name, mode_str), not self._sysfs)
         except:
             Trace.Warning("Cannot open", full_name)
             return None
-
-        # Cache the handle and return it
-        self._attrs[full_name] = handle
-        return handle
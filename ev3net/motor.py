@@ -1,15 +1,10 @@
-from device import Device
+from device import Device, await_value
+from condition import Condition
+from schema import EnumAttribute, IntAttribute, ListAttribute
+import asyncio
 import time
 
 
-################################################################################
-#
-# Current time in ms
-#
-def __time_ms():
-    return int(round(time.time() * 1000))
-
-
 ################################################################################
 #
 # Motor class
@@ -50,6 +45,11 @@ class Motor(Device):
     #
     STATES                  = [STATE_RUNNING, STATE_RAMPING, STATE_HOLDING, STATE_STALLED]
 
+    #
+    # State sampling period while waiting, in ms
+    #
+    WAIT_PERIOD_MS          = 10
+
     #
     # Construction
     #
@@ -57,101 +57,149 @@ class Motor(Device):
         super(Motor, self).__init__(Motor.CLASS_NAME, device_name, driver_name, ev3_instance)
 
     #
-    # count per rotation
+    # Polarity and stop action values
     #
-    count_per_rot = property(fget = lambda self : self.get_cached_attribute('count_per_rot'))
+    POLARITIES              = ('normal', 'inversed')
+    STOP_ACTIONS            = ('coast', 'brake', 'hold')
 
     #
-    # duty_cycle
+    # Attributes
     #
-    duty_cycle = property(fget = lambda self : self.get_attribute('duty_cycle'))
+    command         = EnumAttribute(COMMANDS, readable = False, writable = True)
+    count_per_rot   = IntAttribute(static = True)
+    duty_cycle      = IntAttribute()
+    duty_cycle_sp   = IntAttribute(writable = True)
+    polarity        = EnumAttribute(POLARITIES, writable = True)
+    position        = IntAttribute(writable = True)
+    position_sp     = IntAttribute(writable = True)
+    speed           = IntAttribute()
+    speed_sp        = IntAttribute(writable = True)
+    state           = ListAttribute()
+    stop_action     = EnumAttribute(STOP_ACTIONS, writable = True)
+    stop_actions    = ListAttribute(static = True)
+    time_sp         = IntAttribute(writable = True)
 
     #
-    # duty_cycle_sp
+    # Run forever
     #
-    duty_cycle_sp = property(
-        fget = lambda self : self.get_attribute('duty_cycle_sp'),
-        fset = lambda self, value : self.set_attribute('duty_cycle_sp', value))
-
+    def run_forever(self, speed, wait = False, at = None):
+        if at is not None:
+            self.set_attributes_at(at, [('speed_sp', speed), ('command', 'run-forever')])
+        else:
+            with self.batch():
+                self.speed_sp = speed
+                self.command = 'run-forever'
+        if wait:
+            self.wait()
+    
     #
-    # polarity
+    # Run forever, for asyncio instances
     #
-    polarity = property(
-        fget = lambda self : self.get_attribute('polarity'),
-        fset = lambda self, value : self.set_attribute('polarity', value))
+    async def run_forever_async(self, speed, wait = False):
+        await self.set_attributes_async([('speed_sp', speed), ('command', 'run-forever')])
+        if wait:
+            await self.wait_async()
 
     #
-    # speed
+    # Run for a defined time
     #
-    speed = property(fget = lambda self : self.get_attribute('speed'))
+    def run_timed(self, speed, time, wait = False, at = None):
+        if at is not None:
+            self.set_attributes_at(at, [('speed_sp', speed), ('time_sp', time), ('command', 'run-timed')])
+        else:
+            with self.batch():
+                self.speed_sp = speed
+                self.time_sp = time
+                self.command = 'run-timed'
+        if wait:
+            self.wait()
 
     #
-    # speed_sp
+    # Run for a defined time, for asyncio instances
     #
-    speed_sp = property(
-        fget = lambda self : self.get_attribute('speed_sp'),
-        fset = lambda self, value : self.set_attribute('speed_sp', value))
+    async def run_timed_async(self, speed, time, wait = False):
+        await self.set_attributes_async([('speed_sp', speed), ('time_sp', time), ('command', 'run-timed')])
+        if wait:
+            await self.wait_async()
 
     #
-    # state
+    # Stop the motor
     #
-    state = property(fget = lambda self : self.get_attribute('state'))
+    def stop(self):
+        self.command = 'stop'
 
     #
-    # Time
+    # Stop the motor, for asyncio instances
     #
-    time_sp = property(
-        fget = lambda self : self.get_attribute('time_sp'),
-        fset = lambda self, value : self.set_attribute('time_sp', value))
+    async def stop_async(self):
+        await self.set_attribute_async('command', 'stop')
 
     #
-    # Run forever
-    #
-    def run_forever(self, speed, wait = False):
-        self.speed_sp = speed
-        self.command = 'run-forever'
-        if wait:
-            self.wait()
-    
+    # Wait until a condition holds, or the timeout in ms expires. Returns
+    # whether the condition was met.
     #
-    # Run for a defined time
+    # The condition is either a callable taking the motor state, or the name
+    # of a Condition, in which case position is the argument. Instances that
+    # can wait on the brick itself do so for named conditions.
     #
-    def run_timed(self, speed, time, wait = False):
-        self.speed_sp = speed
-        self.time_sp = time
-        self.command = 'run-timed'
-        if wait:
-            self.wait()
+    def wait(self, cond = Condition.STOPPED, timeout = 0, position = None):
 
-    #
-    # Stop the motor
-    #
-    def stop(self):
-        self.command = 'stop'
+        # Wait on the brick if possible. Callables get the decoded state, as
+        # read from Motor.state.
+        attribute = 'state'
+        if not callable(cond):
+            condition = Condition(cond, position)
+            wait = getattr(self._ev3, 'wait', None)
+            if wait is not None:
+                return wait(self._name, cond, position, timeout)
+            attribute = condition.attribute
+            check     = condition.check
+        else:
+            check = lambda value : cond(Motor.state.decode(value))
+
+        # Determine deadline
+        deadline = time.monotonic() + timeout / 1000 if timeout > 0 else None
+
+        # Follow attribute changes until the condition holds
+        with self.subscribe(attribute, Motor.WAIT_PERIOD_MS) as subscription:
+            while True:
+
+                # Wait for the next value, but never longer than is remaining
+                remaining = None if deadline is None else max(0, deadline - time.monotonic())
+                result, value = subscription.next(remaining)
+                if not result:
+                    return False
+
+                # Check condition
+                if check(value):
+                    return True
 
     #
-    # Wait
+    # Wait until a condition holds, or the timeout in ms expires, for asyncio
+    # instances. Takes the same arguments as wait(), but polls the state for
+    # callable conditions.
     #
-    def wait(self, cond = lambda state : state != 'running', timeout = 0):
-        
-        # Take start time
-        start_time = __time_ms() if timeout > 0 else 0
+    async def wait_async(self, cond = Condition.STOPPED, timeout = 0, position = None):
 
-        # Wait loop
-        while True:
+        # Wait on the brick if possible
+        attribute = 'state'
+        if not callable(cond):
+            condition = Condition(cond, position)
+            wait = getattr(self._ev3, 'wait', None)
+            if wait is not None:
+                return await await_value(wait(self._name, cond, position, timeout))
+            attribute = condition.attribute
+            check     = condition.check
+        else:
+            check = lambda value : cond(Motor.state.decode(value))
 
-            # Timeout has elapsed
-            if timeout > 0 and __time_ms() - start_time >= timeout:
+        # Poll until the condition holds or the deadline passes
+        deadline = time.monotonic() + timeout / 1000 if timeout > 0 else None
+        while not check(await self.get_attribute_async(attribute)):
+            if deadline is not None and time.monotonic() >= deadline:
                 return False
-
-            # Check condition
-            if cond(self.state):
-                return True
-
-            # Sleep a bit, but never longer than is remaining
-            sleep_time = 10 if timeout == 0 else min(10, __time_ms() - start_time)            
-            if sleep_time > 0:
-                time.sleep(0.0001 * sleep_time)
+            await asyncio.sleep(Motor.WAIT_PERIOD_MS / 1000)
+        return True
 
 
 ################################################################################
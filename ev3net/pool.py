@@ -0,0 +1,316 @@
+from contextlib import contextmanager
+from threading import Condition, Lock, local
+from time import monotonic
+from clock import Clock
+from connection import Connection
+from history import History
+from protocol import BinaryCodec
+from remote import RemoteEV3
+from trace import Trace
+
+################################################################################
+#
+# Class representing a pool of connections to a single remote EV3
+#
+# A pool can be used wherever a RemoteEV3 can. Each thread is bound to one of
+# the pool's connections, assigned round robin, so that threads spread their
+# requests over the connections while the requests of any single thread stay
+# in order. Connections can also be checked out for exclusive use, after
+# which threads bound to them move to another connection.
+#
+# The server must run in asyncio mode to serve the connections concurrently.
+# A server that serves one client at a time does not answer a second
+# connection, which then fails with a ConnectionError.
+#
+class RemotePool:
+
+    #
+    # Default number of connections
+    #
+    DEFAULT_SIZE = 4
+
+    #
+    # Connections idle for longer than this many seconds are pinged before
+    # being handed out
+    #
+    HEALTH_CHECK_IDLE = 5.0
+
+    #
+    # Seconds to wait for the server to answer a new connection
+    #
+    CONNECT_TIMEOUT = 5.0
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_remote_ip',
+        '_remote_port',
+        '_protocol',
+        '_connections',
+        '_connecting',
+        '_checked_out',
+        '_checkouts',
+        '_last_used',
+        '_next_index',
+        '_cond',
+        '_local',
+        '_single_client'
+    ]
+
+    #
+    # Construction. Connections are established when first used.
+    #
+    def __init__(self, remote_ip, remote_port = Connection.DEFAULT_PORT, size = DEFAULT_SIZE, protocol = BinaryCodec.NAME):
+        if size < 1:
+            raise ValueError('Invalid pool size ' + str(size))
+        self._remote_ip     = remote_ip
+        self._remote_port   = remote_port
+        self._protocol      = protocol
+        self._connections   = [None] * size
+        self._connecting    = [Lock() for _ in range(size)]
+        self._checked_out   = [False] * size
+        self._checkouts     = {}
+        self._last_used     = [0.0] * size
+        self._next_index    = 0
+        self._cond          = Condition()
+        self._local         = local()
+        self._single_client = False
+
+    #
+    # Number of connections
+    #
+    size = property(fget = lambda self : len(self._connections))
+
+    #
+    # Check out a connection for exclusive use, waiting at most timeout
+    # seconds for one to become available. Returns a RemoteEV3.
+    #
+    def checkout(self, timeout = None):
+
+        with self._cond:
+            if not self._cond.wait_for(lambda : not all(self._checked_out), timeout):
+                raise TimeoutError('No connection available to ' + self.__key())
+            index = self._checked_out.index(False)
+            self._checked_out[index] = True
+
+        try:
+            ev3 = self.__get_connection(index)
+        except:
+            self.__release(index)
+            raise
+
+        # Remember the slot, the connection may be replaced before checkin
+        with self._cond:
+            self._checkouts[ev3] = index
+        return ev3
+
+    #
+    # Return a checked out connection to the pool
+    #
+    def checkin(self, ev3):
+        with self._cond:
+            index = self._checkouts.pop(ev3, None)
+        if index is None:
+            raise ValueError('Connection was not checked out of this pool')
+        self.__release(index)
+
+    #
+    # Check out a connection for the duration of a with statement
+    #
+    @contextmanager
+    def connection(self, timeout = None):
+        ev3 = self.checkout(timeout)
+        try:
+            yield ev3
+        finally:
+            self.checkin(ev3)
+
+    #
+    # Ping all connections, replacing the ones that fail. Returns the number
+    # of healthy connections.
+    #
+    def check(self):
+        healthy = 0
+        for index in range(len(self._connections)):
+            try:
+                self.__get_connection(index, force_check = True)
+                healthy += 1
+            except Exception as ex:
+                Trace.Warning('Connection to', self.__key(), 'failed', ex)
+        return healthy
+
+    #
+    # Close all connections
+    #
+    def close(self):
+        with self._cond:
+            connections, self._connections = self._connections, [None] * len(self._connections)
+        for ev3 in connections:
+            if ev3 is not None:
+                ev3.close()
+
+    #
+    # EV3 instance interface, using the connection bound to the current thread
+    #
+    def get_name(self, class_name, device_name):
+        return self.__thread_connection().get_name(class_name, device_name)
+
+    def get_name_future(self, class_name, device_name):
+        return self.__thread_connection().get_name_future(class_name, device_name)
+
+    def get_attribute(self, name, attribute):
+        return self.__thread_connection().get_attribute(name, attribute)
+
+    def get_attribute_future(self, name, attribute):
+        return self.__thread_connection().get_attribute_future(name, attribute)
+
+    def get_attribute_int(self, name, attribute):
+        return self.__thread_connection().get_attribute_int(name, attribute)
+
+    def get_attribute_int_future(self, name, attribute):
+        return self.__thread_connection().get_attribute_int_future(name, attribute)
+
+    def get_attributes(self, attributes):
+        return self.__thread_connection().get_attributes(attributes)
+
+    def get_attributes_future(self, attributes):
+        return self.__thread_connection().get_attributes_future(attributes)
+
+    def get_values(self, name):
+        return self.__thread_connection().get_values(name)
+
+    def get_values_future(self, name):
+        return self.__thread_connection().get_values_future(name)
+
+    def set_attribute(self, name, attribute, value):
+        return self.__thread_connection().set_attribute(name, attribute, value)
+
+    def set_attributes(self, sets):
+        return self.__thread_connection().set_attributes(sets)
+
+    def batch(self):
+        return self.__thread_connection().batch()
+
+    def wait(self, name, condition, arg = None, timeout = 0):
+        return self.__thread_connection().wait(name, condition, arg, timeout)
+
+    def wait_future(self, name, condition, arg = None, timeout = 0):
+        return self.__thread_connection().wait_future(name, condition, arg, timeout)
+
+    def subscribe(self, name, attribute, period_ms, callback = None):
+        return self.__thread_connection().subscribe(name, attribute, period_ms, callback)
+
+    def subscribe_telemetry(self, name, attribute, period_ms, callback = None):
+        return self.__thread_connection().subscribe_telemetry(name, attribute, period_ms, callback)
+
+    def sample(self, name, attribute, period_ms, capacity = History.DEFAULT_CAPACITY):
+        return self.__thread_connection().sample(name, attribute, period_ms, capacity)
+
+    def ping(self):
+        return self.__thread_connection().ping()
+
+    def share_attribute(self, name, attribute, period_ms = 10):
+        return self.__thread_connection().share_attribute(name, attribute, period_ms)
+
+    def sync_clock(self, samples = Clock.DEFAULT_SAMPLES):
+        return self.__thread_connection().sync_clock(samples)
+
+    def set_attributes_at(self, timestamp, sets):
+        return self.__thread_connection().set_attributes_at(timestamp, sets)
+
+    #
+    # Get the connection bound to the current thread
+    #
+    def __thread_connection(self):
+
+        # Bind the thread to a connection that is not checked out, the first
+        # time and whenever its connection was checked out since. Waits for
+        # a checkin if all of them are checked out.
+        index = getattr(self._local, 'index', None)
+        if index is None or self._checked_out[index]:
+            with self._cond:
+                self._cond.wait_for(lambda : not all(self._checked_out))
+                size = len(self._connections)
+                while self._checked_out[self._next_index]:
+                    self._next_index = (self._next_index + 1) % size
+                index = self._local.index = self._next_index
+                self._next_index = (self._next_index + 1) % size
+
+        return self.__get_connection(index)
+
+    #
+    # Get a healthy connection by index, connecting or reconnecting as needed
+    #
+    def __get_connection(self, index, force_check = False):
+
+        now = monotonic()
+        ev3 = self._connections[index]
+
+        # Ping connections that have been idle for a while
+        if ev3 is not None and not ev3.closed and (force_check or now - self._last_used[index] > RemotePool.HEALTH_CHECK_IDLE):
+            try:
+                ev3.ping()
+            except Exception:
+                ev3.close()
+
+        # Replace closed connections. Connecting waits for the server, so it
+        # holds only the lock of the connection, and threads that need the
+        # same connection wait for it to be established.
+        if ev3 is None or ev3.closed:
+            with self._connecting[index]:
+                ev3 = self._connections[index]
+                if ev3 is None or ev3.closed:
+                    ev3 = self.__connect()
+                    with self._cond:
+                        self._connections[index] = ev3
+
+        self._last_used[index] = now
+        return ev3
+
+    #
+    # Open a new connection. A server that does not answer it while another
+    # connection is open serves one client at a time, after which new
+    # connections fail right away for as long as another one is open.
+    #
+    def __connect(self):
+
+        if self._single_client and self.__any_open():
+            raise ConnectionError(self.__single_client_message())
+
+        try:
+            ev3 = RemoteEV3(self._remote_ip, self._remote_port, self._protocol, timeout = RemotePool.CONNECT_TIMEOUT)
+        except TimeoutError:
+            if not self.__any_open():
+                raise
+            self._single_client = True
+            raise ConnectionError(self.__single_client_message())
+
+        self._single_client = False
+        return ev3
+
+    #
+    # Whether any of the connections is open
+    #
+    def __any_open(self):
+        return any(ev3 is not None and not ev3.closed for ev3 in self._connections)
+
+    #
+    # Error message for a server that serves one client at a time
+    #
+    def __single_client_message(self):
+        return 'Server at ' + self.__key() + ' does not answer a second connection, pools need a server running with --mode async'
+
+    #
+    # Release a checked out connection
+    #
+    def __release(self, index):
+        with self._cond:
+            self._checked_out[index] = False
+            self._cond.notify_all()
+
+    #
+    # Pool key, for messages
+    #
+    def __key(self):
+        return self._remote_ip + ':' + str(self._remote_port)
@@ -0,0 +1,374 @@
+#
+# Message encoding for the ev3 network interface
+#
+# A message consists of a request id, an operation and a list of arguments.
+# Responses use the 'ret' operation and echo the id of the request. Two
+# encodings exist: the original colon-delimited text format, and a compact
+# binary format that a client can negotiate with the 'proto' message.
+#
+import struct
+
+
+################################################################################
+#
+# Error raised by the codecs for a message that cannot be decoded, for
+# instance one sent by a client using another version of the protocol. Only
+# that message is lost, the next one can be decoded as usual.
+#
+class DecodeError(ValueError):
+    pass
+
+
+################################################################################
+#
+# Operations. The position in this list is the binary opcode, so new
+# operations must only ever be appended.
+#
+OPERATIONS = [
+    'ret',
+    'proto',
+    'name',
+    'get',
+    'mget',
+    'set',
+    'push',
+    'sub',
+    'unsub',
+    'wait',
+    'ping',
+    'at',
+    'tsub',
+    'mset',
+    'share',
+    'resume',
+    'end',
+    'vals',
+    'hsub',
+    'hist',
+    'geti'
+]
+
+################################################################################
+#
+# Operations that carry response values rather than request arguments
+#
+RESPONSES = ('ret', 'push')
+
+################################################################################
+#
+# Well-known strings, sent as a single byte by the binary codec. The position
+# in this list is the symbol code, so new symbols must only ever be appended.
+#
+SYMBOLS = [
+
+    # Device classes and device name prefixes
+    'tacho-motor', 'lego-sensor', 'motor', 'sensor',
+
+    # Ports
+    'outA', 'outB', 'outC', 'outD', 'in1', 'in2', 'in3', 'in4',
+
+    # Generic attributes
+    'address', 'command', 'commands', 'driver_name',
+
+    # Motor attributes
+    'count_per_rot', 'duty_cycle', 'duty_cycle_sp', 'polarity', 'position', 'position_sp',
+    'speed', 'speed_sp', 'state', 'stop_action', 'stop_actions', 'time_sp',
+
+    # Sensor attributes
+    'decimals', 'mode', 'modes', 'num_values', 'units', 'bin_data', 'bin_data_format',
+    'value0', 'value1', 'value2', 'value3', 'value4', 'value5', 'value6', 'value7',
+
+    # Motor commands and states
+    'run-forever', 'run-to-abs-pos', 'run-to-rel-pos', 'run-timed', 'run-direct', 'stop', 'reset',
+    'running', 'ramping', 'holding', 'stalled', '',
+
+    # Driver names
+    'lego-ev3-m-motor', 'lego-ev3-l-motor', 'lego-ev3-color', 'lego-ev3-gyro', 'lego-ev3-touch', 'lego-nxt-us',
+
+    # Protocol names
+    'text', 'binary',
+
+    # Wait conditions
+    'stopped'
+]
+
+
+################################################################################
+#
+# Colon-delimited text encoding
+#
+# Request arguments are separated by ':', so they cannot contain one. Response
+# and push values are separated by NUL instead, because attribute values such
+# as 'address' do contain colons. All values are sent and received as strings.
+#
+class TextCodec:
+
+    #
+    # Protocol name
+    #
+    NAME = 'text'
+
+    #
+    # Encode a message
+    #
+    def encode(self, msg_id, op, args):
+        separator = '\0' if op in RESPONSES else ':'
+        values = separator.join(map(lambda v : str(v).strip(), args))
+        return (str(msg_id) + ':' + op + ':' + values).encode()
+
+    #
+    # Decode a message, returns (msg_id, op, args). Raises DecodeError if the
+    # message is malformed.
+    #
+    def decode(self, data):
+        try:
+            msg_id, op, values = str(data, 'utf-8').split(':', 2)
+            msg_id = int(msg_id)
+        except ValueError as ex:
+            raise DecodeError('Invalid text message ' + repr(bytes(data[:64]))) from ex
+        separator = '\0' if op in RESPONSES else ':'
+        return msg_id, op, values.split(separator)
+
+
+################################################################################
+#
+# Compact binary encoding
+#
+# A message is a 32 bit request id and an 8 bit opcode, followed by the
+# arguments. Each argument is a one byte type tag followed by its value:
+# integers and floats are encoded natively, well-known strings and device
+# names are encoded as symbol codes, and other strings are length-prefixed
+# UTF-8. All integers are little endian.
+#
+class BinaryCodec:
+
+    #
+    # Protocol name
+    #
+    NAME = 'binary'
+
+    #
+    # Argument type tags
+    #
+    TAG_NONE    = 0
+    TAG_INT32   = 1
+    TAG_INT64   = 2
+    TAG_FLOAT   = 3
+    TAG_STR     = 4
+    TAG_SYMBOL  = 5
+    TAG_DEVICE  = 6
+    TAG_BYTES   = 7
+
+    #
+    # Fixed-size parts
+    #
+    HEADER  = struct.Struct('<IB')
+    TAG     = struct.Struct('<B')
+    INT32   = struct.Struct('<Bi')
+    INT64   = struct.Struct('<Bq')
+    FLOAT   = struct.Struct('<Bd')
+    LENGTH  = struct.Struct('<BI')
+    SYMBOL  = struct.Struct('<BB')
+    DEVICE  = struct.Struct('<BBBH')
+
+    #
+    # Lookup tables
+    #
+    OPCODES      = { op : code for code, op in enumerate(OPERATIONS) }
+    SYMBOL_CODES = { symbol : code for code, symbol in enumerate(SYMBOLS) }
+
+    #
+    # Maximum number of cached device name encodings
+    #
+    MAX_DEVICES = 256
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_encoded',
+        '_devices'
+    ]
+
+    #
+    # Construction
+    #
+    def __init__(self):
+
+        # Encoded strings, prefilled with the symbols. Device names are added
+        # as they are first seen.
+        self._encoded = { symbol : BinaryCodec.SYMBOL.pack(BinaryCodec.TAG_SYMBOL, code) for symbol, code in BinaryCodec.SYMBOL_CODES.items() }
+
+        # Decoded device names, by (tag, class, prefix, index)
+        self._devices = {}
+
+    #
+    # Encode a message
+    #
+    def encode(self, msg_id, op, args):
+        encoded = self._encoded
+        parts = [BinaryCodec.HEADER.pack(msg_id, BinaryCodec.OPCODES[op])]
+        for arg in args:
+
+            # Strings are the most common, and only device names hold a
+            # slash, so encode the others inline
+            if arg.__class__ is str:
+                value = encoded.get(arg)
+                if value is None:
+                    if '/' in arg:
+                        value = self.encode_value(arg)
+                    else:
+                        value = arg.encode()
+                        value = BinaryCodec.LENGTH.pack(BinaryCodec.TAG_STR, len(value)) + value
+                parts.append(value)
+            else:
+                parts.append(self.encode_value(arg))
+
+        return b''.join(parts)
+
+    #
+    # Encode a single value
+    #
+    def encode_value(self, value):
+
+        # None
+        if value is None:
+            return BinaryCodec.TAG.pack(BinaryCodec.TAG_NONE)
+
+        # Strings, try symbols and device names first
+        if isinstance(value, str):
+            encoded = self._encoded.get(value)
+            if encoded is not None:
+                return encoded
+            encoded = self.encode_device(value) if '/' in value else None
+            if encoded is not None:
+                if len(self._encoded) < len(SYMBOLS) + BinaryCodec.MAX_DEVICES:
+                    self._encoded[value] = encoded
+                return encoded
+            value = value.encode()
+            return BinaryCodec.LENGTH.pack(BinaryCodec.TAG_STR, len(value)) + value
+
+        # Integers
+        if isinstance(value, int):
+            if -0x80000000 <= value <= 0x7fffffff:
+                return BinaryCodec.INT32.pack(BinaryCodec.TAG_INT32, value)
+            return BinaryCodec.INT64.pack(BinaryCodec.TAG_INT64, value)
+
+        # Floats
+        if isinstance(value, float):
+            return BinaryCodec.FLOAT.pack(BinaryCodec.TAG_FLOAT, value)
+
+        # Raw bytes
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return BinaryCodec.LENGTH.pack(BinaryCodec.TAG_BYTES, len(value)) + bytes(value)
+
+        # Anything else is sent as its string representation
+        return self.encode_value(str(value))
+
+    #
+    # Encode a device name like 'tacho-motor/motor3' as class, prefix and
+    # index codes. Returns None if the name does not have that form.
+    #
+    def encode_device(self, value):
+
+        class_name, slash, subdir = value.partition('/')
+        if not slash:
+            return None
+
+        prefix = subdir.rstrip('0123456789')
+        index  = subdir[len(prefix):]
+        if not index or len(index) > 4 or index != str(int(index)):
+            return None
+
+        class_code  = BinaryCodec.SYMBOL_CODES.get(class_name)
+        prefix_code = BinaryCodec.SYMBOL_CODES.get(prefix)
+        if class_code is None or prefix_code is None:
+            return None
+
+        return BinaryCodec.DEVICE.pack(BinaryCodec.TAG_DEVICE, class_code, prefix_code, int(index))
+
+    #
+    # Decode a message, returns (msg_id, op, args). Raises DecodeError if the
+    # message is truncated, or holds an opcode, symbol or type tag that this
+    # version does not know, as sent by a newer peer.
+    #
+    def decode(self, data):
+
+        try:
+            msg_id, opcode = BinaryCodec.HEADER.unpack_from(data, 0)
+            op     = OPERATIONS[opcode]
+            offset = BinaryCodec.HEADER.size
+
+            # Symbols and strings are by far the most common, so decode those inline
+            args = []
+            end  = len(data)
+            while offset < end:
+                tag = data[offset]
+                if tag == BinaryCodec.TAG_SYMBOL:
+                    args.append(SYMBOLS[data[offset + 1]])
+                    offset += 2
+                elif tag == BinaryCodec.TAG_STR:
+                    start  = offset + BinaryCodec.LENGTH.size
+                    offset = start + BinaryCodec.LENGTH.unpack_from(data, offset)[1]
+                    args.append(str(data[start:offset], 'utf-8'))
+                else:
+                    value, offset = self.decode_value(data, offset)
+                    args.append(value)
+
+        except (IndexError, ValueError, struct.error) as ex:
+            raise DecodeError('Invalid binary message ' + repr(bytes(data[:64]))) from ex
+
+        # The last value must end where the message does
+        if offset > end:
+            raise DecodeError('Truncated binary message ' + repr(bytes(data[:64])))
+
+        return msg_id, op, args
+
+    #
+    # Decode a single value at an offset, returns (value, new offset)
+    #
+    def decode_value(self, data, offset):
+
+        tag = data[offset]
+
+        if tag == BinaryCodec.TAG_SYMBOL:
+            return SYMBOLS[data[offset + 1]], offset + 2
+
+        if tag == BinaryCodec.TAG_INT32:
+            return BinaryCodec.INT32.unpack_from(data, offset)[1], offset + BinaryCodec.INT32.size
+
+        if tag == BinaryCodec.TAG_STR or tag == BinaryCodec.TAG_BYTES:
+            length = BinaryCodec.LENGTH.unpack_from(data, offset)[1]
+            start  = offset + BinaryCodec.LENGTH.size
+            value  = bytes(data[start:start + length])
+            return value.decode() if tag == BinaryCodec.TAG_STR else value, start + length
+
+        if tag == BinaryCodec.TAG_DEVICE:
+            key  = BinaryCodec.DEVICE.unpack_from(data, offset)
+            name = self._devices.get(key)
+            if name is None:
+                name = SYMBOLS[key[1]] + '/' + SYMBOLS[key[2]] + str(key[3])
+                if len(self._devices) < BinaryCodec.MAX_DEVICES:
+                    self._devices[key] = name
+            return name, offset + BinaryCodec.DEVICE.size
+
+        if tag == BinaryCodec.TAG_NONE:
+            return None, offset + 1
+
+        if tag == BinaryCodec.TAG_INT64:
+            return BinaryCodec.INT64.unpack_from(data, offset)[1], offset + BinaryCodec.INT64.size
+
+        if tag == BinaryCodec.TAG_FLOAT:
+            return BinaryCodec.FLOAT.unpack_from(data, offset)[1], offset + BinaryCodec.FLOAT.size
+
+        raise DecodeError('Invalid type tag ' + str(tag))
+
+
+################################################################################
+#
+# Codecs by protocol name
+#
+CODECS = {
+    TextCodec.NAME      : TextCodec,
+    BinaryCodec.NAME    : BinaryCodec
+}
@@ -0,0 +1,120 @@
+from time import monotonic
+
+################################################################################
+#
+# Class representing a cache of recent attribute reads
+#
+# Each attribute can be given a maximum age. A read of such an attribute is
+# answered from the cache if the cached value is younger than that, and goes
+# to the brick otherwise. Attributes without a maximum age are not cached.
+# Hits and misses are counted per attribute, to help choose the ages.
+#
+class ReadCache:
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_max_ages',
+        '_entries',
+        '_stats',
+        '_invalidated'
+    ]
+
+    #
+    # Construction, takes a dictionary of maximum ages in ms by attribute
+    #
+    def __init__(self, max_ages_ms = None):
+        self._max_ages  = {}
+        self._entries   = {}
+        self._stats     = {}
+
+        # Time of the last invalidation, reads started before it are not
+        # stored because they may return the value from before a set
+        self._invalidated = 0.0
+
+        for attribute, max_age_ms in (max_ages_ms or {}).items():
+            self.set_max_age(attribute, max_age_ms)
+
+    #
+    # Set the maximum age of an attribute in ms, 0 or None to stop caching it
+    #
+    def set_max_age(self, attribute, max_age_ms):
+        self._entries.pop(attribute, None)
+        if max_age_ms:
+            self._max_ages[attribute] = max_age_ms / 1000
+        else:
+            self._max_ages.pop(attribute, None)
+
+    #
+    # Maximum age of an attribute in ms, or None if it is not cached
+    #
+    def get_max_age(self, attribute):
+        max_age = self._max_ages.get(attribute)
+        return None if max_age is None else max_age * 1000
+
+    #
+    # Whether an attribute is cached
+    #
+    def caches(self, attribute):
+        return attribute in self._max_ages
+
+    #
+    # Look up an attribute. Returns (True, value, None) if the cached value is
+    # recent enough, otherwise (False, None, timestamp), where the timestamp
+    # is passed to store() with the value read, or is None for attributes
+    # that are not cached.
+    #
+    def lookup(self, attribute):
+
+        max_age = self._max_ages.get(attribute)
+        if max_age is None:
+            return False, None, None
+
+        stats = self._stats.get(attribute)
+        if stats is None:
+            stats = self._stats[attribute] = [0, 0]
+        now = monotonic()
+        entry = self._entries.get(attribute)
+        if entry is not None and now - entry[1] <= max_age:
+            stats[0] += 1
+            return True, entry[0], None
+        stats[1] += 1
+        return False, None, now
+
+    #
+    # Store a value read at a time returned by lookup
+    #
+    def store(self, attribute, value, timestamp):
+        if timestamp is not None and timestamp > self._invalidated and value is not None:
+            self._entries[attribute] = (value, timestamp)
+
+    #
+    # Drop the cached value of an attribute, or of all attributes
+    #
+    def invalidate(self, attribute = None):
+        self._invalidated = monotonic()
+        if attribute is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(attribute, None)
+
+    #
+    # Hits and misses by attribute, as { attribute : (hits, misses) }
+    #
+    stats = property(fget = lambda self : { attribute : tuple(stats) for attribute, stats in self._stats.items() })
+
+    #
+    # Fraction of reads of cached attributes served from the cache
+    #
+    def hit_rate(self, attribute = None):
+        stats = list(self._stats.values()) if attribute is None else [self._stats.get(attribute, (0, 0))]
+        hits  = sum(s[0] for s in stats)
+        total = hits + sum(s[1] for s in stats)
+        return hits / total if total else 0.0
+
+    #
+    # Reset the statistics
+    #
+    def reset_stats(self):
+        self._stats.clear()
@@ -1,64 +1,712 @@
+from concurrent.futures import Future
+from contextlib import contextmanager
+from threading import Lock, Thread, local
+from time import monotonic, sleep
+from bindata import parse_value
+from clock import Clock
+from condition import Condition
 from connection import Connection
+from history import History
+from protocol import CODECS, BinaryCodec, DecodeError, TextCodec
+from shm import HAVE_SHARED_MEMORY, SharedTable
+from subscription import Subscription
+from telemetry import TelemetryReceiver
+from trace import Trace
 
 ################################################################################
 #
 # Class representing a remote EV3
 #
-# TODO why the strip everywhere?
+# Requests are pipelined: every request carries an id, which the server echoes
+# in its response. A background reader thread matches responses to requests
+# and resolves the futures handed out to callers, so that many requests can be
+# in flight at the same time, from any number of threads.
+#
+# When the connection drops, the reader thread reconnects and resumes the
+# session using the token the server handed out, so that the server keeps the
+# session's jobs and does not stop its motors. Requests that were not answered
+# yet, and messages sent while reconnecting, are sent again once resumed.
 #
 class RemoteEV3:
 
+    #
+    # Seconds to keep trying to reconnect before giving up. Should not exceed
+    # the server's grace period.
+    #
+    RECONNECT_TIMEOUT = 10.0
+
     #
     # Members
     #
     __slots__ = [
-        '_connection'
+        '_connection',
+        '_send_lock',
+        '_pending',
+        '_subscriptions',
+        '_next_id',
+        '_reader',
+        '_closed',
+        '_clock',
+        '_telemetry',
+        '_cork',
+        '_shared',
+        '_shared_table',
+        '_address',
+        '_protocol',
+        '_token',
+        '_reconnect',
+        '_closing',
+        '_backlog',
+        '_reconnects'
     ]
 
 
     #
-    # Construction
+    # Construction. Connects through the Unix domain socket instead of TCP if
+    # a path is given. Pass reconnect = False to fail outstanding requests
+    # when the connection drops instead. The timeout limits how many seconds
+    # to wait for the server to answer when connecting, a server that does
+    # not raises TimeoutError.
+    #
+    def __init__(self, remote_ip, remote_port=Connection.DEFAULT_PORT, protocol = BinaryCodec.NAME, unix_path = None, reconnect = True, timeout = None):
+        self._send_lock = Lock()
+        self._pending   = {}
+        self._subscriptions = {}
+        self._next_id   = 0
+        self._closed    = False
+        self._clock     = Clock()
+        self._telemetry = None
+        self._cork      = local()
+        self._shared    = {}
+        self._shared_table = None
+        self._address   = (remote_ip, remote_port, unix_path)
+        self._protocol  = protocol
+        self._token     = ''
+        self._reconnect = reconnect
+        self._closing   = False
+        self._backlog   = None
+        self._reconnects = 0
+        self._connection, _ = self.__connect(monotonic() + timeout if timeout is not None else None)
+
+        # Start the response reader
+        self._reader = Thread(target = self.__read_responses, daemon = True)
+        self._reader.start()
+
+    #
+    # Whether the connection has been closed
+    #
+    closed = property(fget = lambda self : self._closed)
+
+    #
+    # Number of times the connection was re-established
+    #
+    reconnects = property(fget = lambda self : self._reconnects)
+
+    #
+    # Check that the server responds. Returns the server's clock, as seconds
+    # since the epoch.
+    #
+    def ping(self):
+        return self.ping_future().result()
+
+    #
+    # Check that the server responds, returns a future
+    #
+    def ping_future(self):
+        return self.__request('ping', decode = lambda values : float(values[0]))
+
+    #
+    # Close the connection, outstanding requests fail. The server drops the
+    # session and stops its motors.
     #
-    def __init__(self, remote_ip, remote_port=Connection.DEFAULT_PORT):
-        self._connection = Connection()
-        self._connection.connect(remote_ip, remote_port)
+    def close(self):
+        with self._send_lock:
+            self._closing = True
+            try:
+                if self._backlog is None and not self._closed:
+                    self._connection.send(self.__make_id(), 'end')
+            except OSError:
+                pass
+            self._connection.close()
+        self._reader.join()
 
     #
     # Determine name to use for a specific device
     #
     def get_name(self, class_name, device_name):
-        
-        # Send message
-        self._connection.send('name', class_name, device_name)
-        
-        # Receive response
-        result, data = self._connection.recv()
-        if not result:
-            raise ValueError('Could not find device ' + class_name + ':' + device_name)
+        return self.get_name_future(class_name, device_name).result()
 
-        # Return data
-        return data.strip().decode()
+    #
+    # Determine name to use for a specific device, returns a future
+    #
+    def get_name_future(self, class_name, device_name):
+        return self.__request('name', class_name, device_name)
 
     #
     # Get an attribute
     #
     def get_attribute(self, name, attribute):
-        
-        # Send message
-        self._connection.send('get', name, attribute)
-        
-        # Receive response
-        result, data = self._connection.recv()
-        if not result:
-            raise ValueError('Connection closed')
-        
-        # Return data
-        return data.strip().decode()
+
+        # Read shared attributes from shared memory
+        if self._shared:
+            slot = self._shared.get((name, attribute))
+            if slot is not None:
+                value = self._shared_table.read(slot)
+                if value is not None:
+                    return value
+
+        return self.get_attribute_future(name, attribute).result()
+
+    #
+    # Get an attribute, returns a future
+    #
+    def get_attribute_future(self, name, attribute):
+        return self.__request('get', name, attribute)
+
+    #
+    # Get an attribute as int, or None if it cannot be read as one
+    #
+    def get_attribute_int(self, name, attribute):
+
+        # Read shared attributes from shared memory
+        if self._shared:
+            slot = self._shared.get((name, attribute))
+            if slot is not None:
+                value = self._shared_table.read(slot)
+                if value is not None:
+                    return int(value)
+
+        return self.get_attribute_int_future(name, attribute).result()
+
+    #
+    # Get an attribute as int, returns a future
+    #
+    def get_attribute_int_future(self, name, attribute):
+        return self.__request('geti', name, attribute, decode = RemoteEV3.__decode_int)
+
+    #
+    # Decode an int. The binary protocol sends it as is, the text protocol
+    # as a string, and one empty value when there is none.
+    #
+    @staticmethod
+    def __decode_int(values):
+        if not values or values == ['']:
+            return None
+        try:
+            return int(values[0])
+        except ValueError:
+            return None
+
+    #
+    # Get multiple attributes in a single round trip. Takes a list of
+    # (name, attribute) tuples, returns a list of values in the same order.
+    #
+    def get_attributes(self, attributes):
+        return self.get_attributes_future(attributes).result()
+
+    #
+    # Get multiple attributes, returns a future
+    #
+    def get_attributes_future(self, attributes):
+
+        # Flatten into name, attribute, name, attribute, ...
+        args = []
+        for name, attribute in attributes:
+            args.append(name)
+            args.append(attribute)
+
+        # The text protocol cannot distinguish between no values and one
+        # empty value, so trim or pad to the expected count
+        count = len(attributes)
+        def decode(values):
+            values.extend([''] * (count - len(values)))
+            return values[:count]
+
+        return self.__request('mget', *args, decode = decode)
+
+    #
+    # Get all values of a sensor in a single round trip. The brick reads them
+    # from bin_data where it can. Returns a list of numbers, or None.
+    #
+    def get_values(self, name):
+        return self.get_values_future(name).result()
+
+    #
+    # Get all values of a sensor, returns a future
+    #
+    def get_values_future(self, name):
+        return self.__request('vals', name, decode = RemoteEV3.__decode_values)
+
+    #
+    # Decode sensor values. The text protocol sends one empty value when
+    # there are none.
+    #
+    @staticmethod
+    def __decode_values(values):
+        if not values or values == ['']:
+            return None
+        return [parse_value(value) for value in values]
 
     #
     # Set an attribute
     #
     def set_attribute(self, name, attribute, value):
-        
-        # Send message
-        self._connection.send('set', name, attribute, value)
+
+        # Hold back while the thread is in a batch
+        sets = getattr(self._cork, 'sets', None)
+        if sets is not None:
+            sets.append((name, attribute, value))
+            return
+
+        # Send message, there is no response
+        with self._send_lock:
+            self.__send(self.__make_id(), 'set', name, attribute, value)
+
+    #
+    # Set multiple attributes in a single message. Takes a list of (name,
+    # attribute, value) tuples, which the brick applies in order.
+    #
+    def set_attributes(self, sets):
+
+        # Hold back while the thread is in a batch
+        corked = getattr(self._cork, 'sets', None)
+        if corked is not None:
+            corked.extend(sets)
+            return
+
+        # Flatten into name, attribute, value, name, ...
+        args = []
+        for name, attribute, value in sets:
+            args.extend((name, attribute, value))
+
+        # Send message, there is no response
+        with self._send_lock:
+            self.__send(self.__make_id(), 'mset', *args)
+
+    #
+    # Gather the sets made by the current thread during a with statement,
+    # and send them as a single message at the end. Batches can be nested,
+    # the outermost one sends.
+    #
+    @contextmanager
+    def batch(self):
+
+        # Nested batch, the outer one sends
+        if getattr(self._cork, 'sets', None) is not None:
+            yield
+            return
+
+        self._cork.sets = []
+        try:
+            yield
+        finally:
+            sets, self._cork.sets = self._cork.sets, None
+            if sets:
+                self.set_attributes(sets)
+
+    #
+    # Wait on the brick until a named condition holds, or the timeout in ms
+    # expires. Returns whether the condition was met.
+    #
+    def wait(self, name, condition, arg = None, timeout = 0):
+        return self.wait_future(name, condition, arg, timeout).result()
+
+    #
+    # Wait on the brick, returns a future. The condition is checked before
+    # it is sent.
+    #
+    def wait_future(self, name, condition, arg = None, timeout = 0):
+        Condition(condition, arg)
+        return self.__request('wait', name, condition, arg, timeout, decode = lambda values : int(values[0]) != 0)
+
+    #
+    # Subscribe to an attribute. The server samples the attribute every period
+    # and pushes its value when it changes. Returns a Subscription.
+    #
+    def subscribe(self, name, attribute, period_ms, callback = None):
+
+        with self._send_lock:
+
+            # Fail immediately if the connection is gone
+            if self._closed:
+                raise ValueError('Connection closed')
+
+            # Register the subscription before sending
+            msg_id = self.__make_id()
+            subscription = Subscription(callback, lambda : self.__unsubscribe(msg_id))
+            self._subscriptions[msg_id] = subscription
+            self.__send(msg_id, 'sub', name, attribute, period_ms)
+
+        return subscription
+
+    #
+    # Record an integer attribute on the brick, sampled every period_ms into a
+    # ring buffer of capacity samples. Unlike a subscription, every sample is
+    # kept with its timestamp, and fetched in bulk with History.fetch().
+    # Returns a History.
+    #
+    def sample(self, name, attribute, period_ms, capacity = History.DEFAULT_CAPACITY):
+
+        if capacity < 1:
+            raise ValueError('Invalid capacity ' + str(capacity))
+
+        with self._send_lock:
+
+            # Fail immediately if the connection is gone
+            if self._closed:
+                raise ValueError('Connection closed')
+
+            msg_id = self.__make_id()
+            self.__send(msg_id, 'hsub', name, attribute, period_ms, capacity)
+
+        return History(lambda since : self.__fetch_history(msg_id, since), lambda : self.__stop_sampling(msg_id))
+
+    #
+    # Fetch recorded samples, starting at a sequence number
+    #
+    def __fetch_history(self, sampler_id, since):
+        result = self.__request('hist', sampler_id, since, decode = RemoteEV3.__decode_history).result()
+        if result is None:
+            raise ValueError('Sampler not found')
+        return result
+
+    #
+    # Decode a history response into (first, count, chunk), or None if the
+    # sampler was not found
+    #
+    @staticmethod
+    def __decode_history(values):
+        if len(values) < 3:
+            return None
+        chunk = values[2]
+        return int(values[0]), int(values[1]), bytes.fromhex(chunk) if isinstance(chunk, str) else chunk
+
+    #
+    # Stop a sampler
+    #
+    def __stop_sampling(self, sampler_id):
+        with self._send_lock:
+            if not self._closed:
+                self.__send(self.__make_id(), 'unsub', sampler_id)
+
+    #
+    # Subscribe to an attribute over the UDP telemetry channel. The server
+    # sends every sample as a datagram; samples may be lost, and late ones are
+    # dropped, so the subscription always holds the newest value that arrived.
+    # Returns a Subscription.
+    #
+    def subscribe_telemetry(self, name, attribute, period_ms, callback = None):
+
+        with self._send_lock:
+
+            # Fail immediately if the connection is gone
+            if self._closed:
+                raise ValueError('Connection closed')
+
+            # Open the receiver on first use
+            if self._telemetry is None:
+                self._telemetry = TelemetryReceiver()
+
+            # Register the subscription before sending
+            msg_id = self.__make_id()
+            subscription = Subscription(callback, lambda : self.__unsubscribe_telemetry(msg_id))
+            self._telemetry.register(msg_id, subscription)
+            self.__send(msg_id, 'tsub', name, attribute, period_ms, self._telemetry.port)
+
+        return subscription
+
+    #
+    # Telemetry receiver, None until the first telemetry subscription
+    #
+    telemetry = property(fget = lambda self : self._telemetry)
+
+    #
+    # Cancel a subscription
+    #
+    def __unsubscribe(self, sub_id):
+        with self._send_lock:
+            if self._subscriptions.pop(sub_id, None) is not None and not self._closed:
+                self.__send(self.__make_id(), 'unsub', sub_id)
+
+    #
+    # Share an attribute through shared memory, for clients on the same host
+    # as the server. The server samples the attribute every period_ms, and
+    # get_attribute reads the latest sample without a round trip. Returns
+    # whether the attribute could be shared; if not, reads keep going to the
+    # server.
+    #
+    def share_attribute(self, name, attribute, period_ms = 10):
+
+        if not HAVE_SHARED_MEMORY or not self._connection.is_local():
+            return False
+        if (name, attribute) in self._shared:
+            return True
+
+        # Ask the server for a slot
+        msg_id, future = self.__send_request('share', (name, attribute, period_ms), lambda values : values)
+        values = future.result()
+        if not values[0]:
+            return False
+
+        # Map the table the first time
+        try:
+            if self._shared_table is None or self._shared_table.name != values[0]:
+                self._shared_table = SharedTable(values[0])
+        except OSError:
+            with self._send_lock:
+                self.__send(self.__make_id(), 'unsub', msg_id)
+            return False
+
+        self._shared[(name, attribute)] = int(values[1])
+        return True
+
+    #
+    # Cancel a telemetry subscription
+    #
+    def __unsubscribe_telemetry(self, sub_id):
+        with self._send_lock:
+            if self._telemetry.unregister(sub_id) is not None and not self._closed:
+                self.__send(self.__make_id(), 'unsub', sub_id)
+
+    #
+    # Estimated clock of the brick
+    #
+    clock = property(fget = lambda self : self._clock)
+
+    #
+    # Synchronize the estimated clock of the brick, returns the Clock
+    #
+    def sync_clock(self, samples = Clock.DEFAULT_SAMPLES):
+        self._clock.sync(self.ping, samples)
+        return self._clock
+
+    #
+    # Set attributes at a given time, in seconds since the epoch on the local
+    # clock. Takes a list of (name, attribute, value) tuples, which the brick
+    # applies in order when the time comes. Synchronizes the clock first if
+    # that has not happened yet.
+    #
+    def set_attributes_at(self, timestamp, sets):
+
+        if not self._clock.synced:
+            self.sync_clock()
+
+        args = [self._clock.to_remote(timestamp)]
+        for name, attribute, value in sets:
+            args.extend((name, attribute, value))
+
+        with self._send_lock:
+            self.__send(self.__make_id(), 'at', *args)
+
+    #
+    # Allocate a request id. Must be called with the send lock held.
+    #
+    def __make_id(self):
+        self._next_id += 1
+        return self._next_id
+
+    #
+    # Send a message, must be called with the send lock held. While
+    # reconnecting, messages are queued to be sent once the session resumed.
+    #
+    def __send(self, msg_id, op, *args):
+
+        if self._closed:
+            raise ValueError('Connection closed')
+        if self._backlog is not None:
+            self._backlog.append((msg_id, op, args))
+            return
+
+        try:
+            self._connection.send(msg_id, op, *args)
+        except OSError:
+            if not self._reconnect or self._closing:
+                raise
+            self._backlog = [(msg_id, op, args)]
+
+    #
+    # Connect to the server, negotiate the protocol and start or resume the
+    # session, waiting for the server's answers until the deadline. Returns
+    # the connection, and whether the session was resumed.
+    #
+    def __connect(self, deadline):
+
+        remote_ip, remote_port, unix_path = self._address
+        connection = Connection()
+        if unix_path is not None:
+            connection.connect_unix(unix_path)
+        else:
+            connection.connect(remote_ip, remote_port)
+
+        try:
+            # Negotiate the protocol, the server answers with the one it will use
+            if self._protocol != TextCodec.NAME:
+                values = self.__handshake(connection, deadline, 'proto', self._protocol)
+                connection.codec = CODECS.get(values[0], TextCodec)()
+
+            # Start a session, or resume the previous one
+            if self._reconnect:
+                values = self.__handshake(connection, deadline, 'resume', self._token)
+                resumed = self._token == values[0] and int(values[1]) != 0
+                self._token = values[0]
+                return connection, resumed
+
+            return connection, False
+
+        except:
+            connection.close()
+            raise
+
+    #
+    # Send a request on a connection that has no reader yet, and wait for
+    # its response until the deadline, or indefinitely if that is None
+    #
+    def __handshake(self, connection, deadline, msg, *args):
+
+        with self._send_lock:
+            msg_id = self.__make_id()
+        connection.send(msg_id, msg, *args)
+        while True:
+            if deadline is not None and not connection.wait(max(0, deadline - monotonic())):
+                raise TimeoutError('No response from server')
+            result, response = connection.recv()
+            if not result:
+                raise ValueError('Connection closed')
+            if response[0] == msg_id:
+                return response[2]
+
+    #
+    # Re-establish the connection after it dropped. Returns whether that
+    # succeeded before the timeout expired.
+    #
+    def __reconnect(self):
+
+        # Queue messages from now on
+        with self._send_lock:
+            if self._closing or not self._reconnect:
+                return False
+            if self._backlog is None:
+                self._backlog = []
+
+        # Keep trying, backing off a little each time. A server that accepts
+        # the connection but does not answer, for instance a single client
+        # server still serving the dropped connection, fails the attempt.
+        deadline = monotonic() + RemoteEV3.RECONNECT_TIMEOUT
+        delay = 0.05
+        while True:
+            try:
+                connection, resumed = self.__connect(deadline)
+                break
+            except (OSError, ValueError):
+                if self._closing or monotonic() + delay > deadline:
+                    return False
+                sleep(delay)
+                delay = min(delay * 2, 1.0)
+
+        with self._send_lock:
+
+            # Closed meanwhile
+            if self._closing:
+                connection.close()
+                return False
+
+            # Without the session, the server forgot subscriptions and shared
+            # attributes
+            subscriptions = []
+            telemetry = None
+            if not resumed:
+                subscriptions, self._subscriptions = list(self._subscriptions.values()), {}
+                telemetry, self._telemetry = self._telemetry, None
+                self._shared = {}
+
+            # Send unanswered requests and queued messages again, in order
+            messages = { msg_id : (msg, args) for msg_id, (_, _, msg, args) in self._pending.items() }
+            for msg_id, msg, args in self._backlog:
+                messages[msg_id] = (msg, args)
+            self._connection = connection
+            self._backlog = None
+            self._reconnects += 1
+            for msg_id in sorted(messages):
+                msg, args = messages[msg_id]
+                self.__send(msg_id, msg, *args)
+
+        for subscription in subscriptions:
+            subscription.close()
+        if telemetry is not None:
+            telemetry.close()
+        return True
+
+    #
+    # Send a request that expects a response, returns a future
+    #
+    def __request(self, msg, *args, decode = None):
+        return self.__send_request(msg, args, decode)[1]
+
+    #
+    # Send a request that expects a response, returns its id and a future
+    #
+    def __send_request(self, msg, args, decode):
+
+        future = Future()
+        with self._send_lock:
+
+            # Fail immediately if the connection is gone
+            if self._closed:
+                raise ValueError('Connection closed')
+
+            # Register the future before sending, the response may arrive
+            # before send returns
+            msg_id = self.__make_id()
+            self._pending[msg_id] = (future, decode, msg, args)
+            self.__send(msg_id, msg, *args)
+
+        return msg_id, future
+
+    #
+    # Response reader thread
+    #
+    def __read_responses(self):
+
+        while True:
+
+            # Receive response, reconnect if the connection dropped. A
+            # response that cannot be decoded leaves its request pending.
+            try:
+                result, response = self._connection.recv()
+            except DecodeError as ex:
+                Trace.Warning('Invalid response', ex)
+                continue
+            if not result:
+                if self.__reconnect():
+                    continue
+                break
+
+            # Deliver pushed values to the matching subscription
+            msg_id, op, values = response
+            if op == 'push':
+                subscription = self._subscriptions.get(msg_id)
+                if subscription is not None:
+                    subscription.push(values[0])
+                continue
+
+            # Resolve the matching future, unless the caller cancelled it
+            pending = self._pending.pop(msg_id, None)
+            if pending is not None and pending[0].set_running_or_notify_cancel():
+                future, decode, _, _ = pending
+                future.set_result(values[0] if decode is None else decode(values))
+
+        # Connection closed, fail all outstanding requests and end subscriptions
+        with self._send_lock:
+            self._closed = True
+            self._backlog = None
+            pending, self._pending = self._pending, {}
+            subscriptions, self._subscriptions = self._subscriptions, {}
+            self._shared = {}
+
+        for future, _, _, _ in pending.values():
+            if future.set_running_or_notify_cancel():
+                future.set_exception(ValueError('Connection closed'))
+        for subscription in subscriptions.values():
+            subscription.close()
+        if self._telemetry is not None:
+            self._telemetry.close()
@@ -0,0 +1,182 @@
+################################################################################
+#
+# Typed attribute schema for devices
+#
+# Device classes declare their attributes as class members, which decode the
+# strings read from the brick into Python values once, as they are read:
+#
+#   class Motor(Device):
+#       speed_sp = IntAttribute(writable = True)
+#       state    = ListAttribute()
+#
+# Static attributes are read once and kept for the lifetime of the device.
+# Other attributes may be given a maximum age in ms, within which repeated
+# reads are answered from the device's read cache.
+#
+# Access a declared attribute through the class to inspect it, as in
+# Motor.speed_sp.writable.
+#
+class Attribute:
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_name',
+        '_static',
+        '_readable',
+        '_writable',
+        '_max_age_ms'
+    ]
+
+    #
+    # Construction
+    #
+    def __init__(self, static = False, readable = True, writable = False, max_age_ms = None):
+        self._name          = None
+        self._static        = static
+        self._readable      = readable
+        self._writable      = writable
+        self._max_age_ms    = max_age_ms
+
+    #
+    # Take the name of the class member
+    #
+    def __set_name__(self, owner, name):
+        self._name = name
+
+    #
+    # Properties
+    #
+    name        = property(fget = lambda self : self._name)
+    static      = property(fget = lambda self : self._static)
+    readable    = property(fget = lambda self : self._readable)
+    writable    = property(fget = lambda self : self._writable)
+    max_age_ms  = property(fget = lambda self : self._max_age_ms)
+
+    #
+    # Decode a value read from the brick, None if it could not be read
+    #
+    def decode(self, value):
+        return value
+
+    #
+    # Check and encode a value to write
+    #
+    def encode(self, value):
+        return value
+
+    #
+    # Read and decode the attribute of a device
+    #
+    def read(self, device):
+        return self.decode(device.get_attribute(self._name))
+
+    #
+    # Descriptor protocol
+    #
+    def __get__(self, device, owner = None):
+        if device is None:
+            return self
+        if not self._readable:
+            raise AttributeError('Attribute ' + self._name + ' cannot be read')
+        if self._static:
+            return device.get_static_attribute(self._name, self.decode)
+        return self.read(device)
+
+    def __set__(self, device, value):
+        if not self._writable:
+            raise AttributeError('Attribute ' + self._name + ' cannot be written')
+        device.set_attribute(self._name, self.encode(value))
+
+
+################################################################################
+#
+# Integer attribute. Read through get_attribute_int, which lets instances
+# that can skip the string, such as a local brick, do so.
+#
+class IntAttribute(Attribute):
+
+    __slots__ = []
+
+    def decode(self, value):
+        return None if value is None else int(value)
+
+    def encode(self, value):
+        return int(value)
+
+    def read(self, device):
+        return device.get_attribute_int(self._name)
+
+
+################################################################################
+#
+# Attribute holding one of a fixed set of strings
+#
+class EnumAttribute(Attribute):
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_values'
+    ]
+
+    #
+    # Construction
+    #
+    def __init__(self, values, **kwargs):
+        super(EnumAttribute, self).__init__(**kwargs)
+        self._values = tuple(values)
+
+    #
+    # Valid values
+    #
+    values = property(fget = lambda self : self._values)
+
+    #
+    # Check a value to write
+    #
+    def encode(self, value):
+        if not value in self._values:
+            raise ValueError('Invalid value ' + str(value) + ' for ' + self._name)
+        return value
+
+
+################################################################################
+#
+# Attribute holding a space separated list of strings, decoded into a list
+#
+class ListAttribute(Attribute):
+
+    __slots__ = []
+
+    def decode(self, value):
+        if value is None:
+            return None
+        return value.split() if isinstance(value, str) else list(value)
+
+    def encode(self, value):
+        return value if isinstance(value, str) else ' '.join(value)
+
+
+#
+# Declared attributes of a device class and its bases, by name
+#
+_schemas = {}
+
+#
+# Get the declared attributes of a device class, as { name : Attribute }
+#
+def schema_of(cls):
+    schema = _schemas.get(cls)
+    if schema is None:
+        schema = {}
+        for base in reversed(cls.__mro__):
+            for name, member in vars(base).items():
+                if isinstance(member, Attribute):
+                    schema[name] = member
+                else:
+                    schema.pop(name, None)
+        _schemas[cls] = schema
+    return schema
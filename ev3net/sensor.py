@@ -1,4 +1,5 @@
-from device import Device
+from device import Device, await_value
+from schema import Attribute, EnumAttribute, IntAttribute, ListAttribute
 
 
 ################################################################################
@@ -16,10 +17,11 @@ class Sensor(Device):
     #
     # Attributes
     #
-    decimals    = property(fget = lambda self : self.get_cached_attribute('decimals'))
-    mode        = property(fget = lambda self : self.get_attribute('mode'), fset = lambda self, mode : self.set_attribute('mode', mode))
-    modes       = property(fget = lambda self : self.get_cached_attribute('modes'))
-    num_values  = property(fget = lambda self : int(self.get_attribute('num_values')))
+    decimals    = IntAttribute(static = True)
+    mode        = Attribute(writable = True)
+    modes       = ListAttribute(static = True)
+    num_values  = IntAttribute()
+    units       = Attribute()
 
     #
     # Value
@@ -28,15 +30,31 @@ class Sensor(Device):
         return self.get_attribute_int('value' + str(index))
 
     #
-    # Get all values
+    # Get all values. Instances that can read them at once, from bin_data on
+    # the brick, do so in a single read or round trip.
     #
     def get_values(self):
-        values = []
-        for i in range(0, self.num_values):
-            values.append(self.value(i))
-        return values
+        get_values = getattr(self._ev3, 'get_values', None)
+        if get_values is not None:
+            values = get_values(self._name)
+            if values is not None:
+                return values
+        names = ['value' + str(i) for i in range(0, self.num_values)]
+        return [int(value) for value in self.get_attributes(names)]
     values = property(fget = lambda self : self.get_values())
 
+    #
+    # Get all values, for asyncio instances
+    #
+    async def get_values_async(self):
+        get_values = getattr(self._ev3, 'get_values', None)
+        if get_values is not None:
+            values = await await_value(get_values(self._name))
+            if values is not None:
+                return values
+        names = ['value' + str(i) for i in range(0, int(await self.get_attribute_async('num_values')))]
+        return [int(value) for value in await self.get_attributes_async(names)]
+
 
 ################################################################################
 #
@@ -57,11 +75,13 @@ class ColorSensor(Sensor):
     MODE_COL_REFLECT    = 'COL-REFLECT'
     MODE_REF_RAW        = 'REF-RAW'
     MODE_RGB_RAW        = 'RGB-RAW'
+    MODE_COL_CAL        = 'COL-CAL'
 
     #
     # Mode list
     #
-    Modes = (MODE_COL_AMBIENT, MODE_COL_COLOR, MODE_COL_REFLECT, MODE_RGB_RAW, MODE_REF_RAW) 
+    Modes = (MODE_COL_AMBIENT, MODE_COL_COLOR, MODE_COL_REFLECT, MODE_RGB_RAW, MODE_REF_RAW, MODE_COL_CAL)
+    mode  = EnumAttribute(Modes, writable = True)
     
     #
     # Colors
@@ -117,7 +137,8 @@ class GyroSensor(Sensor):
     #
     # Mode list
     #
-    Modes = (MODE_GYRO_ANG, MODE_GYRO_RATE, MODE_GYRO_FAS, MODE_GYRO_GA, MODE_GYRO_CAL, MODE_TILT_RATE, MODE_TILT_ANG) 
+    Modes = (MODE_GYRO_ANG, MODE_GYRO_RATE, MODE_GYRO_FAS, MODE_GYRO_GA, MODE_GYRO_CAL, MODE_TILT_RATE, MODE_TILT_ANG)
+    mode  = EnumAttribute(Modes, writable = True)
 
     #
     # Construction
@@ -153,7 +174,8 @@ class TouchSensor(Sensor):
     #
     # Mode list
     #
-    Modes = (MODE_TOUCH) 
+    Modes = (MODE_TOUCH,)
+    mode  = EnumAttribute(Modes, writable = True)
 
     #
     # Construction
@@ -185,7 +207,8 @@ class UltrasonicSensor(Sensor):
     #
     # Mode list
     #
-    Modes = (MODE_US_DIST_CM, MODE_US_DIST_IN, MODE_US_SI_CM, MODE_US_SI_IN, MODE_US_LISTEN) 
+    Modes = (MODE_US_DIST_CM, MODE_US_DIST_IN, MODE_US_SI_CM, MODE_US_SI_IN, MODE_US_LISTEN)
+    mode  = EnumAttribute(Modes, writable = True)
 
     #
     # Construction
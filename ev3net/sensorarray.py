@@ -0,0 +1,230 @@
+from array import array
+from concurrent.futures import TimeoutError
+from time import monotonic, time
+
+#
+# NumPy is optional, values are kept in standard arrays without it
+#
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+HAVE_NUMPY = numpy is not None
+
+################################################################################
+#
+# Class representing a group of sensors read together, across bricks
+#
+# Each column of the array is one value of one sensor. A read sends a single
+# request per brick for all of its columns, with the requests to all remote
+# bricks in flight at the same time, and writes the values into a
+# preallocated array, which is a NumPy array if NumPy is installed:
+#
+#   sensors = SensorArray([ColorSensor('in1', left), ColorSensor('in1', right)])
+#   values  = sensors.read()
+#   error   = values[0] - values[1]
+#
+# Values that cannot be read, and all values of bricks that fail or do not
+# respond in time, are NaN. With a history capacity, every read is also
+# recorded as a row of a ring buffer.
+#
+class SensorArray:
+
+    #
+    # Default timeout per read, in seconds
+    #
+    DEFAULT_TIMEOUT = 1.0
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_columns',
+        '_groups',
+        '_values',
+        '_timestamp',
+        '_errors',
+        '_timestamps',
+        '_history',
+        '_capacity',
+        '_count'
+    ]
+
+    #
+    # Construction. Takes a list of sensors, for their first value, or of
+    # (sensor, index) tuples, and the number of reads to keep in the history.
+    #
+    def __init__(self, sensors, history = 0):
+
+        self._columns = [entry if isinstance(entry, tuple) else (entry, 0) for entry in sensors]
+
+        # Group the columns by brick, with the bricks that return futures
+        # first so that their requests are sent before the others are read
+        groups = {}
+        for column, (sensor, index) in enumerate(self._columns):
+            group = groups.get(sensor.ev3)
+            if group is None:
+                group = groups[sensor.ev3] = (sensor.ev3, [], [])
+            group[1].append((sensor.name, 'value' + str(index)))
+            group[2].append(column)
+        self._groups = sorted(groups.values(), key = lambda group : not hasattr(group[0], 'get_attributes_future'))
+
+        self._values    = SensorArray.__allocate(len(self._columns))
+        self._timestamp = None
+        self._errors    = {}
+
+        # Rows of the history are kept in one flat buffer
+        self._capacity   = history
+        self._count      = 0
+        self._timestamps = SensorArray.__allocate(history) if history else None
+        self._history    = SensorArray.__allocate(history * len(self._columns)) if history else None
+
+    #
+    # Sensor and value index of each column
+    #
+    columns = property(fget = lambda self : self._columns)
+
+    #
+    # Values of the last read, and its time in seconds since the epoch
+    #
+    values      = property(fget = lambda self : self._values)
+    timestamp   = property(fget = lambda self : self._timestamp)
+
+    #
+    # Exceptions of the last read by EV3 instance, for the bricks that failed
+    # or timed out
+    #
+    errors = property(fget = lambda self : self._errors)
+
+    #
+    # Number of rows the history holds, and the number of reads recorded
+    #
+    capacity    = property(fget = lambda self : self._capacity)
+    count       = property(fget = lambda self : self._count)
+
+    #
+    # Read all sensors. Returns the values array, which is updated in place
+    # by every read.
+    #
+    def read(self, timeout = DEFAULT_TIMEOUT):
+
+        deadline = monotonic() + timeout
+        self._errors = {}
+
+        # Send the requests to remote bricks, and read the others meanwhile
+        pending = []
+        for ev3, attributes, columns in self._groups:
+            try:
+                get_attributes_future = getattr(ev3, 'get_attributes_future', None)
+                if get_attributes_future is not None:
+                    pending.append((ev3, get_attributes_future(attributes), columns))
+                else:
+                    self.__store(columns, SensorArray.__get_attributes(ev3, attributes))
+            except Exception as ex:
+                self.__fail(ev3, columns, ex)
+
+        # Collect the responses. A response that arrives after the timeout
+        # is dropped by the instance.
+        for ev3, future, columns in pending:
+            try:
+                self.__store(columns, future.result(max(0, deadline - monotonic())))
+            except TimeoutError:
+                self.__fail(ev3, columns, TimeoutError('No response from ' + str(ev3)))
+            except Exception as ex:
+                self.__fail(ev3, columns, ex)
+
+        self._timestamp = time()
+        if self._capacity:
+            self.__record()
+        return self._values
+
+    #
+    # Get the recorded reads, oldest first. Returns the timestamps, and the
+    # values with a row per read: a 2-D array with NumPy, a flat array in row
+    # order without it.
+    #
+    def get_history(self):
+
+        if not self._capacity:
+            raise ValueError('SensorArray has no history')
+
+        # Copy in one or two parts, depending on whether the rows wrap
+        width = len(self._columns)
+        count = min(self._count, self._capacity)
+        start = (self._count - count) % self._capacity
+        end   = start + count
+        if end <= self._capacity:
+            timestamps = self._timestamps[start:end]
+            values     = self._history[start * width:end * width]
+        else:
+            end -= self._capacity
+            timestamps = SensorArray.__join(self._timestamps[start:], self._timestamps[:end])
+            values     = SensorArray.__join(self._history[start * width:], self._history[:end * width])
+
+        if HAVE_NUMPY:
+            return timestamps.copy(), values.reshape(count, width).copy()
+        return timestamps, values
+
+    #
+    # Drop the recorded reads
+    #
+    def clear_history(self):
+        self._count = 0
+
+    #
+    # Store the values read from a brick into its columns
+    #
+    def __store(self, columns, values):
+        for column, value in zip(columns, values):
+            try:
+                self._values[column] = float(value)
+            except (TypeError, ValueError):
+                self._values[column] = float('nan')
+
+    #
+    # Mark the columns of a brick as not read
+    #
+    def __fail(self, ev3, columns, ex):
+        self._errors[ev3] = ex
+        for column in columns:
+            self._values[column] = float('nan')
+
+    #
+    # Record the last read in the history
+    #
+    def __record(self):
+        width = len(self._columns)
+        row   = self._count % self._capacity
+        self._timestamps[row] = self._timestamp
+        self._history[row * width:(row + 1) * width] = self._values
+        self._count += 1
+
+    #
+    # Read attributes from an instance without futures, in one call if it
+    # supports that
+    #
+    @staticmethod
+    def __get_attributes(ev3, attributes):
+        get_attributes = getattr(ev3, 'get_attributes', None)
+        if get_attributes is not None:
+            return get_attributes(attributes)
+        return [ev3.get_attribute(name, attribute) for name, attribute in attributes]
+
+    #
+    # Allocate an array of doubles, filled with NaN
+    #
+    @staticmethod
+    def __allocate(size):
+        if HAVE_NUMPY:
+            return numpy.full(size, numpy.nan)
+        return array('d', [float('nan')]) * size
+
+    #
+    # Join two parts of a buffer
+    #
+    @staticmethod
+    def __join(first, second):
+        if HAVE_NUMPY:
+            return numpy.concatenate((first, second))
+        return first + second
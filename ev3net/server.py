@@ -3,15 +3,28 @@
 #
 # Imports
 #
-from connection import Connection
-from local import LocalEV3
+import asyncio
+from argparse import ArgumentParser
+from connection import Connection, AsyncConnection
+from protocol import CODECS, BinaryCodec, DecodeError, TextCodec
+from local import HandleCache, LocalEV3
 from device import Device, EV3
 from motor import Motor
+from condition import Condition
+from history import SampleRing, encode_chunk
+from shm import HAVE_SHARED_MEMORY, SharedTable
+from telemetry import TelemetrySender
 from trace import Trace
+from time import monotonic, time
+from secrets import token_hex
 
 #
 # Server class
 #
+# Serves a single EV3 to its clients. In the default mode, one client is served
+# at a time; the asyncio mode serves any number of concurrent clients. Each
+# connection has its own Session, holding its jobs and the devices it touched.
+#
 class Server:
 
     #
@@ -20,117 +33,1083 @@ class Server:
     __slots__ = [
         '_connection',
         '_ev3',
-        '_handlers'
+        '_handlers',
+        '_sessions',
+        '_telemetry',
+        '_shared',
+        '_detached'
     ]
 
+    #
+    # Maximum number of messages handled for one client before the others
+    # get a turn, in the asyncio mode
+    #
+    MAX_BATCH = 16
+
+    #
+    # Seconds a disconnected client has to resume its session, before the
+    # session is dropped and its motors are stopped
+    #
+    RESUME_GRACE = 10.0
+
     #
     # Construction
     #
-    def __init__(self):
-        self._ev3 = LocalEV3()
+    def __init__(self, ev3 = None):
+        self._ev3 = ev3 if ev3 is not None else LocalEV3()
         self._connection = Connection()
+        self._sessions = set()
+        self._telemetry = TelemetrySender()
+        self._shared = None
+        self._detached = {}
 
         # Setup handler map
         self._handlers = {
+            'proto' :   self.handle_proto,
             'name' :    self.handle_name,
             'get' :     self.handle_get,
-            'set' :     self.handle_set
+            'mget' :    self.handle_mget,
+            'set' :     self.handle_set,
+            'sub' :     self.handle_sub,
+            'unsub' :   self.handle_unsub,
+            'wait' :    self.handle_wait,
+            'ping' :    self.handle_ping,
+            'at' :      self.handle_at,
+            'tsub' :    self.handle_tsub,
+            'mset' :    self.handle_mset,
+            'share' :   self.handle_share,
+            'resume' :  self.handle_resume,
+            'end' :     self.handle_end,
+            'vals' :    self.handle_vals,
+            'hsub' :    self.handle_hsub,
+            'hist' :    self.handle_hist,
+            'geti' :    self.handle_geti
         }
 
     #
-    # Main loop
+    # Currently connected sessions
+    #
+    sessions = property(fget = lambda self : self._sessions)
+
+    #
+    # Sender for telemetry datagrams
+    #
+    telemetry = property(fget = lambda self : self._telemetry)
+
+    #
+    # Release the telemetry socket and the shared memory table
+    #
+    def close(self):
+        self._telemetry.close()
+        if self._shared is not None:
+            self._shared.close()
+            self._shared = None
+
+    #
+    # Main loop. Also listens on a Unix domain socket if a path is given.
     #
-    def main(self):
+    def main(self, address = '0.0.0.0', port = Connection.DEFAULT_PORT, unix_path = None):
 
         # Listen for connections
-        self._connection.listen()
+        self._connection.listen(address, port)
+        if unix_path:
+            self._connection.listen_unix(unix_path)
+
+        try:
+            self.__serve()
+        finally:
+            self.close()
+
+    #
+    # Serve clients one at a time
+    #
+    def __serve(self):
 
         # Main server loop
         while True:
 
-            # Accept connection
-            self._connection.accept()
+            # Accept connection, every connection starts out using text.
+            # Drop detached sessions whose grace period ended meanwhile.
+            if not self._connection.accept(self.__expire_sessions()):
+                continue
+            self._connection.codec = TextCodec()
+            session = Session(self._connection)
+            self._sessions.add(session)
             
             # Message handler loop
             while True:
 
-                # Receive message
-                result, msg = self._connection.recv()
+                # Run due jobs and drop detached sessions whose grace period
+                # ended, and wait for a message until the next of those
+                timeouts = [timeout for timeout in (session.run_jobs(), self.__expire_sessions()) if timeout is not None]
+                if not self._connection.wait(min(timeouts) if timeouts else None):
+                    continue
+
+                # Receive message, skipping messages that cannot be decoded
+                try:
+                    result, msg = self._connection.recv()
+                except DecodeError as ex:
+                    Trace.Warning('Invalid message', ex)
+                    continue
                 if not result:
                     break
 
                 # Dispatch message
-                self.handle(msg)
+                self.handle(session, msg)
             
             # Connection failed
             Trace.Info('Connection closed')
 
-            # Reset the ev3
-            self.reset()
-            
+            # Keep the session for a while if the client can resume it,
+            # otherwise drop it and reset the ev3
+            if not self.detach_session(session):
+                self.close_session(session)
+                self.reset()
+
+    #
+    # Main loop for the asyncio mode
+    #
+    async def main_async(self, address = '0.0.0.0', port = Connection.DEFAULT_PORT, unix_path = None):
+
+        servers = [await asyncio.start_server(self.serve_async, address, port)]
+        Trace.Info('Listening on', address, ':', port)
+        if unix_path:
+            Connection.remove_unix_path(unix_path)
+            servers.append(await asyncio.start_unix_server(self.serve_async, unix_path))
+            Trace.Info('Listening on', unix_path)
+
+        try:
+            await asyncio.gather(*[server.serve_forever() for server in servers])
+        finally:
+            for server in servers:
+                server.close()
+            self.close()
+
+    #
+    # Serve a single client in the asyncio mode
+    #
+    async def serve_async(self, reader, writer):
+
+        connection = AsyncConnection(reader, writer)
+        Trace.Info('Connection from', connection.remote_address)
+
+        # Run the session's jobs next to its message handler loop
+        session = Session(connection)
+        self._sessions.add(session)
+        jobs = asyncio.ensure_future(session.run_jobs_async())
+
+        # Message handler loop. Whatever ends it, the session's jobs are
+        # stopped and its motors are stopped or kept for it to resume.
+        try:
+            handled = 0
+            while True:
+
+                # Receive message, skipping messages that cannot be decoded
+                try:
+                    result, msg = await connection.recv()
+                except DecodeError as ex:
+                    Trace.Warning('Invalid message', connection.remote_address, ex)
+                    continue
+                if not result:
+                    break
+
+                # Dispatch message, a message that fails is skipped
+                try:
+                    self.handle(session, msg)
+                except Exception as ex:
+                    Trace.Warning('Message failed', msg, ex)
+                await connection.drain()
+
+                # Give other clients a turn after a batch of buffered messages,
+                # receiving only yields when there is nothing buffered
+                handled += 1
+                if handled == Server.MAX_BATCH:
+                    handled = 0
+                    await asyncio.sleep(0)
+
+        finally:
+
+            # Connection failed
+            Trace.Info('Connection closed', connection.remote_address)
+            connection.close()
+            jobs.cancel()
+
+            # Keep the session for a while if the client can resume it,
+            # otherwise drop it and stop the motors it touched
+            if self.detach_session(session):
+                asyncio.get_running_loop().call_later(Server.RESUME_GRACE, self.__expire_sessions)
+            else:
+                self.close_session(session)
+                self.reset(session.devices)
 
     #
     # Request handler
     #                    
-    def handle(self, msg):
+    def handle(self, session, msg):
 
-        # Split into parts
-        parts = msg.decode().split(':')
-        if len(parts) < 1:
-            return False
+        # Split into request id, operation and arguments
+        msg_id, op, args = msg
 
         # Show command
-        Trace.Verbose('Executing command', parts)
+        Trace.Verbose('Executing command', msg_id, op, args)
 
         # Find handler
-        handler = self._handlers.get(parts[0])
+        handler = self._handlers.get(op)
         if handler is None:
-            raise Exception('No handler for message', parts)
+            Trace.Warning('No handler for message', op, args)
+            return
 
-        # Invoke handler
-        handler(parts)
+        # Invoke handler. Arguments that cannot be parsed drop the message,
+        # rather than the connection.
+        try:
+            handler(session, msg_id, args)
+        except (IndexError, TypeError, ValueError) as ex:
+            Trace.Warning('Invalid message', msg_id, op, args, ex)
+
+    #
+    # Handle protocol negotiation message. The response is sent using the
+    # current protocol, after which the connection switches over.
+    #
+    def handle_proto(self, session, msg_id, args):
+        codec_type = CODECS.get(args[0], TextCodec)
+        session.send(msg_id, 'ret', codec_type.NAME)
+        session.connection.codec = codec_type()
 
     #
     # Handle name message
     #
-    def handle_name(self, msg_parts):
-        class_name  = msg_parts[1]
-        device_name = msg_parts[2]
-        self._connection.send(self._ev3.get_name(class_name, device_name))
+    def handle_name(self, session, msg_id, args):
+        class_name  = args[0]
+        device_name = args[1]
+        session.send(msg_id, 'ret', self._ev3.get_name(class_name, device_name))
 
     #
     # Handle attribute get message
     #
-    def handle_get(self, msg_parts):
-        name = msg_parts[1]
-        attr = msg_parts[2] 
-        self._connection.send(self._ev3.get_attribute(name, attr))
+    def handle_get(self, session, msg_id, args):
+        name = args[0]
+        attr = args[1]
+        session.send(msg_id, 'ret', self._ev3.get_attribute(name, attr))
+
+    #
+    # Handle integer attribute get message. Responds with the value as an
+    # int, which the binary encoding sends without formatting it, or with
+    # nothing if it cannot be read as one.
+    #
+    def handle_geti(self, session, msg_id, args):
+        name = args[0]
+        attr = args[1]
+        get_attribute_int = getattr(self._ev3, 'get_attribute_int', None)
+        try:
+            if get_attribute_int is not None:
+                value = get_attribute_int(name, attr)
+            else:
+                value = int(self._ev3.get_attribute(name, attr))
+        except (TypeError, ValueError):
+            value = None
+        session.send(msg_id, 'ret', *([] if value is None else [value]))
+
+    #
+    # Handle multi-attribute get message
+    #
+    def handle_mget(self, session, msg_id, args):
+        values = []
+        for i in range(0, len(args) - 1, 2):
+            values.append(self._ev3.get_attribute(args[i], args[i + 1]))
+        session.send(msg_id, 'ret', *values)
+
+    #
+    # Handle sensor values message. Responds with all values of the sensor, or
+    # with none if they cannot be read.
+    #
+    def handle_vals(self, session, msg_id, args):
+        name = args[0]
+        get_values = getattr(self._ev3, 'get_values', None)
+        if get_values is not None:
+            values = get_values(name)
+        else:
+            try:
+                count  = int(self._ev3.get_attribute(name, 'num_values'))
+                values = [int(self._ev3.get_attribute(name, 'value' + str(i))) for i in range(count)]
+            except (TypeError, ValueError):
+                values = None
+        session.send(msg_id, 'ret', *(values or []))
 
     #
     # Handle attribute set message
     #
-    def handle_set(self, msg_parts):
-        name = msg_parts[1]
-        attr = msg_parts[2]
-        val  = msg_parts[3] 
+    def handle_set(self, session, msg_id, args):
+        name = args[0]
+        attr = args[1]
+        val  = args[2]
+        session.touch(name)
         self._ev3.set_attribute(name, attr, val)
 
+    #
+    # Handle multiple set message, the arguments are name, attribute and value
+    # triplets. The sets are applied in order.
+    #
+    def handle_mset(self, session, msg_id, args):
+        ev3 = self._ev3
+        for i in range(0, len(args) - 2, 3):
+            session.touch(args[i])
+            ev3.set_attribute(args[i], args[i + 1], args[i + 2])
+
+    #
+    # Handle subscription message
+    #
+    def handle_sub(self, session, msg_id, args):
+        name      = args[0]
+        attr      = args[1]
+        period_ms = int(args[2])
+        session.add_job(msg_id, SubscriptionJob(session, self._ev3, msg_id, name, attr, period_ms))
+
+    #
+    # Handle telemetry subscribe message. Like a subscription, but samples
+    # are sent as datagrams to the given UDP port on the client's address.
+    # Telemetry subscriptions are cancelled with the unsubscribe message.
+    #
+    def handle_tsub(self, session, msg_id, args):
+        name      = args[0]
+        attr      = args[1]
+        period_ms = int(args[2])
+        address   = (session.connection.remote_address[0], int(args[3]))
+        session.add_job(msg_id, TelemetryJob(self._telemetry, address, self._ev3, msg_id, name, attr, period_ms))
+
+    #
+    # Handle history subscribe message. Samples the attribute at a fixed rate
+    # into a ring buffer of the given capacity, which the client fetches with
+    # the history message. Samplers are stopped with the unsubscribe message.
+    #
+    def handle_hsub(self, session, msg_id, args):
+        name      = args[0]
+        attr      = args[1]
+        period_ms = int(args[2])
+        capacity  = min(int(args[3]), SamplerJob.MAX_CAPACITY)
+        if capacity < 1:
+            raise ValueError('Invalid capacity ' + str(capacity))
+        session.add_job(msg_id, SamplerJob(self._ev3, name, attr, period_ms, capacity))
+
+    #
+    # Handle history message. The arguments are the id of the sampler and
+    # the sequence number to read from. Responds with the sequence number of
+    # the first sample read, the number of samples recorded, and the samples
+    # as a chunk, or with nothing if there is no such sampler. The text
+    # protocol cannot carry raw bytes, so chunks are sent as hex there.
+    #
+    def handle_hist(self, session, msg_id, args):
+        job = session.get_job(int(args[0]))
+        if not isinstance(job, SamplerJob):
+            session.send(msg_id, 'ret')
+            return
+        first, timestamps, values = job.ring.read(int(args[1]))
+        chunk = encode_chunk(timestamps, values)
+        if not isinstance(session.connection.codec, BinaryCodec):
+            chunk = chunk.hex()
+        session.send(msg_id, 'ret', first, job.ring.count, chunk)
+
+    #
+    # Handle share message. Allocates a slot in the shared memory table, which
+    # is updated with the attribute periodically. Responds with the name of
+    # the table and the slot, or an empty name if shared memory cannot be
+    # used. Shared attributes are released with the unsubscribe message.
+    #
+    def handle_share(self, session, msg_id, args):
+
+        name      = args[0]
+        attr      = args[1]
+        period_ms = int(args[2])
+
+        # Create the table on first use
+        if self._shared is None and HAVE_SHARED_MEMORY:
+            try:
+                self._shared = SharedTable()
+            except OSError as ex:
+                Trace.Warning('Cannot create shared memory', ex)
+
+        # Allocate a slot, and fill it before responding
+        slot = self._shared.allocate() if self._shared is not None else None
+        if slot is None:
+            session.send(msg_id, 'ret', '')
+            return
+        job = SharedJob(self._shared, slot, self._ev3, name, attr, period_ms)
+        job.run(monotonic())
+        session.add_job(msg_id, job)
+        session.send(msg_id, 'ret', self._shared.name, slot)
+
+    #
+    # Handle resume message. The argument is the token of a session to
+    # resume, or empty for a new one. Continues the detached session with
+    # that token if its grace period has not ended, keeping its jobs and
+    # devices. Responds with the session's token and whether it was resumed.
+    #
+    def handle_resume(self, session, msg_id, args):
+
+        # Find the session, which may still be connected if the server did
+        # not notice yet that the client's connection was lost
+        token = args[0] if args else ''
+        previous = None
+        if token:
+            detached = self._detached.pop(token, None)
+            if detached is not None:
+                previous = detached[0]
+            else:
+                previous = next((other for other in self._sessions if other is not session and other.token == token), None)
+                if previous is not None:
+                    previous.connection.close()
+
+        # Continue the previous session, or start a new one
+        if previous is not None:
+            session.adopt(previous)
+            Trace.Info('Resumed session', session.token)
+        else:
+            session.token = token_hex(8)
+        session.send(msg_id, 'ret', session.token, 1 if previous is not None else 0)
+
+    #
+    # Handle end message. The client is closing the connection deliberately,
+    # so its session is dropped right away instead of being kept to resume.
+    #
+    def handle_end(self, session, msg_id, args):
+        session.token = None
+
+    #
+    # Handle unsubscribe message, the argument is the id of the subscription
+    #
+    def handle_unsub(self, session, msg_id, args):
+        session.remove_job(int(args[0]))
+
+    #
+    # Handle wait message. Responds once the condition holds, or the timeout
+    # in ms expires.
+    #
+    def handle_wait(self, session, msg_id, args):
+        name = args[0]
+        try:
+            condition   = Condition(args[1], args[2])
+            timeout_ms  = int(args[3])
+        except (TypeError, ValueError) as ex:
+            Trace.Warning('Invalid wait', args, ex)
+            session.send(msg_id, 'ret', 0)
+            return
+        session.add_job(msg_id, WaitJob(session, self._ev3, msg_id, name, condition, timeout_ms))
+
+    #
+    # Handle ping message, responds with the server clock
+    #
+    def handle_ping(self, session, msg_id, args):
+        session.send(msg_id, 'ret', time())
+
+    #
+    # Handle scheduled set message. The first argument is the time at which to
+    # apply the sets, in seconds since the epoch on the server clock; the
+    # rest are name, attribute and value triplets.
+    #
+    def handle_at(self, session, msg_id, args):
+        sets = [(args[i], args[i + 1], args[i + 2]) for i in range(1, len(args) - 2, 3)]
+        for name, _, _ in sets:
+            session.touch(name)
+        due = monotonic() + float(args[0]) - time()
+        session.add_job(msg_id, ScheduledJob(self._ev3, due, sets))
+
+    #
+    # Close a session
+    #
+    def close_session(self, session):
+        session.clear_jobs()
+        self._sessions.discard(session)
+
+    #
+    # Detach a session from its connection, so that the client can resume it
+    # during the grace period. Returns False for sessions without a token.
+    #
+    def detach_session(self, session):
+        self._sessions.discard(session)
+        if session.token is None:
+            return False
+        self._detached[session.token] = (session, monotonic() + Server.RESUME_GRACE)
+        return True
+
+    #
+    # Drop detached sessions whose grace period has ended, and stop the motors
+    # they touched. Returns the time in seconds until the next one ends, or
+    # None if there are none.
+    #
+    def __expire_sessions(self):
+
+        now = monotonic()
+        next_expiry = None
+        for token, (session, expiry) in list(self._detached.items()):
+            if expiry <= now:
+                Trace.Info('Session expired', token)
+                del self._detached[token]
+                session.clear_jobs()
+                self.reset(session.devices)
+            elif next_expiry is None or expiry < next_expiry:
+                next_expiry = expiry
+
+        return None if next_expiry is None else next_expiry - now
+
     #
     # Reset the ev3
-    # - Stop motors
+    # - Stop motors, either all of them or only those in the list of names
     #
-    def reset(self):
+    def reset(self, names = None):
         for output in EV3.OUTPUTS:
             device = Device('tacho-motor', output, None, self._ev3)
-            if not device.name is None and 'motor' in device.driver_name:
+            if device.name is None or (names is not None and not device.name in names):
+                continue
+            if 'motor' in device.driver_name:
                 Trace.Info('Stopping motor', output)
                 device.command = 'stop'
 
+
+################################################################################
+#
+# Class representing the server side state of a single connection
+#
+class Session:
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_connection',
+        '_jobs',
+        '_devices',
+        '_jobs_changed',
+        '_token'
+    ]
+
+    #
+    # Construction
+    #
+    def __init__(self, connection):
+        self._connection    = connection
+        self._jobs          = {}
+        self._devices       = set()
+        self._jobs_changed  = None
+        self._token         = None
+
+    #
+    # Connection, and names of the devices that were written to
+    #
+    connection  = property(fget = lambda self : self._connection)
+    devices     = property(fget = lambda self : self._devices)
+
+    #
+    # Token the client can resume the session with, None if it cannot
+    #
+    def __set_token(self, token):
+        self._token = token
+    token = property(fget = lambda self : self._token, fset = __set_token)
+
+    #
+    # Take over the jobs, devices and token of another session, leaving it
+    # with nothing to clean up
+    #
+    def adopt(self, session):
+        self._token = session._token
+        self._devices |= session._devices
+        for msg_id, job in session._jobs.items():
+            job.resume(self)
+            self.add_job(msg_id, job)
+        session._token   = None
+        session._devices = set()
+        session._jobs    = {}
+
+    #
+    # Send a message to the client
+    #
+    def send(self, msg_id, op, *args):
+        self._connection.send(msg_id, op, *args)
+
+    #
+    # Record that a device was written to
+    #
+    def touch(self, name):
+        self._devices.add(name)
+
+    #
+    # Add a job, keyed by the id of the request that created it
+    #
+    def add_job(self, msg_id, job):
+        previous = self._jobs.get(msg_id)
+        if previous is not None and previous is not job:
+            previous.close()
+        self._jobs[msg_id] = job
+        if self._jobs_changed is not None:
+            self._jobs_changed.set()
+
+    #
+    # Get a job by the id of the request that created it, or None
+    #
+    def get_job(self, msg_id):
+        return self._jobs.get(msg_id)
+
+    #
+    # Remove a job
+    #
+    def remove_job(self, msg_id):
+        job = self._jobs.pop(msg_id, None)
+        if job is not None:
+            job.close()
+
+    #
+    # Remove all jobs
+    #
+    def clear_jobs(self):
+        jobs, self._jobs = self._jobs, {}
+        for job in jobs.values():
+            job.close()
+
+    #
+    # Run all jobs that are due. Returns the time in seconds until the next
+    # job is due, or None if there are no jobs.
+    #
+    def run_jobs(self):
+
+        if not self._jobs:
+            return None
+
+        now = monotonic()
+        next_due = None
+        for msg_id, job in list(self._jobs.items()):
+
+            # Run job if due, and drop it when finished
+            if job.due <= now and not job.run(now):
+                del self._jobs[msg_id]
+                job.close()
+                continue
+
+            # Track the earliest due time
+            if next_due is None or job.due < next_due:
+                next_due = job.due
+
+        return None if next_due is None else max(0, next_due - monotonic())
+
+    #
+    # Run jobs as they become due, for the asyncio mode
+    #
+    async def run_jobs_async(self):
+
+        self._jobs_changed = asyncio.Event()
+        while True:
+
+            # Run jobs and flush what they sent
+            timeout = self.run_jobs()
+            await self._connection.drain()
+
+            # Wait until the next job is due, or jobs were added
+            self._jobs_changed.clear()
+            try:
+                await asyncio.wait_for(self._jobs_changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+################################################################################
+#
+# Job base class. A job runs on the server's main loop whenever it is due.
+#
+class Job:
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_due'
+    ]
+
+    #
+    # Construction
+    #
+    def __init__(self, due):
+        self._due = due
+
+    #
+    # Time at which the job is due, as returned by time.monotonic
+    #
+    due = property(fget = lambda self : self._due)
+
+    #
+    # Run the job. Returns whether the job should be kept.
+    #
+    def run(self, now):
+        return False
+
+    #
+    # Continue the job in another session, after the client resumed
+    #
+    def resume(self, session):
+        pass
+
+    #
+    # Release resources held by the job, called when it is removed
+    #
+    def close(self):
+        pass
+
+
+################################################################################
+#
+# Job base class for jobs that take a sample every period
+#
+class PeriodicJob(Job):
+
+    #
+    # Minimum sampling period
+    #
+    MIN_PERIOD_MS = 1
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_period'
+    ]
+
+    #
+    # Construction, the first sample is due immediately
+    #
+    def __init__(self, period_ms):
+        super(PeriodicJob, self).__init__(monotonic())
+        self._period = max(period_ms, PeriodicJob.MIN_PERIOD_MS) / 1000
+
+    #
+    # Take a sample, and schedule the next one
+    #
+    def run(self, now):
+        self.sample(now)
+        self.schedule(now)
+        return True
+
+    #
+    # Take a sample
+    #
+    def sample(self, now):
+        pass
+
+    #
+    # Schedule next sample, skipping samples that were missed
+    #
+    def schedule(self, now):
+        self._due += self._period
+        if self._due < now:
+            self._due = now + self._period
+
+
+################################################################################
+#
+# Job that samples an attribute, and pushes it to the client when it changes
+#
+class SubscriptionJob(PeriodicJob):
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_session',
+        '_ev3',
+        '_msg_id',
+        '_name',
+        '_attr',
+        '_value',
+        '_first'
+    ]
+
+    #
+    # Construction
+    #
+    def __init__(self, session, ev3, msg_id, name, attr, period_ms):
+        super(SubscriptionJob, self).__init__(period_ms)
+        self._session    = session
+        self._ev3        = ev3
+        self._msg_id     = msg_id
+        self._name       = name
+        self._attr       = attr
+        self._value      = None
+        self._first      = True
+
+    #
+    # Continue in another session, pushing the current value again in case
+    # changes were missed while disconnected
+    #
+    def resume(self, session):
+        self._session   = session
+        self._first     = True
+
+    #
+    # Sample the attribute, and push it if it changed
+    #
+    def sample(self, now):
+        value = self._ev3.get_attribute(self._name, self._attr)
+        if self._first or value != self._value:
+            self._first = False
+            self._value = value
+            self._session.send(self._msg_id, 'push', value)
+
+
+################################################################################
+#
+# Job that checks a condition, and responds once it holds or times out
+#
+class WaitJob(Job):
+
+    #
+    # Checking period
+    #
+    PERIOD = 0.001
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_session',
+        '_ev3',
+        '_msg_id',
+        '_name',
+        '_condition',
+        '_deadline'
+    ]
+
+    #
+    # Construction, a timeout of 0 waits indefinitely
+    #
+    def __init__(self, session, ev3, msg_id, name, condition, timeout_ms):
+        super(WaitJob, self).__init__(monotonic())
+        self._session    = session
+        self._ev3        = ev3
+        self._msg_id     = msg_id
+        self._name       = name
+        self._condition  = condition
+        self._deadline   = self._due + timeout_ms / 1000 if timeout_ms > 0 else None
+
+    #
+    # Continue in another session
+    #
+    def resume(self, session):
+        self._session = session
+
+    #
+    # Check the condition
+    #
+    def run(self, now):
+
+        # Respond when the condition holds, and give up when the attribute
+        # cannot be read, for instance because the motor was unplugged
+        try:
+            if self._condition.check(self._ev3.get_attribute(self._name, self._condition.attribute)):
+                self._session.send(self._msg_id, 'ret', 1)
+                return False
+        except (TypeError, ValueError):
+            self._session.send(self._msg_id, 'ret', 0)
+            return False
+
+        # Respond when timed out
+        if self._deadline is not None and now >= self._deadline:
+            self._session.send(self._msg_id, 'ret', 0)
+            return False
+
+        # Check again later
+        self._due = now + WaitJob.PERIOD
+        return True
+
+
+################################################################################
+#
+# Job that applies a list of sets at a scheduled time
+#
+class ScheduledJob(Job):
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_ev3',
+        '_sets'
+    ]
+
+    #
+    # Construction
+    #
+    def __init__(self, ev3, due, sets):
+        super(ScheduledJob, self).__init__(due)
+        self._ev3   = ev3
+        self._sets  = sets
+
+    #
+    # Apply the sets in order
+    #
+    def run(self, now):
+        for name, attr, value in self._sets:
+            self._ev3.set_attribute(name, attr, value)
+        return False
+
+
+################################################################################
+#
+# Job that samples an attribute periodically and sends every sample as a
+# telemetry datagram. Unlike SubscriptionJob, unchanged values are sent too,
+# so that a lost datagram is made up for by the next one.
+#
+class TelemetryJob(PeriodicJob):
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_sender',
+        '_address',
+        '_ev3',
+        '_sub_id',
+        '_name',
+        '_attr',
+        '_seq'
+    ]
+
+    #
+    # Construction
+    #
+    def __init__(self, sender, address, ev3, sub_id, name, attr, period_ms):
+        super(TelemetryJob, self).__init__(period_ms)
+        self._sender    = sender
+        self._address   = address
+        self._ev3       = ev3
+        self._sub_id    = sub_id
+        self._name      = name
+        self._attr      = attr
+        self._seq       = 0
+
+    #
+    # Sample the attribute and send it
+    #
+    def sample(self, now):
+        value = self._ev3.get_attribute(self._name, self._attr)
+        self._sender.send(self._address, self._sub_id, self._seq, time(), value)
+        self._seq += 1
+
+
+################################################################################
+#
+# Job that samples an attribute periodically into a shared memory slot
+#
+class SharedJob(PeriodicJob):
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_table',
+        '_slot',
+        '_ev3',
+        '_name',
+        '_attr'
+    ]
+
+    #
+    # Construction
+    #
+    def __init__(self, table, slot, ev3, name, attr, period_ms):
+        super(SharedJob, self).__init__(period_ms)
+        self._table     = table
+        self._slot      = slot
+        self._ev3       = ev3
+        self._name      = name
+        self._attr      = attr
+
+    #
+    # Sample the attribute into the slot
+    #
+    def sample(self, now):
+        self._table.write(self._slot, self._ev3.get_attribute(self._name, self._attr))
+
+    #
+    # Release the slot
+    #
+    def close(self):
+        self._table.release(self._slot)
+
+
+################################################################################
+#
+# Job that samples an integer attribute at a fixed rate into a ring buffer,
+# with the server clock at each sample. Samples that cannot be read or parsed
+# are skipped.
+#
+class SamplerJob(PeriodicJob):
+
+    #
+    # Maximum number of samples kept
+    #
+    MAX_CAPACITY = 1 << 20
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_ring',
+        '_read',
+        '_name',
+        '_attr'
+    ]
+
+    #
+    # Construction
+    #
+    def __init__(self, ev3, name, attr, period_ms, capacity):
+        super(SamplerJob, self).__init__(period_ms)
+        self._ring      = SampleRing(capacity)
+        self._read      = getattr(ev3, 'get_attribute_int', None) or (lambda name, attr : int(ev3.get_attribute(name, attr)))
+        self._name      = name
+        self._attr      = attr
+
+    #
+    # Recorded samples
+    #
+    ring = property(fget = lambda self : self._ring)
+
+    #
+    # Sample the attribute
+    #
+    def sample(self, now):
+        try:
+            value = self._read(self._name, self._attr)
+            if value is not None:
+                self._ring.append(time(), value)
+        except (TypeError, ValueError):
+            pass
+
+    #
+    # Schedule next sample on the same grid, skipping samples that were missed
+    #
+    def schedule(self, now):
+        self._due += self._period
+        if self._due < now:
+            self._due += ((now - self._due) // self._period + 1) * self._period
+
+
 #
 # Run server as script
 #
 if __name__ == "__main__":
 
+    # Parse command line
+    parser = ArgumentParser(description = 'ev3-net server')
+    parser.add_argument('--address', default = '0.0.0.0', help = 'address to listen on')
+    parser.add_argument('--port', type = int, default = Connection.DEFAULT_PORT, help = 'port to listen on')
+    parser.add_argument('--unix', default = None,
+                        help = 'Unix domain socket to listen on for clients on the same host, empty to disable; defaults to a path derived from the port')
+    parser.add_argument('--max-handles', type = int, default = HandleCache.DEFAULT_MAX_HANDLES,
+                        help = 'maximum number of attribute files kept open')
+    parser.add_argument('--sysfs-root', default = LocalEV3.DEFAULT_ROOT,
+                        help = 'directory holding the device classes, for instance a tree made by sysfs.py')
+    parser.add_argument('--mode', choices = ('sync', 'async'), default = 'sync',
+                        help = 'serve one client at a time, or many concurrently using asyncio')
+    args = parser.parse_args()
+    if args.unix is None:
+        args.unix = Connection.get_unix_path(args.port) if Connection.HAVE_UNIX else ''
+
     # Set trace level
     #Trace.level = Trace.TRACE_LEVEL_VERBOSE
 
@@ -138,7 +1117,10 @@ if __name__ == "__main__":
     Trace.Info('Starting ev3-net server...')
     
     # Create server instance
-    server = Server()
+    server = Server(LocalEV3(args.max_handles, args.sysfs_root))
 
     # Run server main loop
-    server.main()
\ No newline at end of file
+    if args.mode == 'async':
+        asyncio.run(server.main_async(args.address, args.port, args.unix))
+    else:
+        server.main(args.address, args.port, args.unix)
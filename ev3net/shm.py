@@ -0,0 +1,175 @@
+import atexit
+from struct import Struct
+from sys import version_info
+
+#
+# Shared memory is not available before Python 3.8
+#
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    shared_memory = None
+
+HAVE_SHARED_MEMORY = shared_memory is not None
+
+################################################################################
+#
+# Class representing a table of attribute values in shared memory
+#
+# Lets clients on the same host read attributes without a round trip to the
+# server. The server samples each shared attribute periodically and writes it
+# to a fixed-size slot; clients map the table and read the slot directly.
+#
+# Each slot is protected by a sequence lock: the writer makes the sequence
+# number odd while it updates the slot, and even again when done. Readers
+# retry until they see the same even sequence number before and after copying
+# the value. There is a single writer, so writers need no lock.
+#
+class SharedTable:
+
+    #
+    # Slot layout: sequence number and value length, followed by the value
+    #
+    HEADER      = Struct('<IH')
+    SLOT_SIZE   = 64
+    VALUE_SIZE  = SLOT_SIZE - HEADER.size
+
+    #
+    # Length written for values that do not fit in a slot
+    #
+    TOO_LONG    = 0xFFFF
+
+    #
+    # Default number of slots
+    #
+    DEFAULT_SLOTS = 256
+
+    #
+    # Names of the tables created by this process
+    #
+    __owned_names = set()
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_memory',
+        '_buffer',
+        '_owner',
+        '_free'
+    ]
+
+    #
+    # Construction. Creates a new table when no name is given, otherwise
+    # attaches to the existing table with that name.
+    #
+    def __init__(self, name = None, slots = DEFAULT_SLOTS):
+
+        if not HAVE_SHARED_MEMORY:
+            raise ValueError('Shared memory is not available')
+
+        if name is None:
+            self._memory = shared_memory.SharedMemory(create = True, size = slots * SharedTable.SLOT_SIZE)
+            self._owner  = True
+            self._free   = list(range(slots - 1, -1, -1))
+            SharedTable.__owned_names.add(self._memory.name)
+        else:
+            self._memory = SharedTable.__attach(name)
+            self._owner  = False
+            self._free   = []
+
+        self._buffer = self._memory.buf
+        if self._owner:
+            self._buffer[:] = bytes(len(self._buffer))
+            atexit.register(self.close)
+
+    #
+    # Attach to an existing block, without letting this process' resource
+    # tracker remove it on exit unless this process created it
+    #
+    @staticmethod
+    def __attach(name):
+        if name in SharedTable.__owned_names:
+            return shared_memory.SharedMemory(name)
+        if version_info >= (3, 13):
+            return shared_memory.SharedMemory(name, track = False)
+        memory = shared_memory.SharedMemory(name)
+        try:
+            resource_tracker.unregister(memory._name, 'shared_memory')
+        except Exception:
+            pass
+        return memory
+
+    #
+    # Name to attach to the table with
+    #
+    name = property(fget = lambda self : self._memory.name)
+
+    #
+    # Allocate a slot, returns None if the table is full
+    #
+    def allocate(self):
+        if not self._free:
+            return None
+        slot = self._free.pop()
+        SharedTable.HEADER.pack_into(self._buffer, slot * SharedTable.SLOT_SIZE, 0, 0)
+        return slot
+
+    #
+    # Return a slot to the table
+    #
+    def release(self, slot):
+        self._free.append(slot)
+
+    #
+    # Write a value to a slot
+    #
+    def write(self, slot, value):
+
+        data = value if isinstance(value, bytes) else str(value).encode('utf-8')
+        offset = slot * SharedTable.SLOT_SIZE
+        seq, _ = SharedTable.HEADER.unpack_from(self._buffer, offset)
+
+        # Mark the slot as being written, then write the value and mark it
+        # done. Sequence number zero is reserved for slots never written.
+        SharedTable.HEADER.pack_into(self._buffer, offset, seq + 1, 0)
+        done = (seq + 2) & 0xFFFFFFFF or 2
+        if len(data) <= SharedTable.VALUE_SIZE:
+            start = offset + SharedTable.HEADER.size
+            self._buffer[start:start + len(data)] = data
+            SharedTable.HEADER.pack_into(self._buffer, offset, done, len(data))
+        else:
+            SharedTable.HEADER.pack_into(self._buffer, offset, done, SharedTable.TOO_LONG)
+
+    #
+    # Read the value in a slot. Returns None if the slot was never written,
+    # or holds a value that does not fit.
+    #
+    def read(self, slot):
+
+        offset = slot * SharedTable.SLOT_SIZE
+        start  = offset + SharedTable.HEADER.size
+        while True:
+
+            # Wait for the writer to finish
+            seq, length = SharedTable.HEADER.unpack_from(self._buffer, offset)
+            if seq & 1:
+                continue
+
+            # Copy the value, and keep it if the slot did not change meanwhile
+            data = bytes(self._buffer[start:start + length]) if length <= SharedTable.VALUE_SIZE else None
+            if SharedTable.HEADER.unpack_from(self._buffer, offset)[0] == seq:
+                return None if seq == 0 or data is None else data.decode('utf-8')
+
+    #
+    # Unmap the table, and remove it if this process created it
+    #
+    def close(self):
+        if self._buffer is None:
+            return
+        self._buffer = None
+        self._memory.close()
+        if self._owner:
+            self._memory.unlink()
+            atexit.unregister(self.close)
+            SharedTable.__owned_names.discard(self._memory.name)
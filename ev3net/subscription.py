@@ -0,0 +1,167 @@
+from collections import deque
+from threading import Condition, Thread
+from time import monotonic
+from trace import Trace
+
+################################################################################
+#
+# Class representing a subscription to an attribute
+#
+# Receives updates whenever the value of the attribute changes. Updates are
+# passed to the callback, if any, and can also be consumed in order using
+# next(), or by iterating over the subscription. Use as a context manager to
+# cancel the subscription when done.
+#
+class Subscription:
+
+    #
+    # Maximum number of unconsumed updates kept, older ones are dropped
+    #
+    MAX_QUEUED = 256
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_callback',
+        '_cancel',
+        '_queue',
+        '_value',
+        '_closed',
+        '_cond'
+    ]
+
+    #
+    # Construction. The cancel function is invoked once when the subscription
+    # is cancelled by the user.
+    #
+    def __init__(self, callback = None, cancel = None):
+        self._callback  = callback
+        self._cancel    = cancel
+        self._queue     = deque(maxlen = Subscription.MAX_QUEUED)
+        self._value     = None
+        self._closed    = False
+        self._cond      = Condition()
+
+    #
+    # Most recently received value
+    #
+    value = property(fget = lambda self : self._value)
+
+    #
+    # Whether the subscription has ended
+    #
+    closed = property(fget = lambda self : self._closed)
+
+    #
+    # Deliver an update. Updates arrive on the connection's reader thread,
+    # which must survive a callback that raises.
+    #
+    def push(self, value):
+        with self._cond:
+            self._value = value
+            self._queue.append(value)
+            self._cond.notify_all()
+        if self._callback is not None:
+            try:
+                self._callback(value)
+            except Exception as ex:
+                Trace.Warning('Subscription callback failed', ex)
+
+    #
+    # End the subscription, without notifying the source
+    #
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    #
+    # Cancel the subscription
+    #
+    def cancel(self):
+        if self._closed:
+            return
+        self.close()
+        if self._cancel is not None:
+            self._cancel()
+
+    #
+    # Get the next update. Returns (True, value), or (False, None) when the
+    # timeout in seconds expires or the subscription has ended.
+    #
+    def next(self, timeout = None):
+        with self._cond:
+            deadline = None if timeout is None else monotonic() + timeout
+            while not self._queue:
+                if self._closed:
+                    return False, None
+                remaining = None if deadline is None else deadline - monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False, None
+                self._cond.wait(remaining)
+            return True, self._queue.popleft()
+
+    #
+    # Iterate over updates until the subscription ends
+    #
+    def __iter__(self):
+        while True:
+            result, value = self.next()
+            if not result:
+                return
+            yield value
+
+    #
+    # Context manager support
+    #
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.cancel()
+
+
+################################################################################
+#
+# Subscription that samples an attribute from a background thread. Used by
+# EV3 instances that have no way to push updates themselves.
+#
+class PollingSubscription(Subscription):
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_thread'
+    ]
+
+    #
+    # Construction
+    #
+    def __init__(self, ev3, name, attribute, period_ms, callback = None):
+        super(PollingSubscription, self).__init__(callback)
+        self._thread = Thread(target = self.__sample, args = (ev3, name, attribute, period_ms / 1000), daemon = True)
+        self._thread.start()
+
+    #
+    # Sampling thread
+    #
+    def __sample(self, ev3, name, attribute, period):
+
+        value     = None
+        first     = True
+        next_time = monotonic()
+        while not self._closed:
+
+            # Push the value if it changed
+            sample = ev3.get_attribute(name, attribute)
+            if first or sample != value:
+                first = False
+                value = sample
+                self.push(value)
+
+            # Sleep until the next sample is due
+            next_time += period
+            with self._cond:
+                self._cond.wait(max(0, next_time - monotonic()))
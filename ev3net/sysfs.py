@@ -0,0 +1,229 @@
+import os
+import shutil
+import stat
+import tempfile
+from argparse import ArgumentParser
+from struct import pack
+from bindata import FORMATS
+from motor import Motor
+
+################################################################################
+#
+# Class representing an emulated ev3dev sysfs tree
+#
+# Builds the tacho-motor and lego-sensor class directories of a brick in a
+# directory, with the same files and permissions as ev3dev. A LocalEV3 with
+# its root pointing at the tree goes through the same stat, open and read
+# path as on a brick, so that path can be measured on any Linux machine:
+#
+#   with SysfsTree() as tree:
+#       tree.add_motor('outA')
+#       server = Server(LocalEV3(root = tree.root))
+#
+# Nothing drives the devices: values only change when written, either by a
+# client or through set_attribute.
+#
+class SysfsTree:
+
+    #
+    # File permissions
+    #
+    READ_ONLY   = 0o444
+    READ_WRITE  = 0o664
+    WRITE_ONLY  = 0o220
+
+    #
+    # Attributes of a motor, with their initial value and permissions
+    #
+    MOTOR_ATTRIBUTES = [
+        ('command',         '',                                 WRITE_ONLY),
+        ('commands',        ' '.join(Motor.COMMANDS),           READ_ONLY),
+        ('count_per_rot',   360,                                READ_ONLY),
+        ('duty_cycle',      0,                                  READ_ONLY),
+        ('duty_cycle_sp',   0,                                  READ_WRITE),
+        ('max_speed',       1560,                               READ_ONLY),
+        ('polarity',        'normal',                           READ_WRITE),
+        ('position',        0,                                  READ_WRITE),
+        ('position_sp',     0,                                  READ_WRITE),
+        ('ramp_down_sp',    0,                                  READ_WRITE),
+        ('ramp_up_sp',      0,                                  READ_WRITE),
+        ('speed',           0,                                  READ_ONLY),
+        ('speed_sp',        0,                                  READ_WRITE),
+        ('state',           '',                                 READ_ONLY),
+        ('stop_action',     'coast',                            READ_WRITE),
+        ('stop_actions',    'coast brake hold',                 READ_ONLY),
+        ('time_sp',         0,                                  READ_WRITE)
+    ]
+
+    #
+    # Size of bin_data. The driver exposes its whole raw data buffer, of
+    # which only the first num_values values are valid.
+    #
+    BIN_DATA_SIZE = 32
+
+    #
+    # Modes of the sensors that can be added, the first is the initial mode
+    #
+    SENSOR_MODES = {
+        'lego-ev3-color'    : ['COL-REFLECT', 'COL-AMBIENT', 'COL-COLOR', 'REF-RAW', 'RGB-RAW', 'COL-CAL'],
+        'lego-ev3-gyro'     : ['GYRO-ANG', 'GYRO-RATE', 'GYRO-FAS', 'GYRO-G&A', 'GYRO-CAL', 'TILT-RATE', 'TILT-ANG'],
+        'lego-ev3-touch'    : ['TOUCH'],
+        'lego-ev3-us'       : ['US-DIST-CM', 'US-DIST-IN', 'US-LISTEN', 'US-SI-CM', 'US-SI-IN', 'US-DC-CM', 'US-DC-IN'],
+        'lego-nxt-us'       : ['US-DIST-CM', 'US-DIST-IN', 'US-SI-CM', 'US-SI-IN', 'US-LISTEN']
+    }
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_root',
+        '_owned',
+        '_motors',
+        '_sensors'
+    ]
+
+    #
+    # Construction. Builds the tree in a new temporary directory, which is
+    # removed on close, unless a root is given.
+    #
+    def __init__(self, root = None):
+        self._owned     = root is None
+        self._root      = os.path.join(tempfile.mkdtemp(prefix = 'ev3net-sysfs-') if root is None else root, '')
+        self._motors    = 0
+        self._sensors   = 0
+        for class_name in ('tacho-motor', 'lego-sensor'):
+            os.makedirs(self._root + class_name, exist_ok = True)
+
+    #
+    # Directory holding the device classes, to pass to LocalEV3
+    #
+    root = property(fget = lambda self : self._root)
+
+    #
+    # Add a motor to an output port, returns its device name
+    #
+    def add_motor(self, port, driver_name = 'lego-ev3-l-motor'):
+
+        name = 'tacho-motor/motor' + str(self._motors)
+        self._motors += 1
+
+        self.__add_device(name, port, driver_name)
+        for attribute, value, mode in SysfsTree.MOTOR_ATTRIBUTES:
+            self.__write(name, attribute, value, mode)
+        return name
+
+    #
+    # Add a sensor to an input port, returns its device name. The values are
+    # written to valueN and to bin_data in the given format.
+    #
+    def add_sensor(self, port, driver_name = 'lego-ev3-gyro', values = (0,), format = 's16', decimals = 0):
+
+        name = 'lego-sensor/sensor' + str(self._sensors)
+        self._sensors += 1
+
+        modes = SysfsTree.SENSOR_MODES.get(driver_name, [''])
+        self.__add_device(name, port, driver_name)
+        self.__write(name, 'mode',              modes[0],           SysfsTree.READ_WRITE)
+        self.__write(name, 'modes',             ' '.join(modes),    SysfsTree.READ_ONLY)
+        self.__write(name, 'decimals',          decimals,           SysfsTree.READ_ONLY)
+        self.__write(name, 'units',             '',                 SysfsTree.READ_ONLY)
+        self.__write(name, 'poll_ms',           10,                 SysfsTree.READ_WRITE)
+        self.__write(name, 'bin_data_format',   format,             SysfsTree.READ_ONLY)
+        self.set_values(name, values)
+        return name
+
+    #
+    # Add the devices of a typical build: two large motors and a medium motor,
+    # a gyro, a color sensor and a touch sensor
+    #
+    def add_default_devices(self):
+        self.add_motor('outA', 'lego-ev3-l-motor')
+        self.add_motor('outB', 'lego-ev3-l-motor')
+        self.add_motor('outC', 'lego-ev3-m-motor')
+        self.add_sensor('in1', 'lego-ev3-gyro')
+        self.add_sensor('in2', 'lego-ev3-color', format = 's8')
+        self.add_sensor('in3', 'lego-ev3-touch', format = 's8')
+
+    #
+    # Set the values of a sensor. bin_data is padded to its full size, like
+    # the driver's buffer.
+    #
+    def set_values(self, name, values):
+
+        format = self.get_attribute(name, 'bin_data_format')
+        code   = FORMATS[format]
+        data   = pack(code[0] + str(len(values)) + code[1], *values)
+        self.__write(name, 'num_values', len(values), SysfsTree.READ_ONLY)
+        self.__write(name, 'bin_data', data.ljust(SysfsTree.BIN_DATA_SIZE, b'\0'), SysfsTree.READ_ONLY)
+        for index, value in enumerate(values):
+            self.__write(name, 'value' + str(index), value, SysfsTree.READ_ONLY)
+
+    #
+    # Get an attribute, as the device would show it
+    #
+    def get_attribute(self, name, attribute):
+        with open(self._root + name + '/' + attribute) as f:
+            return f.read().strip()
+
+    #
+    # Set an attribute as the device would, for instance to simulate a motor
+    # moving. Keeps the attribute's permissions.
+    #
+    def set_attribute(self, name, attribute, value):
+        path = self._root + name + '/' + attribute
+        self.__write(name, attribute, value, stat.S_IMODE(os.stat(path).st_mode))
+
+    #
+    # Remove a device, as if it were unplugged
+    #
+    def remove(self, name):
+        shutil.rmtree(self._root + name)
+
+    #
+    # Remove the tree, if it was created by this object
+    #
+    def close(self):
+        if self._owned and os.path.exists(self._root):
+            shutil.rmtree(self._root)
+
+    #
+    # Context manager support
+    #
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    #
+    # Create a device directory with the attributes all devices have
+    #
+    def __add_device(self, name, port, driver_name):
+        os.makedirs(self._root + name)
+        self.__write(name, 'address',       'ev3-ports:' + port,    SysfsTree.READ_ONLY)
+        self.__write(name, 'driver_name',   driver_name,            SysfsTree.READ_ONLY)
+
+    #
+    # Write an attribute file. Text values end in a newline, like in sysfs.
+    #
+    def __write(self, name, attribute, value, mode):
+        path = self._root + name + '/' + attribute
+        data = value if isinstance(value, bytes) else (str(value) + '\n').encode()
+        if os.path.exists(path):
+            os.chmod(path, mode | stat.S_IWUSR)
+        with open(path, 'wb') as f:
+            f.write(data)
+        os.chmod(path, mode)
+
+
+#
+# Build a tree as script, for the server's --sysfs-root
+#
+if __name__ == "__main__":
+
+    parser = ArgumentParser(description = 'Build an emulated ev3dev sysfs tree')
+    parser.add_argument('root', help = 'directory to build the tree in')
+    args = parser.parse_args()
+
+    SysfsTree(args.root).add_default_devices()
+    print(os.path.abspath(args.root))
@@ -0,0 +1,213 @@
+from random import random
+from socket import socket, AF_INET, SOCK_DGRAM, SHUT_RDWR
+from struct import Struct
+from threading import Lock, Thread
+from trace import Trace
+
+################################################################################
+#
+# UDP side channel for high-rate telemetry
+#
+# Subscriptions over TCP deliver every change in order, so a single lost
+# packet holds back all newer samples until it is retransmitted. Telemetry
+# subscriptions instead send each sample as a separate datagram, numbered per
+# subscription. The receiver keeps only the newest sample, and drops any
+# datagram that arrives after a newer one. Commands always go over TCP.
+#
+# A datagram holds the subscription id, the sequence number, the server clock
+# at the time of sampling, and the value as UTF-8.
+#
+DATAGRAM = Struct('<IQd')
+
+#
+# Maximum datagram size
+#
+MAX_DATAGRAM = 1472
+
+
+################################################################################
+#
+# Class sending telemetry datagrams, used by the server
+#
+class TelemetrySender:
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_socket',
+        '_loss',
+        '_sent',
+        '_dropped'
+    ]
+
+    #
+    # Construction
+    #
+    def __init__(self):
+        self._socket    = socket(AF_INET, SOCK_DGRAM)
+        self._socket.setblocking(False)
+        self._loss      = 0.0
+        self._sent      = 0
+        self._dropped   = 0
+
+    #
+    # Fraction of datagrams to drop deliberately, to simulate a lossy network
+    #
+    def __set_loss(self, loss):
+        self._loss = loss
+    loss = property(fget = lambda self : self._loss, fset = __set_loss)
+
+    #
+    # Number of datagrams sent, and dropped by the simulated loss or because
+    # the socket buffer was full
+    #
+    sent    = property(fget = lambda self : self._sent)
+    dropped = property(fget = lambda self : self._dropped)
+
+    #
+    # Send a sample
+    #
+    def send(self, address, sub_id, seq, timestamp, value):
+
+        if self._loss and random() < self._loss:
+            self._dropped += 1
+            return
+
+        datagram = DATAGRAM.pack(sub_id, seq, timestamp) + str(value).encode('utf-8')
+        try:
+            self._socket.sendto(datagram[:MAX_DATAGRAM], address)
+            self._sent += 1
+        except (BlockingIOError, OSError):
+            self._dropped += 1
+
+    #
+    # Close the socket
+    #
+    def close(self):
+        self._socket.close()
+
+
+################################################################################
+#
+# Class receiving telemetry datagrams, used by the client
+#
+# Samples are pushed to the Subscription registered for their id, which
+# always holds the newest value.
+#
+class TelemetryReceiver:
+
+    #
+    # Members
+    #
+    __slots__ = [
+        '_socket',
+        '_port',
+        '_lock',
+        '_subscriptions',
+        '_sequences',
+        '_received',
+        '_stale',
+        '_lost',
+        '_closed',
+        '_thread'
+    ]
+
+    #
+    # Construction, binds to a free port on all interfaces
+    #
+    def __init__(self, address = '0.0.0.0'):
+        self._socket        = socket(AF_INET, SOCK_DGRAM)
+        self._socket.bind((address, 0))
+        self._port          = self._socket.getsockname()[1]
+        self._lock          = Lock()
+        self._subscriptions = {}
+        self._sequences     = {}
+        self._received      = 0
+        self._stale         = 0
+        self._lost          = 0
+        self._closed        = False
+        self._thread        = Thread(target = self.__receive, daemon = True)
+        self._thread.start()
+
+    #
+    # Port the server should send datagrams to
+    #
+    port = property(fget = lambda self : self._port)
+
+    #
+    # Number of samples delivered, dropped because a newer one had already
+    # arrived, and missing from the sequence
+    #
+    received    = property(fget = lambda self : self._received)
+    stale       = property(fget = lambda self : self._stale)
+    lost        = property(fget = lambda self : self._lost)
+
+    #
+    # Register a subscription to deliver samples to
+    #
+    def register(self, sub_id, subscription):
+        with self._lock:
+            self._subscriptions[sub_id] = subscription
+            self._sequences[sub_id] = -1
+
+    #
+    # Remove a subscription
+    #
+    def unregister(self, sub_id):
+        with self._lock:
+            self._sequences.pop(sub_id, None)
+            return self._subscriptions.pop(sub_id, None)
+
+    #
+    # Close the socket and all subscriptions
+    #
+    def close(self):
+        self._closed = True
+        try:
+            self._socket.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+        self._socket.close()
+        with self._lock:
+            subscriptions, self._subscriptions = self._subscriptions, {}
+            self._sequences.clear()
+        for subscription in subscriptions.values():
+            subscription.close()
+
+    #
+    # Receive thread
+    #
+    def __receive(self):
+
+        buffer = bytearray(MAX_DATAGRAM)
+        view   = memoryview(buffer)
+        while True:
+
+            try:
+                size = self._socket.recv_into(buffer)
+            except OSError:
+                break
+            if self._closed:
+                break
+            if size < DATAGRAM.size:
+                continue
+
+            # Find the subscription, and drop samples older than the newest
+            sub_id, seq, _ = DATAGRAM.unpack_from(buffer)
+            with self._lock:
+                subscription = self._subscriptions.get(sub_id)
+                if subscription is None:
+                    continue
+                last = self._sequences[sub_id]
+                if seq <= last:
+                    self._stale += 1
+                    continue
+                self._lost += seq - last - 1
+                self._sequences[sub_id] = seq
+                self._received += 1
+
+            try:
+                subscription.push(str(view[DATAGRAM.size:size], 'utf-8'))
+            except Exception as ex:
+                Trace.Warning('Telemetry callback failed', ex)
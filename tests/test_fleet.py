@@ -0,0 +1,77 @@
+#
+# Tests for fleets of bricks, against a server for a fake EV3 on the loopback
+# interface. Run with python -m unittest discover tests.
+#
+import os
+import sys
+import unittest
+from concurrent.futures import TimeoutError
+from random import randint
+from threading import Thread
+from time import sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'ev3net'))
+
+from trace import Trace
+from fake import FakeAttribute, FakeEV3, FakeMediumMotor
+from fleet import Fleet
+from remote import RemoteEV3
+from server import Server
+
+
+################################################################################
+#
+# Fake brick that takes a while to read the position
+#
+class SlowEV3(FakeEV3):
+
+    DELAY = 0.3
+
+    def get_attribute(self, name, attribute):
+        if attribute == 'position':
+            sleep(SlowEV3.DELAY)
+        return super(SlowEV3, self).get_attribute(name, attribute)
+
+
+################################################################################
+#
+# Bricks that respond after the fleet timed out
+#
+class TestLateResponse(unittest.TestCase):
+
+    #
+    # Start a server for a slow fake brick, and a fleet holding it
+    #
+    def setUp(self):
+        Trace.level = Trace.TRACE_LEVEL_ERROR
+        motor = FakeMediumMotor()
+        motor.add_attribute(FakeAttribute('position', '42'))
+        ev3 = SlowEV3()
+        ev3.add_motor(motor, 'outA')
+        port = randint(46000, 49000)
+        Thread(target = Server(ev3).main, args = ('127.0.0.1', port), daemon = True).start()
+        sleep(0.1)
+        self.remote = RemoteEV3('127.0.0.1', port)
+        self.fleet  = Fleet({ 'slow' : self.remote })
+
+    def tearDown(self):
+        self.fleet.close()
+        self.remote.close()
+
+    #
+    # A response that arrives after the timeout is dropped, and the brick
+    # keeps working
+    #
+    def test_brick_usable_after_late_response(self):
+
+        result = self.fleet.get_attribute('tacho-motor', 'outA', 'position', timeout = 0.1)
+        self.assertIsInstance(result.errors['slow'], TimeoutError)
+
+        sleep(SlowEV3.DELAY)
+        name = self.remote.get_name_future('tacho-motor', 'outA').result(2)
+        self.assertEqual(self.remote.get_attribute_future(name, 'position').result(2), '42')
+        self.assertEqual(self.fleet.get_attribute('tacho-motor', 'outA', 'position').values, { 'slow' : '42' })
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+#
+# Tests for the remote EV3 client, against a server for a fake EV3 on the
+# loopback interface. Run with python -m unittest discover tests.
+#
+import os
+import sys
+import unittest
+from random import randint
+from socket import socket, AF_INET, SOCK_STREAM
+from threading import Thread
+from time import monotonic, sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'ev3net'))
+
+from trace import Trace
+from fake import FakeAttribute, FakeEV3, FakeMediumMotor
+from remote import RemoteEV3
+from server import Server
+
+
+################################################################################
+#
+# Reconnecting after the connection dropped
+#
+class TestReconnect(unittest.TestCase):
+
+    #
+    # Start a server for a fake brick with a motor
+    #
+    def setUp(self):
+        Trace.level = Trace.TRACE_LEVEL_ERROR
+        motor = FakeMediumMotor()
+        motor.add_attribute(FakeAttribute('speed_sp', '0'))
+        self.ev3 = FakeEV3()
+        self.ev3.add_motor(motor, 'outA')
+        self.port = randint(46000, 49000)
+        Thread(target = Server(self.ev3).main, args = ('127.0.0.1', self.port), daemon = True).start()
+        sleep(0.1)
+        self.remote = RemoteEV3('127.0.0.1', self.port)
+
+    def tearDown(self):
+        self.remote.close()
+
+    #
+    # Wait until a condition holds, or a few seconds passed
+    #
+    def wait_for(self, condition):
+        deadline = monotonic() + 2
+        while not condition() and monotonic() < deadline:
+            sleep(0.01)
+        return condition()
+
+    #
+    # A dropped connection is re-established, the session is resumed with
+    # its subscriptions, and writes made meanwhile are sent once resumed. The
+    # subscription may push the current value again after resuming.
+    #
+    def test_resumes_session(self):
+
+        name   = self.remote.get_name('tacho-motor', 'outA')
+        values = []
+        subscription = self.remote.subscribe(name, 'speed_sp', 5, values.append)
+        self.assertTrue(self.wait_for(lambda : values == ['0']))
+
+        self.remote._connection.close()
+        self.remote.set_attribute(name, 'speed_sp', '100')
+
+        self.assertTrue(self.wait_for(lambda : values[-1] == '100'), values)
+        self.assertEqual(self.remote.reconnects, 1)
+        self.assertFalse(subscription.closed)
+        self.assertEqual(self.remote.get_attribute(name, 'speed_sp'), '100')
+
+    #
+    # Reconnecting gives up after the reconnect timeout when the server
+    # accepts the connection but never answers
+    #
+    def test_reconnect_times_out(self):
+
+        silent = socket(AF_INET, SOCK_STREAM)
+        silent.bind(('127.0.0.1', 0))
+        silent.listen()
+        timeout = RemoteEV3.RECONNECT_TIMEOUT
+        RemoteEV3.RECONNECT_TIMEOUT = 0.3
+        try:
+            self.remote._address = silent.getsockname() + (None,)
+            self.remote._connection.close()
+            self.assertTrue(self.wait_for(lambda : self.remote.closed))
+        finally:
+            RemoteEV3.RECONNECT_TIMEOUT = timeout
+            silent.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
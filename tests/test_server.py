@@ -0,0 +1,180 @@
+#
+# Tests for the ev3 network server, against a fake EV3 on the loopback
+# interface. Run with python -m unittest discover tests.
+#
+import os
+import sys
+import unittest
+from random import randint
+from threading import Thread
+from time import monotonic, sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'ev3net'))
+
+from trace import Trace
+from connection import Connection
+from fake import FakeEV3, FakeMediumMotor
+from protocol import BinaryCodec
+from server import Server
+
+
+################################################################################
+#
+# Server that records which motors it stopped
+#
+class RecordingServer(Server):
+
+    __slots__ = [
+        'stopped'
+    ]
+
+    def __init__(self, ev3):
+        super(RecordingServer, self).__init__(ev3)
+        self.stopped = []
+
+    def reset(self, names = None):
+        self.stopped.append(names)
+        super(RecordingServer, self).reset(names)
+
+
+################################################################################
+#
+# Sessions of the single client server
+#
+class TestSessionExpiry(unittest.TestCase):
+
+    #
+    # Start a server for a fake brick with a short grace period
+    #
+    def setUp(self):
+        Trace.level = Trace.TRACE_LEVEL_ERROR
+        self._grace = Server.RESUME_GRACE
+        Server.RESUME_GRACE = 0.3
+        self.ev3 = FakeEV3()
+        self.ev3.add_motor(FakeMediumMotor(), 'outA')
+        self.motor = self.ev3.get_name('tacho-motor', 'outA')
+        self.server = RecordingServer(self.ev3)
+        self.port = randint(46000, 49000)
+        Thread(target = self.server.main, args = ('127.0.0.1', self.port), daemon = True).start()
+        sleep(0.1)
+
+    def tearDown(self):
+        Server.RESUME_GRACE = self._grace
+
+    #
+    # Connect, and start a session that can be resumed
+    #
+    def connect(self):
+        connection = Connection()
+        connection.connect('127.0.0.1', self.port)
+        connection.send(1, 'resume', '')
+        self.assertTrue(connection.recv()[0])
+        return connection
+
+    #
+    # A session dropped without ending it expires while another client is
+    # connected, and the motors it touched are stopped
+    #
+    def test_expires_while_other_client_connected(self):
+
+        first = self.connect()
+        first.send(2, 'set', self.motor, 'command', 'run-forever')
+        first.send(3, 'ping')
+        self.assertTrue(first.recv()[0])
+        first.close()
+
+        second = self.connect()
+        try:
+            deadline = monotonic() + 2
+            while not self.server.stopped and monotonic() < deadline:
+                sleep(0.05)
+            self.assertEqual(self.server.stopped, [{ self.motor }])
+        finally:
+            second.close()
+
+
+################################################################################
+#
+# Packets that the server cannot decode
+#
+class TestInvalidPackets(unittest.TestCase):
+
+    #
+    # Start a server for a fake brick
+    #
+    def setUp(self):
+        Trace.level = Trace.TRACE_LEVEL_ERROR
+        self.ev3 = FakeEV3()
+        self.ev3.add_motor(FakeMediumMotor(), 'outA')
+        self.port = randint(46000, 49000)
+        Thread(target = Server(self.ev3).main, args = ('127.0.0.1', self.port), daemon = True).start()
+        sleep(0.1)
+
+    #
+    # Connect, and send raw data. Receiving gives up after a while, for when
+    # the server stopped responding.
+    #
+    def connect(self, data):
+        connection = Connection()
+        connection.connect('127.0.0.1', self.port)
+        connection._client_socket.settimeout(2)
+        connection._client_socket.sendall(data)
+        return connection
+
+    #
+    # Ping the server on a connection
+    #
+    def ping(self, connection):
+        connection.send(7, 'ping')
+        result, response = connection.recv()
+        self.assertTrue(result)
+        self.assertEqual(response[:2], (7, 'ret'))
+
+    #
+    # A message without a request id, as sent by clients that predate them,
+    # is skipped and the connection keeps working
+    #
+    def test_skips_message_without_id(self):
+        data = b'get:tacho-motor/motor0:position'
+        connection = self.connect(Connection.LENGTH.pack(len(data) + Connection.LENGTH.size) + data)
+        try:
+            self.ping(connection)
+        finally:
+            connection.close()
+
+    #
+    # A binary message with an opcode added by a newer version of the
+    # protocol is skipped
+    #
+    def test_skips_unknown_opcode(self):
+        connection = self.connect(b'')
+        try:
+            connection.send(1, 'proto', BinaryCodec.NAME)
+            self.assertEqual(connection.recv()[1][2], [BinaryCodec.NAME])
+            connection.codec = BinaryCodec()
+            data = BinaryCodec.HEADER.pack(2, 255)
+            connection._client_socket.sendall(Connection.LENGTH.pack(len(data) + Connection.LENGTH.size) + data)
+            self.ping(connection)
+        finally:
+            connection.close()
+
+    #
+    # A length prefix shorter than the prefix itself drops the connection,
+    # and the server accepts the next one
+    #
+    def test_drops_connection_on_invalid_length(self):
+        connection = self.connect(Connection.LENGTH.pack(2))
+        try:
+            self.assertEqual(connection.recv(), (False, None))
+        finally:
+            connection.close()
+
+        connection = self.connect(b'')
+        try:
+            self.ping(connection)
+        finally:
+            connection.close()
+
+
+if __name__ == "__main__":
+    unittest.main()